@@ -0,0 +1,613 @@
+import argparse
+from http.server import BaseHTTPRequestHandler, SimpleHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+from pathlib import Path
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from functools import partial
+from urllib.parse import urlsplit
+from openai import OpenAI
+import pandas as pd
+import psutil
+
+from classes import (BatchManifest, DataParser, OpenAIBatchTransport, PDFDownloader, PDFScraper, RequestScheduler, ResponseCache,
+                     StatementLocator, PDF_BACKENDS, STATEMENT_EXPECTED, build_page_index, estimate_tokens, open_pdf)
+from reportparser import collect_batches, plan_batch
+
+STAGES = ["text_extraction", "page_selection", "reduced_pdfs", "extraction", "batch", "consolidation", "download", "link_ranking"]
+
+# Stages run once per PDF backend, and reported as <stage>/<backend>
+BACKEND_STAGES = ["text_extraction", "reduced_pdfs"]
+
+STATEMENT_TITLES = {
+    'balance_sheet': "Consolidated balance sheet",
+    'income_statement': "Consolidated income statement",
+    'cash_flow_statement': "Consolidated cash flow statement"
+}
+
+NARRATIVE = ("The group continued to invest in its strategy during the year, with progress across all regions. "
+             "Management remains focused on disciplined capital allocation, customer growth and operational "
+             "efficiency, while the board keeps oversight of risk, governance and long-term value creation.")
+
+def pdf_string(text):
+    return "(" + text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") + ")"
+
+def write_synthetic_report(path, num_pages, seed=0):
+    """
+    Writes an annual report PDF of num_pages pages of narrative text, with the
+    balance sheet, income statement and cash flow statement on three consecutive
+    pages in the middle. The PDF is written by hand, so no PDF library is needed.
+
+    Returns the 0-indexed pages of each statement.
+    """
+    rng = random.Random(seed)
+    first = num_pages//2
+    statement_pages = {key: [first + i] for i, key in enumerate(STATEMENT_TITLES)}
+
+    contents = []
+    for i in range(num_pages):
+        lines = []
+        statement = next((key for key, pages in statement_pages.items() if i in pages), None)
+        if statement:
+            lines.append(STATEMENT_TITLES[statement])
+            lines.append("EUR million Note 2024 2023")
+            items = list(STATEMENT_EXPECTED[statement]) + [f"other {statement.replace('_', ' ')} item {n}" for n in range(30)]
+            for item in items:
+                lines.append(f"{item.replace('_', ' ').capitalize()} {rng.randint(1, 30)} {rng.randint(100, 99999):,} {rng.randint(100, 99999):,}")
+        else:
+            lines.append(f"Management report {i + 1}")
+            for _ in range(40):
+                lines.append(NARRATIVE[:rng.randint(60, 95)])
+        stream = "BT /F1 9 Tf 11 TL 40 800 Td " + " ".join(f"{pdf_string(line)} Tj T*" for line in lines) + " ET"
+        contents.append(stream.encode("latin-1"))
+
+    # Objects: 1 catalog, 2 pages, 3 font, then a page and a content stream per page
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        ("<< /Type /Pages /Kids [" + " ".join(f"{4 + 2*i} 0 R" for i in range(num_pages)) + f"] /Count {num_pages} >>").encode(),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"
+    ]
+    for i, stream in enumerate(contents):
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2*i} 0 R >>".encode())
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n".encode() + stream + b"\nendstream")
+
+    with open(path, "wb") as f:
+        f.write(b"%PDF-1.4\n")
+        offsets = []
+        for n, obj in enumerate(objects, start=1):
+            offsets.append(f.tell())
+            f.write(f"{n} 0 obj\n".encode() + obj + b"\nendobj\n")
+        xref = f.tell()
+        f.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode())
+        for offset in offsets:
+            f.write(f"{offset:010d} 00000 n \n".encode())
+        f.write(f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+    return statement_pages
+
+def synthetic_history(num_years, num_items=60, seed=0):
+    """
+    Returns a statement as parsed over num_years years, as a list of dicts with a
+    'year' key, where some line items are renamed part way through the history.
+    """
+    rng = random.Random(seed)
+    renames = {f"item_{n}": f"total_item_{n}" for n in range(0, num_items, 7)}
+    history = []
+    for i in range(num_years):
+        year = 2024 - i
+        d = {'year': year}
+        for n in range(num_items):
+            key = f"item_{n}"
+            if i > num_years//2 and key in renames:
+                key = renames[key]
+            d[key] = round(1000*(n + 1)*(1 + 0.03*rng.random())**(num_years - i), 1)
+        history.append(d)
+    return history
+
+class FakeOpenAI():
+    """
+    Local stand-in for the OpenAI files, responses and batches endpoints.
+
+    Responses are replayed from a recording of one response per structured
+    output format, and synthesized from the requested schema for formats which
+    aren't recorded. A batch job runs its requests the same way as soon as it
+    is created, and is reported completed. Every request waits latency seconds,
+    and the bytes and estimated tokens received are counted.
+    """
+    def __init__(self, recordings_path="fixtures\\openai_responses.json", latency=0.05):
+        self.recordings = {}
+        if os.path.exists(recordings_path):
+            with open(recordings_path, "r", encoding="utf-8") as f:
+                self.recordings = json.load(f)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.files = {}
+        self.batches = {}
+        self.reset()
+
+        fake = self
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                parts = urlsplit(self.path).path.rstrip("/").split("/")
+                if parts[-1] == "content":
+                    self.respond(fake.files.get(parts[-2], ""), "application/octet-stream")
+                elif parts[-1] == "batches":
+                    self.respond(fake.list_batches())
+                elif parts[-2] == "batches" and parts[-1] in fake.batches:
+                    self.respond(fake.batches[parts[-1]])
+                else:
+                    self.respond(fake.file(parts[-1], 0))
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                fake.count(len(body))
+                time.sleep(fake.latency)
+                if self.path.endswith("/files"):
+                    self.respond(fake.upload(body))
+                elif self.path.endswith("/batches"):
+                    self.respond(fake.create_batch(json.loads(body)))
+                else:
+                    self.respond(fake.response(json.loads(body)))
+
+            def respond(self, payload, content_type="application/json"):
+                data = payload.encode() if isinstance(payload, str) else json.dumps(payload).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return
+
+    def reset(self):
+        self.requests = 0
+        self.bytes_sent = 0
+        self.tokens_sent = 0
+
+    def count(self, size):
+        with self.lock:
+            self.requests += 1
+            self.bytes_sent += size
+
+    def file(self, file_id, size):
+        return {"id": file_id, "object": "file", "bytes": size, "created_at": 0,
+                "filename": "report.pdf", "purpose": "user_data", "status": "processed"}
+
+    def upload(self, body):
+        """
+        Stores an uploaded file. Batch input files, JSON lines of requests, are
+        kept to be run by create_batch.
+        """
+        lines = [line.strip().decode() for line in body.split(b"\n") if line.strip().startswith(b'{"custom_id"')]
+        if not lines:
+            return self.file(f"file-{len(body)}", len(body))
+        with self.lock:
+            file_id = f"file-batch-{len(self.files)}"
+            self.files[file_id] = "\n".join(lines)
+        return dict(self.file(file_id, len(body)), filename="batch.jsonl", purpose="batch")
+
+    def create_batch(self, body):
+        """
+        Runs every request of a batch's input file, and returns the completed job.
+        """
+        output = []
+        for line in self.files[body['input_file_id']].splitlines():
+            request = json.loads(line)
+            output.append(json.dumps({"id": f"batch_req_{len(output)}", "custom_id": request['custom_id'], "error": None,
+                                      "response": {"status_code": 200, "request_id": "req_fake",
+                                                   "body": self.response(request['body'])}}))
+        with self.lock:
+            batch_id = f"batch_{len(self.batches)}"
+            output_file_id = f"file-output-{len(self.files)}"
+            self.files[output_file_id] = "\n".join(output)
+            self.batches[batch_id] = {
+                "id": batch_id, "object": "batch", "endpoint": body['endpoint'], "input_file_id": body['input_file_id'],
+                "completion_window": body['completion_window'], "status": "completed", "created_at": int(time.time()),
+                "output_file_id": output_file_id, "error_file_id": None,
+                "request_counts": {"completed": len(output), "failed": 0, "total": len(output)}
+            }
+            return self.batches[batch_id]
+
+    def list_batches(self):
+        with self.lock:
+            batches = sorted(self.batches.values(), key=lambda b: b['created_at'], reverse=True)
+        return {"object": "list", "data": batches, "has_more": False,
+                "first_id": batches[0]['id'] if batches else None, "last_id": batches[-1]['id'] if batches else None}
+
+    def response(self, body):
+        texts = [c.get('text', "") for m in body['input'] if isinstance(m, dict) for c in m.get('content', [])] \
+            if isinstance(body['input'], list) else [body['input']]
+        with self.lock:
+            self.tokens_sent += estimate_tokens(*texts)
+
+        text_format = body.get('text', {}).get('format', {})
+        name = text_format.get('name')
+        if name in self.recordings:
+            output = self.recordings[name]
+        elif text_format.get('schema'):
+            output = self.synthesize(text_format['schema'])
+        else:
+            output = {}
+        return {
+            "id": "resp_fake", "object": "response", "created_at": 0, "model": body.get('model'),
+            "status": "completed", "parallel_tool_calls": False, "tool_choice": "auto", "tools": [],
+            "output": [{
+                "type": "message", "id": "msg_fake", "status": "completed", "role": "assistant",
+                "content": [{"type": "output_text", "text": json.dumps(output), "annotations": []}]
+            }]
+        }
+
+    def synthesize(self, schema):
+        output = {}
+        for key, prop in schema['properties'].items():
+            if prop.get('type') == "object":
+                output[key] = self.synthesize(prop)
+            elif prop.get('type') == "array":
+                output[key] = [{"key": f"other_item_{n}", "value": 100.0*n} for n in range(5)]
+            else:
+                output[key] = 1000.0
+        return output
+
+    def close(self):
+        self.server.shutdown()
+
+class RSSMonitor():
+    """
+    Samples the resident set size of this process in the background, to report
+    the peak of each stage.
+    """
+    def __init__(self, interval=0.005):
+        self.process = psutil.Process()
+        self.interval = interval
+        self.peak = 0
+        self.running = False
+
+    def __enter__(self):
+        self.peak = self.process.memory_info().rss
+        self.running = True
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def sample(self):
+        while self.running:
+            self.peak = max(self.peak, self.process.memory_info().rss)
+            time.sleep(self.interval)
+
+    def __exit__(self, *args):
+        self.running = False
+        self.thread.join()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+
+class Benchmark():
+    """
+    Times each stage of the pipeline on generated fixtures, without network
+    access: a synthetic report PDF, a fake OpenAI endpoint and a local site
+    serving PDF links.
+
+    Parameters:
+        pages (int): Number of pages of the synthetic report.
+        latency (float): Seconds the fake OpenAI endpoint waits per request.
+        repeat (int): Number of runs of each stage. The median is reported.
+        backends (list): PDF backends to run BACKEND_STAGES with.
+    """
+    def __init__(self, pages=300, latency=0.05, repeat=3, backends=None, verbose=False):
+        self.pages = pages
+        self.latency = latency
+        self.repeat = repeat
+        self.backends = backends if backends else list(PDF_BACKENDS)
+        self.backend = "pypdf2"
+        self.verbose = verbose
+        self.workdir = tempfile.mkdtemp(prefix="benchmark")
+        self.report_path = f"{self.workdir}\\report"
+        self.report_name = "report.pdf"
+        self.pdf_path = f"{self.report_path}\\{self.report_name}"
+        Path(self.report_path).mkdir(parents=True, exist_ok=True)
+        self.statement_pages = write_synthetic_report(self.pdf_path, pages)
+        self.fake = FakeOpenAI(latency=latency)
+
+        client = OpenAI(api_key="benchmark", base_url=self.fake.url, max_retries=0)
+        self.dataparser = DataParser(verbose=False, cache=ResponseCache(enabled=False),
+                                     scheduler=RequestScheduler(limits={}), client=client)
+        self.dataparser.uploads.registry_path = f"{self.workdir}\\uploads.json"
+        return
+
+    def run(self, stages=STAGES):
+        """
+        Returns the results of each stage: its median wall time, peak RSS, and
+        for stages talking to the fake endpoint or site, the bytes, tokens and
+        requests sent or received. Stages which process pages also report the
+        wall time per page.
+        """
+        results = {}
+        for stage in stages:
+            for backend in (self.backends if stage in BACKEND_STAGES else [None]):
+                name = f"{stage}/{backend}" if backend else stage
+                self.backend = backend or "pypdf2"
+                runs = []
+                for _ in range(self.repeat):
+                    setup = getattr(self, f"setup_{stage}", None)
+                    context = setup() if setup else None
+                    self.fake.reset()
+                    with RSSMonitor() as rss:
+                        start = time.perf_counter()
+                        counters = getattr(self, stage)(context) or {}
+                        wall = time.perf_counter() - start
+                    if counters.get('pages'):
+                        counters['ms_per_page'] = wall*1000/counters['pages']
+                    runs.append(dict(wall_s=wall, peak_rss_mb=rss.peak/1024**2, **counters))
+                result = {key: statistics.median(r[key] for r in runs) for key in runs[0]}
+                results[name] = result
+                if self.verbose:
+                    print(f"{name}: " + ", ".join(f"{k}={v:.4g}" for k, v in result.items()))
+        return results
+
+    def setup_text_extraction(self):
+        if os.path.exists(f"{self.report_path}\\pages.idx"):
+            os.remove(f"{self.report_path}\\pages.idx")
+
+    def text_extraction(self, context):
+        build_page_index(self.pdf_path, f"{self.report_path}\\pages.idx", backend=self.backend)
+        return {'pages': self.pages}
+
+    def setup_page_selection(self):
+        return build_page_index(self.pdf_path, f"{self.report_path}\\pages.idx")
+
+    def page_selection(self, page_texts):
+        located = StatementLocator().locate(page_texts)
+        return {'correct': sum(located.get(key) == pages for key, pages in self.statement_pages.items())}
+
+    def reduced_pdfs(self, context):
+        with open_pdf(self.pdf_path, self.backend) as pdf:
+            for key, pages in self.statement_pages.items():
+                self.dataparser.save_reduced_pdf(self.pdf_path, f"{self.report_path}\\_{key}_{self.report_name}", pages, pdf)
+        return {'pages': sum(len(pages) for pages in self.statement_pages.values())}
+
+    def extraction(self, context):
+        self.dataparser.parse_report_for_year(self.report_path, self.report_name, 2024)
+        return {'requests': self.fake.requests, 'bytes_sent': self.fake.bytes_sent, 'tokens_sent': self.fake.tokens_sent}
+
+    def setup_batch(self):
+        batch_path = f"{self.workdir}\\batch"
+        shutil.rmtree(batch_path, ignore_errors=True)
+        Path(f"{batch_path}\\company\\2024").mkdir(parents=True, exist_ok=True)
+        shutil.copy(self.pdf_path, f"{batch_path}\\company\\2024\\{self.report_name}")
+        return batch_path
+
+    def batch(self, batch_path):
+        """
+        Runs reportparser --batch submit and collect against the fake endpoint,
+        then parses the year offline, from the responses the batch cached.
+        correct is 1 if the year was collected, nothing was left to submit again,
+        and the offline parse found every statement.
+        """
+        id_path = f"{batch_path}\\company"
+        pdfs = pd.DataFrame({'filename': [self.report_name]}, index=pd.Index([2024], name='year'))
+        cache = ResponseCache(cache_dir=f"{batch_path}\\responses")
+        dataparser = DataParser(verbose=False, cache=cache, scheduler=self.dataparser.scheduler, client=self.dataparser.client)
+        dataparser.uploads.registry_path = f"{batch_path}\\uploads.json"
+        requests, cache_keys, planned = plan_batch(dataparser, "company", id_path, pdfs, [2024], "")
+        transport = OpenAIBatchTransport(self.dataparser.client, scheduler=self.dataparser.scheduler)
+        batches = BatchManifest(f"{batch_path}\\batches.json")
+        batches.add(transport.submit(requests), cache_keys, {"company": planned})
+        batches.save()
+        collected = collect_batches(cache, transport, batches)
+
+        remaining, _, _ = plan_batch(dataparser, "company", id_path, pdfs, [2024], "")
+        offline = DataParser(verbose=False, cache=ResponseCache(cache_dir=f"{batch_path}\\responses", offline=True),
+                             scheduler=self.dataparser.scheduler, client=self.dataparser.client)
+        missing = offline.parse_report_for_year(f"{id_path}\\2024", self.report_name, 2024)
+        correct = collected == {"company": [2024]} and not remaining and not missing
+        return {'requests': self.fake.requests, 'batch_requests': len(requests), 'correct': int(correct)}
+
+    def setup_consolidation(self):
+        return {key: synthetic_history(30, seed=i) for i, key in enumerate(STATEMENT_EXPECTED)}
+
+    def consolidation(self, histories):
+        columns = 0
+        for key, history in histories.items():
+            columns += len(self.dataparser.consolidate_reports(history, key.replace("_", " "), "", "").columns)
+            self.dataparser.consolidate_windows(history, key.replace("_", " "), "", "", window=10, overlap=2, workers=3)
+        return {'columns': columns}
+
+    def setup_download(self):
+        site = Path(self.workdir) / "site"
+        shutil.rmtree(site, ignore_errors=True)
+        shutil.rmtree(Path(self.workdir) / "downloads", ignore_errors=True)
+        site.mkdir(parents=True, exist_ok=True)
+        (Path(self.workdir) / "downloads").mkdir(parents=True, exist_ok=True)
+        links = []
+        for n in range(8):
+            shutil.copy(self.pdf_path, site / f"annual_report_{2017 + n}.pdf")
+            links.append(f"annual_report_{2017 + n}.pdf")
+        with open(site / "index.html", "w") as f:
+            f.write("<html><body>" + "".join(f'<a href="{l}">{l}</a>' for l in links) + "</body></html>")
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), partial(QuietHandler, directory=site))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        downloads = [(f"{url}/{l}", str(Path(self.workdir) / "downloads" / l)) for l in links]
+        return server, downloads
+
+    def download(self, context):
+        server, downloads = context
+        failed = PDFDownloader(workers=4).download_all(downloads)
+        server.shutdown()
+        received = sum(os.path.getsize(path) for _, path in downloads if os.path.exists(path))
+        return {'files': len(downloads) - len(failed), 'bytes_received': received}
+
+    def setup_link_ranking(self):
+        rng = random.Random(0)
+        rows = []
+        for n in range(5000):
+            year = rng.randint(1995, 2024)
+            kind = rng.choice(["annual-report", "interim-report", "sustainability", "press-release", "ar"])
+            rows.append({'href': f"https://example.com/{year}/{kind}-{n}.pdf", 'text': f"{kind} {year}",
+                         'title': "", 'base_domain': "example.com"})
+        return rows
+
+    def link_ranking(self, links):
+        shortlisted = PDFScraper(verbose=False, client=self.dataparser.client).shortlist_pdf_links(links)
+        return {'links': len(links), 'shortlisted': len(shortlisted)}
+
+    def close(self):
+        self.fake.close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def compare(base_path, new_path):
+    """
+    Returns a DataFrame of each stage's metrics in two result files, and the
+    relative change.
+    """
+    with open(base_path) as f:
+        base = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    rows = []
+    for stage in base['stages']:
+        if stage not in new['stages']:
+            continue
+        for metric, value in base['stages'][stage].items():
+            if metric in new['stages'][stage]:
+                after = new['stages'][stage][metric]
+                rows.append({'stage': stage, 'metric': metric, base['commit']: value, new['commit']: after,
+                             'change': (after - value)/value if value else None})
+    return pd.DataFrame(rows).set_index(['stage', 'metric'])
+
+def run():
+    # Parse args for program
+    parser = argparse.ArgumentParser(prog="benchmark", description="Times each stage of the scraper and parser on generated fixtures, offline.")
+    parser.add_argument(
+        "-s", "--stages",
+        type=str,
+        nargs="+",
+        choices=STAGES,
+        default=STAGES,
+        required=False,
+        help="Stages to run. Defaults to all."
+    )
+    parser.add_argument(
+        "--pages",
+        type=int,
+        default=300,
+        required=False,
+        help="Number of pages of the synthetic report. Defaults to 300."
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=50,
+        required=False,
+        help="Milliseconds the fake OpenAI endpoint waits per request. Defaults to 50."
+    )
+    parser.add_argument(
+        "-b", "--backends",
+        type=str,
+        nargs="+",
+        choices=list(PDF_BACKENDS),
+        default=list(PDF_BACKENDS),
+        required=False,
+        help="PDF backends to run text_extraction and reduced_pdfs with. Defaults to all."
+    )
+    parser.add_argument(
+        "-r", "--repeat",
+        type=int,
+        default=3,
+        required=False,
+        help="Number of runs of each stage, of which the median is reported. Defaults to 3."
+    )
+    parser.add_argument(
+        "-o", "--output",
+        type=str,
+        required=False,
+        help="File to save the results to. Defaults to benchmarks\\<commit>.json."
+    )
+    parser.add_argument(
+        "--compare",
+        type=str,
+        nargs=2,
+        required=False,
+        metavar=("BASE", "NEW"),
+        help="Compare two saved results, and exit."
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        required=False,
+        help="Only run the fake OpenAI endpoint, e.g. for reportparser --openai-url, until interrupted."
+    )
+    parser.add_argument(
+        "-v", "--verbose",
+        action="store_true",
+        required=False,
+        help="Enable verbose mode"
+    )
+    args = vars(parser.parse_args())
+
+    if args.get('compare'):
+        with pd.option_context('display.max_rows', None, 'display.width', 200):
+            print(compare(*args.get('compare')))
+        return
+
+    if args.get('serve'):
+        fake = FakeOpenAI(latency=args.get('latency')/1000)
+        print(f"Serving the fake OpenAI endpoint on {fake.url}")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            fake.close()
+        return
+
+    benchmark = Benchmark(pages=args.get('pages'), latency=args.get('latency')/1000,
+                          repeat=args.get('repeat'), backends=args.get('backends'), verbose=args.get('verbose'))
+    try:
+        stages = benchmark.run([s for s in STAGES if s in args.get('stages')])
+    finally:
+        benchmark.close()
+
+    commit = git_commit()
+    results = {
+        'commit': commit,
+        'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'pages': args.get('pages'),
+        'latency_ms': args.get('latency'),
+        'repeat': args.get('repeat'),
+        'backends': args.get('backends'),
+        'stages': stages
+    }
+    output = args.get('output') or f"benchmarks\\{commit}.json"
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=1)
+
+    print(pd.DataFrame(stages).T.to_string())
+    print(f"Saved results to {output}")
+    return
+
+if __name__ == "__main__":
+    run()
@@ -1,31 +1,2557 @@
 import os
 import asyncio
+import contextlib
+import cProfile
+import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import csv
+import hashlib
+import heapq
+import io
+import itertools
 import json
+import mmap
+from pathlib import Path
+import pstats
+import random
+import re
+import socket
+import sqlite3
+import threading
+import time
+from urllib.parse import urldefrag, urlsplit, urlunsplit
 from crawl4ai import AsyncWebCrawler, BrowserConfig, CrawlerRunConfig
 from crawl4ai.deep_crawling import BestFirstCrawlingStrategy
 from crawl4ai.deep_crawling.scorers import KeywordRelevanceScorer
-from openai import OpenAI
+from openai import OpenAI, NotFoundError, APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 import PyPDF2
-from secret import openai_key
+import pypdfium2 as pdfium
+import requests
+from requests.adapters import HTTPAdapter
+try:
+    from secret import openai_key
+except ImportError:
+    # Offline tools such as benchmark run without a secret.py
+    openai_key = os.environ.get("OPENAI_API_KEY")
+
+# PDFs above either limit are split into one reduced PDF per statement
+MAX_REQUEST_MB = 32
+MAX_REQUEST_PAGES = 100
+
+EXTRACTION_MODEL = "o1"
+
+# Requests and tokens per minute allowed per model, to be set to the account's limits
+RATE_LIMITS = {
+    "o1": {'rpm': 500, 'tpm': 30000},
+    "o3-mini": {'rpm': 1000, 'tpm': 100000}
+}
+
+# USD per million input and output tokens, for the cost estimates of run reports
+MODEL_PRICES = {
+    "o1": (15.0, 60.0),
+    "o3-mini": (1.1, 4.4)
+}
+
+# Queued model requests with a lower priority are sent first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKFILL = 1
+
+# Extracted page text is sent instead of the PDF only if it is at least this rich
+MIN_TEXT_CHARS_PER_PAGE = 200
+MIN_TEXT_NUMBERS = 10
+
+# Titles and line items used by StatementLocator to score report pages
+STATEMENT_SYNONYMS = {
+    'balance_sheet': ["balance sheet", "statement of financial position", "statements of financial position",
+                      "financial position", "statement of assets and liabilities"],
+    'income_statement': ["income statement", "statement of income", "statements of income", "profit and loss",
+                         "profit or loss", "statement of operations", "statements of operations",
+                         "statement of comprehensive income", "statement of earnings"],
+    'cash_flow_statement': ["cash flow statement", "statement of cash flows", "statements of cash flows",
+                            "cash flows statement", "statement of cash flow"]
+}
+STATEMENT_TERMS = {
+    'balance_sheet': ["total assets", "current assets", "non-current assets", "noncurrent assets", "total equity",
+                      "current liabilities", "inventories", "trade receivables", "retained earnings", "share capital"],
+    'income_statement': ["revenue", "cost of sales", "gross profit", "operating profit", "operating result",
+                         "earnings per share", "income tax", "profit for the year", "net income", "finance costs"],
+    'cash_flow_statement': ["operating activities", "investing activities", "financing activities",
+                            "cash and cash equivalents at", "dividends paid", "depreciation", "income taxes paid",
+                            "net change in cash", "proceeds from", "purchase of"]
+}
+
+# Line item key normalization used by Consolidator
+KEY_STOPWORDS = {"and", "of", "the", "in", "from", "for", "to", "total", "activities"}
+KEY_TOKEN_ALIASES = {
+    "flows": "flow", "operations": "operating", "operational": "operating", "equivalents": "equivalent",
+    "receivable": "receivables", "payable": "payables", "liability": "liabilities", "asset": "assets",
+    "expenses": "expense", "costs": "cost", "revenues": "revenue", "stockholders": "shareholders",
+    "provision": "provisions", "taxes": "tax", "investments": "investment", "reserve": "reserves"
+}
+
+# Local ranking of PDF links before they are sent to the model
+MIN_REPORT_YEAR = 1980
+NUMBER_PATTERN = re.compile(r"\(?-?[\d.,]*\d\)?")
+YEAR_PATTERN = re.compile(r"(?<!\d)((?:19|20)\d{2})(?!\d)")
+# The file identifier in a PDF trailer, two hex strings of 16 bytes each
+PDF_ID_PATTERN = re.compile(rb"/ID\[(<[0-9A-Fa-f]{32}><[0-9A-Fa-f]{32}>)\]")
+ANNUAL_REPORT_KEYWORDS = ["annual", "report", "financial", "statement", "10-k", "20-f", "registration document", "yearbook"]
+OTHER_REPORT_KEYWORDS = ["quarter", "interim", "half-year", "half year", "presentation", "sustainability", "proxy", "agm", "invitation", "q1", "q2", "q3"]
+
+# Columns of links.csv, as returned by crawl4ai for each link
+LINK_COLUMNS = ["href", "text", "title", "base_domain"]
+
+STATEMENTS = ['balance_sheet', 'income_statement', 'cash_flow_statement']
+
+EXPECTED_BALANCE_SHEET = [
+    "total_assets", "current_assets", "non_current_assets",
+    "total_liabilities", "current_liabilities", "non_current_liabilities",
+    "total_shareholders_equity", "share_capital", "retained_earnings"
+    ]
+EXPECTED_INCOME_STATEMENT = [
+    "total_revenue", "total_expenses", "net_gains", "net_losses",
+    "earnings_per_share"
+    ]
+EXPECTED_CASH_FLOW_STATEMENT = [
+    "cash_and_cash_equivalents_at_beginning_of_period",
+    "cash_and_cash_equivalents_at_end_of_period",
+    "cash_from_operations", "cash_from_investing", "cash_from_financing",
+    "net_change_in_cash", "free_cash_flow"
+    ]
+
+STATEMENT_EXPECTED = {
+    'balance_sheet': EXPECTED_BALANCE_SHEET,
+    'income_statement': EXPECTED_INCOME_STATEMENT,
+    'cash_flow_statement': EXPECTED_CASH_FLOW_STATEMENT
+}
+
+# Extra attempts at a statement whose response fails validation
+STATEMENT_RETRIES = 2
+
+def statement_schema(expected_columns):
+    """
+    Returns the strict JSON schema of one extracted statement: a number or null
+    for each expected key, and any other line items as key and value pairs,
+    since strict schemas can't have free-form keys.
+    """
+    properties = {key: {"type": ["number", "null"]} for key in expected_columns}
+    properties['other_items'] = {
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": {
+                "key": {"type": "string"},
+                "value": {"type": "number"}
+            },
+            "required": ["key", "value"],
+            "additionalProperties": False
+        }
+    }
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties.keys()),
+        "additionalProperties": False
+    }
+
+def json_schema_format(name, schema):
+    """
+    Returns the text format of a responses request for strict schema output.
+    """
+    return {
+        "format": {
+            "type": "json_schema",
+            "name": name,
+            "schema": schema,
+            "strict": True
+        }
+    }
+
+def report_format():
+    """
+    Returns the text format for extracting all statements from a full report.
+    """
+    schema = {
+        "type": "object",
+        "properties": {key: statement_schema(expected) for key, expected in STATEMENT_EXPECTED.items()},
+        "required": STATEMENTS,
+        "additionalProperties": False
+    }
+    return json_schema_format("annual_report_statements", schema)
+
+def flatten_statement(output):
+    """
+    Returns a statement response as a flat dict of line item to value, leaving
+    out expected keys which weren't reported.
+    """
+    statement = {key: value for key, value in output.items() if key != 'other_items' and value is not None}
+    for item in output.get('other_items', []):
+        statement[normalize_key(item['key'])] = item['value']
+    return statement
+
+def validate_statement(output):
+    """
+    Returns the list of problems with a statement response, which is empty if
+    the response can be used.
+    """
+    if not isinstance(output, dict):
+        return ["the response is not a JSON object"]
+    problems = []
+    keys = [key for key, value in output.items() if key != 'other_items' and value is not None]
+    for item in output.get('other_items', []):
+        key = normalize_key(item.get('key', ""))
+        if not key:
+            problems.append("an item of other_items has no key")
+        elif key in keys:
+            problems.append(f"{key} is given more than once")
+        keys.append(key)
+    for key, value in flatten_statement(output).items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value != value or abs(value) == float('inf'):
+            problems.append(f"{key} is not a number")
+    if not keys:
+        problems.append("no line items were found")
+    return problems
+
+def json_object(output_text):
+    """
+    Returns a response text parsed as a JSON object, or None if it isn't one,
+    e.g. because the response was truncated or refused.
+    """
+    try:
+        output = json.loads(output_text)
+    except (TypeError, ValueError):
+        return None
+    return output if isinstance(output, dict) else None
+
+def is_valid_statement(output_text):
+    return not validate_statement(json_object(output_text))
+
+def requires_split(pdf_path, num_pages):
+    """
+    Returns True if the PDF is too large to send to OpenAI in a single request.
+    """
+    return os.path.getsize(pdf_path)/1024**2 > MAX_REQUEST_MB or num_pages > MAX_REQUEST_PAGES
+
+def normalize_url(url):
+    """
+    Returns url without its fragment and surrounding whitespace, and with the
+    scheme and host lowercased, so that equivalent links compare equal.
+    """
+    parts = urlsplit(urldefrag(url.strip())[0])
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, parts.query, ""))
+
+def page_links(result):
+    """
+    Returns the PDF links of a crawled page, and the normalized URLs of the other
+    pages of its site which it links to.
+    """
+    pdfs = []
+    children = []
+    for l in result.links.get("internal", []) + result.links.get("external", []):
+        if '.pdf' in l['href'].lower():
+            pdfs.append(l)
+    for l in result.links.get("internal", []):
+        if '.pdf' not in l['href'].lower() and l['href'].lower().startswith("http"):
+            children.append(normalize_url(l['href']))
+    return pdfs, children
+
+def response_validators(result):
+    """
+    Returns the ETag and Last-Modified of a rendered page from its response
+    headers, or None if it has neither.
+    """
+    headers = {k.lower(): v for k, v in (getattr(result, 'response_headers', None) or {}).items()}
+    if not headers.get('etag') and not headers.get('last-modified'):
+        return None
+    return {'etag': headers.get('etag'), 'last_modified': headers.get('last-modified'), 'sha256': None}
+
+def normalize_key(key):
+    """
+    Returns a line item key in lowercase_with_underscores, with spellings such as
+    "non-current" and "non_current" unified.
+    """
+    key = str(key).lower().replace("&", " and ")
+    key = re.sub(r"non[\s_-]+current", "noncurrent", key)
+    return re.sub(r"[^a-z0-9]+", "_", key).strip("_")
+
+def key_tokens(key):
+    """
+    Returns the set of meaningful tokens of a line item key, for fuzzy matching.
+    """
+    tokens = set()
+    for token in normalize_key(key).split("_"):
+        token = KEY_TOKEN_ALIASES.get(token, token)
+        if token and token not in KEY_STOPWORDS:
+            tokens.add(token)
+    return frozenset(tokens)
+
+def to_number(value):
+    """
+    Returns value as a number, or None if it isn't one.
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return None if value != value else value
+    if isinstance(value, str):
+        text = value.strip().replace(",", "")
+        if text.startswith("(") and text.endswith(")"):
+            text = "-" + text[1:-1]
+        try:
+            return float(text)
+        except ValueError:
+            return None
+    return None
+
+def file_sha256(path, chunk_size=1024**2):
+    """
+    Returns the hex SHA-256 digest of a file, reading it in chunks.
+    """
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def write_csv(df, path):
+    """
+    Writes df to the CSV at path through a temporary file, so that readers,
+    possibly in other processes, never see a half written file.
+    """
+    tmp_path = f"{path}.tmp"
+    df.to_csv(tmp_path)
+    os.replace(tmp_path, path)
+
+class PDFBackend():
+    """
+    Page count, page text extraction and page subset writing for one open PDF.
+    Use as a context manager, or call close() when done.
+    """
+    name = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def page_texts(self):
+        return [self.page_text(i) for i in range(self.num_pages())]
+
+class PyPDF2Backend(PDFBackend):
+    """
+    The reference backend, reading PDFs with PyPDF2.
+
+    The file is memory-mapped instead of read into memory, and PyPDF2 only
+    parses the objects of a page once the page is accessed.
+    """
+    name = "pypdf2"
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.reader = PyPDF2.PdfReader(self.map)
+        return
+
+    def num_pages(self):
+        return len(self.reader.pages)
+
+    def page_text(self, page_num):
+        return self.reader.pages[page_num].extract_text() or ""
+
+    def write_pages(self, page_numbers, output_path):
+        writer = PyPDF2.PdfWriter()
+        for page_num in page_numbers:
+            writer.add_page(self.reader.pages[page_num])
+        with open(output_path, "wb") as outfile:
+            writer.write(outfile)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+class PdfiumBackend(PDFBackend):
+    """
+    Reads PDFs with PDFium, which extracts text faster than PyPDF2.
+
+    PDFium reads the file on demand and loads each page only when accessed.
+    It isn't thread safe, so its calls are serialized within a process.
+    """
+    name = "pdfium"
+    lock = threading.RLock()
+
+    def __init__(self, path):
+        with self.lock:
+            self.pdf = pdfium.PdfDocument(path)
+        return
+
+    def num_pages(self):
+        return len(self.pdf)
+
+    def page_text(self, page_num):
+        with self.lock:
+            page = self.pdf[page_num]
+            textpage = page.get_textpage()
+            text = textpage.get_text_bounded()
+            textpage.close()
+            page.close()
+        # Lines end in \r\n, where PyPDF2 ends them in \n
+        return text.replace("\r\n", "\n")
+
+    def write_pages(self, page_numbers, output_path):
+        buffer = io.BytesIO()
+        with self.lock:
+            reduced = pdfium.PdfDocument.new()
+            reduced.import_pages(self.pdf, list(page_numbers))
+            reduced.save(buffer)
+            reduced.close()
+        data = buffer.getvalue()
+        # PDFium writes a random /ID in the trailer. The same pages must give the
+        # same file, as responses are cached and files uploaded by their hash, so
+        # it is replaced by a hash of the rest of the file, of the same length.
+        ids = list(PDF_ID_PATTERN.finditer(data))
+        if ids:
+            start, end = ids[-1].span(1)
+            digest = hashlib.md5(data[:start] + data[end:]).hexdigest().upper().encode()
+            data = data[:start] + b"<" + digest + b"><" + digest + b">" + data[end:]
+        with open(output_path, "wb") as f:
+            f.write(data)
+
+    def close(self):
+        with self.lock:
+            self.pdf.close()
+
+PDF_BACKENDS = {backend.name: backend for backend in (PyPDF2Backend, PdfiumBackend)}
+
+def open_pdf(path, backend="pypdf2"):
+    """
+    Opens the PDF at path with one of PDF_BACKENDS.
+    """
+    if backend not in PDF_BACKENDS:
+        raise ValueError(f"Unknown PDF backend {backend}, expected one of {list(PDF_BACKENDS)}.")
+    return PDF_BACKENDS[backend](path)
+
+def read_page_index(pdf_path, index_path, backend="pypdf2"):
+    """
+    Returns the page texts of the index at index_path if it is current, i.e.
+    made from the same PDF with the same backend, and None otherwise.
+    """
+    if not os.path.exists(index_path):
+        return None
+    try:
+        with open(index_path, "r", encoding="utf-8") as f:
+            index = json.load(f)
+    except ValueError:
+        return None
+    # Indexes written before backends were selectable are from PyPDF2
+    if index.get('sha256') == file_sha256(pdf_path) and index.get('backend', "pypdf2") == backend:
+        return index.get('pages')
+    return None
+
+def build_page_index(pdf_path, index_path, pdf=None, backend="pypdf2"):
+    """
+    Returns the extracted text of every page in pdf_path.
+
+    The texts are saved to index_path, keyed by the SHA-256 of the PDF and the
+    backend which extracted them, so that text extraction runs once per file.
+    An existing index is reused as long as both match.
+
+    Parameters:
+        pdf_path (str): Path to the PDF.
+        index_path (str): Path of the page text index, e.g. <report_path>\\pages.idx.
+        pdf (PDFBackend): Optional PDF already open on pdf_path.
+        backend (str): Name of the backend to open pdf_path with, if pdf isn't given.
+    """
+    backend = pdf.name if pdf is not None else backend
+    pages = read_page_index(pdf_path, index_path, backend)
+    if pages is not None:
+        return pages
+
+    if pdf is None:
+        with open_pdf(pdf_path, backend) as pdf:
+            return build_page_index(pdf_path, index_path, pdf)
+
+    pages = pdf.page_texts()
+    tmp_path = f"{index_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({'sha256': file_sha256(pdf_path), 'backend': backend, 'pages': pages}, f)
+    os.replace(tmp_path, index_path)
+    return pages
+
+def estimate_tokens(*texts):
+    """
+    Returns a rough count of the tokens in texts, at about 4 characters per token.
+    """
+    return sum(len(str(t)) for t in texts)//4
+
+def index_report(pdf_path, index_path, backend="pypdf2"):
+    """
+    Builds the page text index of pdf_path, and returns its number of pages and
+    the seconds it took, or None instead of the seconds if the index was
+    already current.
+    Defined at module level so that it can run in a process pool.
+    """
+    pages = read_page_index(pdf_path, index_path, backend)
+    if pages is not None:
+        return len(pages), None
+    start = time.perf_counter()
+    pages = build_page_index(pdf_path, index_path, backend=backend)
+    return len(pages), time.perf_counter() - start
+
+class TokenBucket():
+    """
+    Allows up to rate units per minute, in bursts of at most one minute's worth.
+    """
+    def __init__(self, rate):
+        self.rate = rate/60
+        self.capacity = rate
+        self.level = rate
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        return
+
+    def time_until(self, amount):
+        """
+        Returns the seconds until amount units are available. Amounts above the
+        capacity wait for a full bucket.
+        """
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated)*self.rate)
+        self.updated = now
+        if now < self.paused_until:
+            return self.paused_until - now
+        return max(0, (min(amount, self.capacity) - self.level)/self.rate)
+
+    def take(self, amount):
+        self.level -= min(amount, self.capacity)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.level = 0
+
+class RequestScheduler():
+    """
+    Sends every OpenAI request, limiting the requests and tokens per minute of
+    each model, and retrying rate limited, timed out and failed requests with
+    exponential backoff and jitter.
+
+    Requests waiting for the same model are sent in order of priority, then
+    arrival. A rate limited response pauses all requests to its model for the
+    backoff delay, instead of letting the other threads run into the limit too.
+
+    Limits and priorities only apply within one process. Processes sharing an
+    account, such as several --shard workers or serve workers, each keep to the
+    full limits, so RATE_LIMITS should be divided between them.
+
+    Parameters:
+        limits (dict): Model to its 'rpm' and 'tpm' limits. Models without
+            limits are not throttled.
+        max_retries (int): Attempts after the first one before giving up.
+        base_delay (float): Backoff delay of the first retry, in seconds.
+        max_delay (float): Maximum backoff delay, in seconds.
+    """
+    retryable = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+
+    def __init__(self, limits=None, max_retries=5, base_delay=1.0, max_delay=60.0, verbose=False):
+        self.limits = RATE_LIMITS if limits is None else limits
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.verbose = verbose
+        self.condition = threading.Condition()
+        self.order = itertools.count()
+        self.buckets = {}
+        self.waiting = {}
+        for model, limit in self.limits.items():
+            self.buckets[model] = [TokenBucket(limit['rpm']), TokenBucket(limit['tpm'])]
+            self.waiting[model] = []
+        self.metrics = {}
+        return
+
+    def call(self, create, model=None, tokens=0, priority=PRIORITY_BACKFILL):
+        """
+        Returns create(), called once the model's limits allow a request of about
+        tokens tokens. Transient errors are retried.
+        """
+        for attempt in range(self.max_retries + 1):
+            queued = time.monotonic()
+            self.acquire(model, tokens, priority)
+            started = time.monotonic()
+            try:
+                result = create()
+                self.record(model, started - queued, time.monotonic() - started)
+                return result
+            except self.retryable as e:
+                self.record(model, started - queued, time.monotonic() - started, retry=True)
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff(attempt, e)
+                if self.verbose:
+                    print(f"{type(e).__name__} from {model or 'openai'}, retrying in {delay:.1f}s.")
+                if isinstance(e, RateLimitError) and model in self.buckets:
+                    with self.condition:
+                        self.buckets[model][0].pause(delay)
+                        self.condition.notify_all()
+                else:
+                    time.sleep(delay)
+
+    def acquire(self, model, tokens, priority):
+        if model not in self.buckets:
+            return
+        with self.condition:
+            ticket = (priority, next(self.order))
+            waiting = self.waiting[model]
+            heapq.heappush(waiting, ticket)
+            while True:
+                if waiting[0] == ticket:
+                    requests, token_bucket = self.buckets[model]
+                    wait = max(requests.time_until(1), token_bucket.time_until(tokens))
+                    if wait == 0:
+                        requests.take(1)
+                        token_bucket.take(tokens)
+                        heapq.heappop(waiting)
+                        self.condition.notify_all()
+                        return
+                    self.condition.wait(wait)
+                else:
+                    self.condition.wait()
+
+    def backoff(self, attempt, error):
+        """
+        Returns the delay before retrying, honouring a Retry-After header.
+        """
+        delay = min(self.max_delay, self.base_delay*2**attempt)*random.uniform(0.5, 1.0)
+        response = getattr(error, 'response', None)
+        if response is not None:
+            try:
+                delay = max(delay, float(response.headers.get('retry-after', 0)))
+            except (TypeError, ValueError):
+                pass
+        return delay
+
+    def record(self, model, wait, service, retry=False):
+        with self.condition:
+            m = self.metrics.setdefault(model or "openai", {'requests': 0, 'retries': 0, 'wait': 0.0, 'service': 0.0, 'max_wait': 0.0})
+            m['requests'] += 1
+            m['retries'] += retry
+            m['wait'] += wait
+            m['service'] += service
+            m['max_wait'] = max(m['max_wait'], wait)
+
+    def stats(self):
+        lines = []
+        for model, m in self.metrics.items():
+            lines.append(f"Requests to {model}: {m['requests']} sent, {m['retries']} retried, "
+                         f"{m['wait']/m['requests']:.2f}s average wait (max {m['max_wait']:.2f}s), "
+                         f"{m['service']/m['requests']:.2f}s average service.")
+        return "\n".join(lines)
+
+class Tracer():
+    """
+    Records timed spans of a run, such as a crawl, a download or a model call,
+    with attributes like bytes, pages and tokens.
+
+    Each span is appended to report_path as a JSON line when it ends. Spans
+    opened inside another span on the same thread record it as their parent.
+    The summary is kept as running totals, so a long-running process can drop
+    the spans themselves.
+
+    Parameters:
+        report_path (str): Optional JSON lines file to write the spans to.
+        keep_spans (bool): Keep every span in spans. Without it, memory doesn't
+            grow with the number of spans.
+    """
+    SUMMARY_COLUMNS = ['bytes', 'pages', 'input_tokens', 'output_tokens', 'cost_usd', 'keys', 'unresolved']
+
+    def __init__(self, report_path=None, run_id=None, keep_spans=True):
+        self.report_path = report_path
+        self.run_id = run_id if run_id else datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        self.keep_spans = keep_spans
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.ids = itertools.count(1)
+        self.spans = []
+        self.totals = {}
+        if self.report_path:
+            Path(self.report_path).parent.mkdir(parents=True, exist_ok=True)
+        return
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        """
+        Times the enclosed block. Yields the span's attributes, to which the block
+        can add its results.
+        """
+        stack = self.local.__dict__.setdefault('stack', [])
+        record = {
+            'run': self.run_id,
+            'span': name,
+            'id': next(self.ids),
+            'parent': stack[-1] if stack else None,
+            'thread': threading.current_thread().name,
+            'start': time.time()
+        }
+        stack.append(record['id'])
+        started = time.perf_counter()
+        try:
+            yield attrs
+        except BaseException as e:
+            record['error'] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            stack.pop()
+            record['duration_s'] = time.perf_counter() - started
+            record.update(attrs)
+            self.write(record)
+
+    def record(self, name, duration, **attrs):
+        """
+        Records a span timed elsewhere, e.g. in another process.
+        """
+        self.write(dict({'run': self.run_id, 'span': name, 'id': next(self.ids), 'parent': None,
+                         'thread': threading.current_thread().name, 'start': time.time() - duration,
+                         'duration_s': duration}, **attrs))
+
+    def write(self, record):
+        with self.lock:
+            if self.keep_spans:
+                self.spans.append(record)
+            totals = self.totals.setdefault(record['span'], {'count': 0, 'total_s': 0.0, 'max_s': 0.0})
+            totals['count'] += 1
+            totals['total_s'] += record['duration_s']
+            totals['max_s'] = max(totals['max_s'], record['duration_s'])
+            for column in self.SUMMARY_COLUMNS:
+                if record.get(column) is not None:
+                    totals[column] = totals.get(column, 0) + record[column]
+            if self.report_path:
+                with open(self.report_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, default=str) + "\n")
+
+    def summary(self):
+        """
+        Returns a DataFrame of the count, durations, and totals of bytes, pages,
+        tokens, cost and line item keys of each kind of span.
+        """
+        with self.lock:
+            if not self.totals:
+                return pd.DataFrame()
+            summary = pd.DataFrame.from_dict(self.totals, orient='index').sort_index()
+        summary.index.name = 'span'
+        summary['mean_s'] = summary['total_s']/summary['count']
+        return summary[['count', 'total_s', 'mean_s', 'max_s'] + [c for c in self.SUMMARY_COLUMNS if c in summary.columns]]
+
+class Profiler():
+    """
+    Collects cProfile statistics of the enclosed blocks from any thread, for the
+    PDF handling of reports. Does nothing unless enabled.
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.stats = None
+        return
+
+    @contextlib.contextmanager
+    def profile(self):
+        if not self.enabled:
+            yield
+            return
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            with self.lock:
+                if self.stats is None:
+                    self.stats = pstats.Stats(profile)
+                else:
+                    self.stats.add(profile)
+
+    def dump(self, path):
+        """
+        Writes the collected statistics to path, readable with pstats or snakeviz.
+        """
+        if self.stats is None:
+            return
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.stats.dump_stats(path)
+
+def create_response(client, scheduler, tracer, priority=PRIORITY_BACKFILL, tokens=None, **body):
+    """
+    Sends a responses request through the scheduler, records it as a model_call
+    span with its tokens and estimated cost, and returns the output text.
+    tokens is the estimated size of the request, by default from its input.
+    """
+    model = body['model']
+    with tracer.span("model_call", model=model) as span:
+        if tokens is None:
+            tokens = estimate_tokens(json.dumps(body['input'], default=str))
+        response = scheduler.call(lambda: client.responses.create(**body), model=model, tokens=tokens, priority=priority)
+        usage = getattr(response, 'usage', None)
+        if usage is not None:
+            span['input_tokens'] = usage.input_tokens
+            span['output_tokens'] = usage.output_tokens
+            if model in MODEL_PRICES:
+                span['cost_usd'] = (usage.input_tokens*MODEL_PRICES[model][0] + usage.output_tokens*MODEL_PRICES[model][1])/1e6
+        return response.output_text
+
+class ResponseCache():
+    """
+    On-disk cache of OpenAI response texts.
+
+    Entries are keyed by the model, the prompt, and the SHA-256 of every file sent
+    with it, so repeating an identical request skips both the file upload and the
+    model call. Entries older than max_age_days are evicted, and the least
+    recently used entries are evicted once the cache exceeds max_size_mb.
+
+    Parameters:
+        cache_dir (str): Directory holding one JSON file per response.
+        enabled (bool): With False, the cache is neither read nor written.
+        refresh (bool): Ignore cached entries, but store the new responses.
+        offline (bool): Never call OpenAI. A miss raises a LookupError, which
+            allows replaying recorded responses without network access.
+    """
+    def __init__(self, cache_dir="cache\\responses", max_size_mb=512, max_age_days=90,
+                 enabled=True, refresh=False, offline=False, verbose=False):
+        self.cache_dir = cache_dir
+        self.max_size_mb = max_size_mb
+        self.max_age_days = max_age_days
+        self.enabled = enabled
+        self.refresh = refresh
+        self.offline = offline
+        self.verbose = verbose
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if self.enabled:
+            Path(self.cache_dir).mkdir(parents=True, exist_ok=True)
+            self.evict()
+        return
+
+    def key(self, model, prompt, files=(), **params):
+        """
+        Returns the cache key for a request. files are paths of files sent with
+        the prompt, which are keyed by content rather than by name or upload id.
+        params are any other request options which change the response, such as
+        a response format.
+        """
+        request = {
+            'model': model,
+            'prompt': prompt,
+            'files': [file_sha256(f) for f in files],
+            'params': params
+        }
+        return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode()).hexdigest()
+
+    def contains(self, key):
+        return self.enabled and not self.refresh and os.path.exists(f"{self.cache_dir}\\{key}.json")
+
+    def get_or_create(self, key, create, validate=None):
+        """
+        Returns the cached response text for key. On a miss, create() is called to
+        get the response text, which is then cached.
+
+        With validate, a function of the response text, only responses for which
+        it returns True are cached, and cached responses for which it returns
+        False are evicted and requested again. This keeps a bad response from
+        being replayed on every run.
+        """
+        path = f"{self.cache_dir}\\{key}.json"
+        if self.enabled and not self.refresh and os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    output_text = json.load(f)['output_text']
+                if validate is None or validate(output_text):
+                    os.utime(path)
+                    with self.lock:
+                        self.hits += 1
+                    if self.verbose:
+                        print(f"Using cached response {key}.")
+                    return output_text
+                if self.verbose:
+                    print(f"Evicting invalid cached response {key}.")
+                os.remove(path)
+            except (OSError, ValueError, KeyError):
+                pass
+
+        with self.lock:
+            self.misses += 1
+        if self.offline:
+            raise LookupError(f"No cached response for {key} in offline mode.")
+
+        output_text = create()
+        if validate is None or validate(output_text):
+            self.put(key, output_text)
+        return output_text
+
+    def put(self, key, output_text):
+        """
+        Caches output_text for key, e.g. for a response received outside of
+        get_or_create.
+        """
+        if self.enabled:
+            path = f"{self.cache_dir}\\{key}.json"
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({'key': key, 'created': time.time(), 'output_text': output_text}, f)
+            os.replace(tmp_path, path)
+
+    def evict(self):
+        """
+        Removes entries older than max_age_days, then the least recently used
+        entries until the cache is within max_size_mb.
+        """
+        if not self.enabled:
+            return
+        entries = []
+        now = time.time()
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(".json"):
+                continue
+            # Other processes sharing the cache may evict or replace entries meanwhile
+            try:
+                stat = entry.stat()
+                if now - stat.st_mtime > self.max_age_days*86400:
+                    os.remove(entry.path)
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            except FileNotFoundError:
+                pass
+
+        size = sum(e[1] for e in entries)
+        for _, entry_size, entry_path in sorted(entries):
+            if size <= self.max_size_mb*1024**2:
+                break
+            try:
+                os.remove(entry_path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+
+    def stats(self):
+        return f"Response cache: {self.hits} hits, {self.misses} misses."
+
+class UploadRegistry():
+    """
+    Persistent map from the SHA-256 of a file to its OpenAI file id, so that the
+    same PDF is never uploaded twice. A registered file id is checked with OpenAI
+    once per session before it is reused.
+
+    Parameters:
+        client (OpenAI): Client used for uploads.
+        registry_path (str): JSON file holding the registry.
+    """
+    def __init__(self, client, registry_path="cache\\uploads.json", verbose=False, scheduler=None, tracer=None):
+        self.client = client
+        self.registry_path = registry_path
+        self.verbose = verbose
+        self.scheduler = scheduler if scheduler else RequestScheduler(limits={}, verbose=verbose)
+        self.tracer = tracer if tracer else Tracer()
+        self.lock = threading.Lock()
+        self.file_locks = {}
+        self.verified = set()
+        self.removed = set()
+        self.entries = {}
+        if os.path.exists(self.registry_path):
+            with open(self.registry_path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+        return
+
+    def upload(self, path):
+        """
+        Returns the OpenAI file id of the file at path, uploading it only if no
+        valid upload with the same content exists.
+        """
+        sha256 = file_sha256(path)
+        with self.lock:
+            file_lock = self.file_locks.setdefault(sha256, threading.Lock())
+
+        # Concurrent uploads of the same content wait for the first one
+        with file_lock:
+            entry = self.entries.get(sha256)
+            if entry and self.is_valid(entry['file_id']):
+                if self.verbose:
+                    print(f"Reusing upload {entry['file_id']} for {path}.")
+                return entry['file_id']
+
+            if self.verbose:
+                print(f"Uploading {path} to openai...")
+            def create():
+                with open(path, "rb") as f:
+                    return self.client.files.create(file=f, purpose="user_data")
+            with self.tracer.span("upload", file=os.path.basename(path), bytes=os.path.getsize(path)):
+                openai_file = self.scheduler.call(create)
+
+            with self.lock:
+                self.entries[sha256] = {
+                    'file_id': openai_file.id,
+                    'filename': os.path.basename(path),
+                    'bytes': os.path.getsize(path),
+                    'uploaded': time.time()
+                }
+                self.verified.add(openai_file.id)
+                self.save()
+            return openai_file.id
+
+    def is_valid(self, file_id):
+        if file_id in self.verified:
+            return True
+        try:
+            self.scheduler.call(lambda: self.client.files.retrieve(file_id))
+        except NotFoundError:
+            return False
+        with self.lock:
+            self.verified.add(file_id)
+        return True
+
+    def gc(self, max_age_days=30):
+        """
+        Deletes uploads older than max_age_days from OpenAI, and drops them from the
+        registry along with uploads which no longer exist. Returns the number of
+        entries removed.
+        """
+        removed = 0
+        now = time.time()
+        for sha256, entry in list(self.entries.items()):
+            if now - entry['uploaded'] > max_age_days*86400:
+                try:
+                    self.scheduler.call(lambda: self.client.files.delete(entry['file_id']))
+                except NotFoundError:
+                    pass
+            elif self.is_valid(entry['file_id']):
+                continue
+            if self.verbose:
+                print(f"Removing upload {entry['file_id']} of {entry['filename']}.")
+            with self.lock:
+                del self.entries[sha256]
+                self.removed.add(sha256)
+                self.verified.discard(entry['file_id'])
+            removed += 1
+
+        with self.lock:
+            self.save()
+        return removed
+
+    def save(self):
+        """
+        Writes the registry to disk, merged with the uploads registered by other
+        processes since it was read. Callers must hold self.lock.
+        """
+        Path(self.registry_path).parent.mkdir(parents=True, exist_ok=True)
+        with FileLock(f"{self.registry_path}.lock"):
+            if os.path.exists(self.registry_path):
+                with open(self.registry_path, "r", encoding="utf-8") as f:
+                    entries = json.load(f)
+                for sha256, entry in entries.items():
+                    if sha256 not in self.removed:
+                        self.entries.setdefault(sha256, entry)
+            tmp_path = f"{self.registry_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.entries, f, indent=1)
+            os.replace(tmp_path, self.registry_path)
+
+class ParseManifest():
+    """
+    Records what each year's output.json of a company was generated from: the
+    SHA-256 of the PDF, a fingerprint of the prompts, and the model. Also records
+    the fingerprint of the inputs of the last consolidation.
+
+    Parameters:
+        manifest_path (str): JSON file holding the manifest, e.g. data\\<id>\\manifest.json.
+    """
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.manifest = {'years': {}, 'consolidation': None}
+        self.changed = set()
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                self.manifest.update(json.load(f))
+        return
+
+    def pdf_sha256(self, year, pdf_path):
+        """
+        Returns the SHA-256 of pdf_path, reusing the recorded hash if the file's
+        size and modification time are unchanged.
+        """
+        stat = os.stat(pdf_path)
+        entry = self.manifest['years'].get(str(year))
+        if entry and entry['pdf_size'] == stat.st_size and entry['pdf_mtime'] == stat.st_mtime:
+            return entry['pdf_sha256']
+        return file_sha256(pdf_path)
+
+    def is_current(self, year, pdf_path, output_path, prompt_sha256, model):
+        """
+        Returns True if output_path exists and was generated from the current PDF,
+        prompts and model.
+        """
+        entry = self.manifest['years'].get(str(year))
+        if not entry or not os.path.exists(output_path):
+            return False
+        return (entry['pdf_sha256'] == self.pdf_sha256(year, pdf_path)
+                and entry['prompt_sha256'] == prompt_sha256
+                and entry['model'] == model
+                and entry['output_sha256'] == file_sha256(output_path))
+
+    def record(self, year, pdf_path, output_path, prompt_sha256, model):
+        stat = os.stat(pdf_path)
+        self.manifest['years'][str(year)] = {
+            'pdf_sha256': self.pdf_sha256(year, pdf_path),
+            'pdf_size': stat.st_size,
+            'pdf_mtime': stat.st_mtime,
+            'prompt_sha256': prompt_sha256,
+            'model': model,
+            'output_sha256': file_sha256(output_path)
+        }
+        self.changed.add(str(year))
+
+    def consolidation_is_current(self, fingerprint):
+        return self.manifest['consolidation'] == fingerprint
+
+    def record_consolidation(self, fingerprint):
+        self.manifest['consolidation'] = fingerprint
+        self.changed.add('consolidation')
+
+    def save(self):
+        """
+        Writes the manifest to disk. Only the entries recorded since it was read
+        are written over the manifest on disk, so that processes parsing other
+        years of the same company don't lose each other's entries.
+        """
+        with FileLock(f"{self.manifest_path}.lock"):
+            if os.path.exists(self.manifest_path):
+                with open(self.manifest_path, "r", encoding="utf-8") as f:
+                    manifest = json.load(f)
+                manifest.setdefault('years', {})
+                for key in self.changed:
+                    if key == 'consolidation':
+                        manifest['consolidation'] = self.manifest['consolidation']
+                    else:
+                        manifest['years'][key] = self.manifest['years'][key]
+                self.manifest.update(manifest)
+            tmp_path = f"{self.manifest_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.manifest, f, indent=1)
+            os.replace(tmp_path, self.manifest_path)
+            self.changed = set()
+
+def response_output_text(body):
+    """
+    Returns the output text of a responses API response given as a dict, as in
+    the results of a batch job.
+    """
+    texts = []
+    for item in body.get('output', []):
+        if item.get('type') == "message":
+            for content in item.get('content', []):
+                if content.get('type') == "output_text":
+                    texts.append(content['text'])
+    return "".join(texts)
+
+class OpenAIBatchTransport():
+    """
+    Runs batch jobs of responses requests with the OpenAI Batch API.
+
+    Any object with the same submit, status and results methods can be used in
+    its place, e.g. to run batches against a local fake server.
+
+    Parameters:
+        client (OpenAI): Client used for the batch files and jobs.
+        completion_window (str): Time within which OpenAI completes the job.
+        scheduler (RequestScheduler): Retries the requests, as the client doesn't.
+    """
+    endpoint = "/v1/responses"
+
+    def __init__(self, client, completion_window="24h", scheduler=None):
+        self.client = client
+        self.completion_window = completion_window
+        self.scheduler = scheduler if scheduler else RequestScheduler()
+        return
+
+    def submit(self, requests):
+        """
+        Submits requests, a list of (custom_id, body), as one batch job. Returns
+        the id of the job.
+        """
+        lines = [json.dumps({"custom_id": custom_id, "method": "POST", "url": self.endpoint, "body": body})
+                 for custom_id, body in requests]
+        batch_file = self.scheduler.call(lambda: self.client.files.create(
+            file=("batch.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch"))
+        def create():
+            # A request which timed out may still have created the job, and a
+            # second job for the same file would be billed twice
+            existing = self.find(batch_file.id)
+            if existing is not None:
+                return existing
+            return self.client.batches.create(input_file_id=batch_file.id,
+                                              endpoint=self.endpoint,
+                                              completion_window=self.completion_window)
+        batch = self.scheduler.call(create)
+        return batch.id
+
+    def find(self, input_file_id, limit=100):
+        """
+        Returns the most recent job created from input_file_id, among the last
+        limit jobs, or None.
+        """
+        for batch in self.client.batches.list(limit=limit).data:
+            if batch.input_file_id == input_file_id:
+                return batch
+        return None
+
+    def status(self, batch_id):
+        """
+        Returns the status of a job, with its counts of completed, failed and
+        total requests.
+        """
+        batch = self.scheduler.call(lambda: self.client.batches.retrieve(batch_id))
+        counts = batch.request_counts
+        return {
+            'status': batch.status,
+            'completed': counts.completed if counts else 0,
+            'failed': counts.failed if counts else 0,
+            'total': counts.total if counts else 0
+        }
+
+    def results(self, batch_id):
+        """
+        Returns a dict of custom_id to the output text of each request of a
+        finished job, or None for requests which failed.
+        """
+        batch = self.scheduler.call(lambda: self.client.batches.retrieve(batch_id))
+        results = {}
+        for file_id in [batch.output_file_id, batch.error_file_id]:
+            if not file_id:
+                continue
+            for line in self.scheduler.call(lambda: self.client.files.content(file_id)).text.splitlines():
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                response = item.get('response')
+                if response and response.get('status_code') == 200:
+                    results[item['custom_id']] = response_output_text(response['body'])
+                else:
+                    results[item['custom_id']] = None
+        return results
+
+class BatchManifest():
+    """
+    Records the batch jobs submitted by reportparser --batch: for each job, the
+    response cache key of every request, and the years of each company which
+    are parsed once the job's results are collected.
+    """
+    def __init__(self, manifest_path="data\\batches.json"):
+        self.manifest_path = manifest_path
+        self.jobs = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                self.jobs = json.load(f)
+        return
+
+    def add(self, batch_id, requests, reports):
+        self.jobs[batch_id] = {
+            'status': "submitted",
+            'submitted': time.time(),
+            'requests': requests,
+            'reports': reports
+        }
+
+    def pending(self):
+        return {batch_id: job for batch_id, job in self.jobs.items() if job['status'] != "collected"}
+
+    def save(self):
+        Path(self.manifest_path).parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.jobs, f, indent=1)
+        os.replace(tmp_path, self.manifest_path)
+
+def remove_if_stale(path, max_age, tag):
+    """
+    Removes path if it wasn't modified for max_age seconds. Returns its age if
+    it was removed, or None if it is recent or gone.
+
+    The file is moved aside to a name unique to tag before it is checked again
+    and removed, so that of several processes finding it stale only one removes
+    it, and a file which another process replaced in the meantime is put back.
+    """
+    aside = f"{path}.{tag}.expired"
+    try:
+        if time.time() - os.path.getmtime(path) <= max_age:
+            return None
+        os.replace(path, aside)
+    except FileNotFoundError:
+        return None
+    try:
+        age = time.time() - os.path.getmtime(aside)
+        if age <= max_age:
+            try:
+                os.link(aside, path)
+            except FileExistsError:
+                pass
+            except OSError:
+                # Shared drives without hard links, such as SMB shares, can only
+                # rename it back, if no other process took its place meanwhile
+                if not os.path.exists(path):
+                    try:
+                        os.rename(aside, path)
+                    except FileExistsError:
+                        pass
+            return None
+        return age
+    finally:
+        try:
+            os.remove(aside)
+        except FileNotFoundError:
+            pass
+
+class FileLock():
+    """
+    Lock shared by processes and hosts using the same directory, held by
+    creating its file exclusively. Use as a context manager.
+
+    Parameters:
+        path (str): Lock file.
+        stale (float): Seconds after which a lock file is taken to be left by a
+            crashed process, and is removed.
+    """
+    def __init__(self, path, stale=60, poll=0.05):
+        self.path = path
+        self.stale = stale
+        self.poll = poll
+        return
+
+    def __enter__(self):
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, f"{socket.gethostname()} {os.getpid()}".encode())
+                os.close(fd)
+                return self
+            except FileExistsError:
+                tag = f"{socket.gethostname()}-{os.getpid()}-{threading.get_ident()}"
+                if remove_if_stale(self.path, self.stale, tag) is not None or not os.path.exists(self.path):
+                    continue
+            time.sleep(self.poll)
+
+    def __exit__(self, *args):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+class LeaseManager():
+    """
+    Shares work units between worker processes, on one or several hosts, through
+    lease files in a shared work directory.
+
+    A worker takes a unit by creating its .lease file exclusively, keeps the
+    lease alive with a heartbeat thread touching the file, and marks the unit
+    done with a .done file. A lease which hasn't been renewed for ttl seconds is
+    from a dead worker and is reclaimed by the next worker to ask for the unit.
+    Hosts' clocks are assumed to agree to well within ttl.
+
+    Units must be safe to run twice, with outputs replaced atomically: in the
+    rare case of two workers reclaiming the same lease, the unit is only run
+    twice.
+
+    Parameters:
+        work_dir (str): Directory shared by all workers of a run.
+        ttl (float): Seconds without a heartbeat after which a lease expires.
+        heartbeat (float): Seconds between heartbeats. Defaults to ttl/4.
+    """
+    def __init__(self, work_dir, ttl=300, heartbeat=None, verbose=False):
+        self.work_dir = work_dir
+        self.ttl = ttl
+        self.heartbeat = heartbeat if heartbeat else ttl/4
+        self.verbose = verbose
+        self.owner = f"{socket.gethostname()}-{os.getpid()}"
+        self.held = set()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        Path(self.work_dir).mkdir(parents=True, exist_ok=True)
+        self.thread = threading.Thread(target=self.renew, daemon=True)
+        self.thread.start()
+        return
+
+    def lease_path(self, unit):
+        return f"{self.work_dir}\\{unit}.lease"
+
+    def done_path(self, unit):
+        return f"{self.work_dir}\\{unit}.done"
+
+    def acquire(self, unit):
+        """
+        Takes the lease of unit. Returns False if the unit is done, or leased by
+        a live worker.
+        """
+        if self.is_done(unit):
+            return False
+        path = self.lease_path(unit)
+        while True:
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, json.dumps({'owner': self.owner, 'acquired': time.time()}).encode())
+                os.close(fd)
+                break
+            except FileExistsError:
+                age = remove_if_stale(path, self.ttl, f"{self.owner}-{threading.get_ident()}")
+                if age is not None:
+                    print(f"Reclaimed expired lease of {unit}, last renewed {age:.0f}s ago.")
+                elif os.path.exists(path):
+                    return False
+        # The unit may have been finished while its lease was being taken
+        if self.is_done(unit):
+            self.release(unit)
+            return False
+        with self.lock:
+            self.held.add(unit)
+        return True
+
+    def owns(self, unit):
+        try:
+            with open(self.lease_path(unit), "r", encoding="utf-8") as f:
+                return json.load(f).get('owner') == self.owner
+        except (FileNotFoundError, ValueError):
+            return False
+
+    def renew(self):
+        while not self.stopping.wait(self.heartbeat):
+            with self.lock:
+                held = list(self.held)
+            for unit in held:
+                # A lease can be moved aside by another worker at any time, and
+                # the work directory may be a network share
+                try:
+                    if self.owns(unit):
+                        now = time.time()
+                        os.utime(self.lease_path(unit), (now, now))
+                        continue
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    print(f"Error renewing the lease of {unit}:")
+                    print(e)
+                    continue
+                print(f"Lost the lease of {unit} to another worker.")
+                with self.lock:
+                    self.held.discard(unit)
+
+    def release(self, unit):
+        with self.lock:
+            self.held.discard(unit)
+        if self.owns(unit):
+            os.remove(self.lease_path(unit))
+
+    def complete(self, unit, **info):
+        """
+        Marks unit as done, with info saved in its .done file, and releases its lease.
+        """
+        path = self.done_path(unit)
+        tmp_path = f"{path}.{self.owner}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(dict(owner=self.owner, finished=time.time(), **info), f, default=str)
+        os.replace(tmp_path, path)
+        self.release(unit)
+
+    def is_done(self, unit):
+        return os.path.exists(self.done_path(unit))
+
+    def close(self):
+        """
+        Stops the heartbeat, and releases all held leases.
+        """
+        self.stopping.set()
+        self.thread.join()
+        with self.lock:
+            held = list(self.held)
+        for unit in held:
+            self.release(unit)
+
+class JobQueue():
+    """
+    Persistent queue of reportparser jobs in a SQLite database, for the
+    reportparser serve worker.
+
+    A job is the dict of reportparser arguments it runs with. Jobs are claimed
+    by priority, then in submission order, and never while another job of the
+    same company is running. A failed job is queued again until it has been
+    attempted max_attempts times.
+
+    Several servers can share the database. A running job records the owner
+    which claimed it, which keeps its claims alive with renew(). recover()
+    queues again the jobs left running by the same owner before a restart, and
+    those whose claim wasn't renewed for ttl seconds, from a server which
+    stopped.
+
+    Parameters:
+        db_path (str): SQLite database file.
+        max_attempts (int): Attempts per job before it is marked failed.
+        ttl (float): Seconds without renew() after which a claim expires.
+        owner (str): Name of the server, the same across its restarts. Defaults
+            to the host and process id.
+    """
+    def __init__(self, db_path="data\\jobs.db", max_attempts=3, ttl=300, owner=None):
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        self.ttl = ttl
+        self.owner = owner if owner else f"{socket.gethostname()}-{os.getpid()}"
+        Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+        with self.connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    company TEXT NOT NULL,
+                    args TEXT NOT NULL,
+                    priority INTEGER NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    result TEXT,
+                    error TEXT,
+                    submitted REAL NOT NULL,
+                    started REAL,
+                    finished REAL,
+                    owner TEXT,
+                    heartbeat REAL
+                )""")
+            # Databases from before claims had owners
+            columns = [row['name'] for row in db.execute("PRAGMA table_info(jobs)")]
+            for column, kind in [('owner', "TEXT"), ('heartbeat', "REAL")]:
+                if column not in columns:
+                    db.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, priority, id)")
+        return
+
+    def connect(self):
+        # One connection per call, as connections can't be shared across threads
+        db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return contextlib.closing(db)
+
+    def submit(self, company, args, priority=PRIORITY_BACKFILL):
+        """
+        Queues a job, and returns its id.
+        """
+        with self.connect() as db:
+            cursor = db.execute("INSERT INTO jobs (company, args, priority, status, submitted) VALUES (?, ?, ?, 'queued', ?)",
+                                (company, json.dumps(args), priority, time.time()))
+            return cursor.lastrowid
+
+    def claim(self):
+        """
+        Marks the next runnable job as running, and returns its id and args, or
+        None if no job can run.
+        """
+        with self.connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute("""
+                SELECT id, args FROM jobs
+                WHERE status = 'queued' AND company NOT IN (SELECT company FROM jobs WHERE status = 'running')
+                ORDER BY priority, id LIMIT 1""").fetchone()
+            if row is not None:
+                db.execute("""
+                    UPDATE jobs SET status = 'running', attempts = attempts + 1, started = ?, owner = ?, heartbeat = ?
+                    WHERE id = ?""", (time.time(), self.owner, time.time(), row['id']))
+            db.execute("COMMIT")
+        return (row['id'], json.loads(row['args'])) if row is not None else None
+
+    def complete(self, job_id, result):
+        with self.connect() as db:
+            db.execute("UPDATE jobs SET status = 'done', result = ?, error = NULL, finished = ? WHERE id = ?",
+                       (json.dumps(result, default=str), time.time(), job_id))
+
+    def fail(self, job_id, error, result=None):
+        """
+        Queues a failed job again, or marks it failed after max_attempts attempts.
+        Returns True if the job was queued again.
+        """
+        with self.connect() as db:
+            db.execute("""
+                UPDATE jobs SET status = CASE WHEN attempts < ? THEN 'queued' ELSE 'failed' END,
+                                error = ?, result = ?, finished = ?
+                WHERE id = ?""",
+                       (self.max_attempts, str(error), json.dumps(result, default=str) if result is not None else None,
+                        time.time(), job_id))
+            return db.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()['status'] == "queued"
+
+    def renew(self):
+        """
+        Keeps the claims of this server's running jobs alive.
+        """
+        with self.connect() as db:
+            db.execute("UPDATE jobs SET heartbeat = ? WHERE status = 'running' AND owner = ?", (time.time(), self.owner))
+
+    def recover(self, own=True):
+        """
+        Queues again the expired claims of servers which stopped and, with own,
+        the jobs left running by this owner, which must not be running any.
+        Returns their number.
+        """
+        with self.connect() as db:
+            return db.execute("""
+                UPDATE jobs SET status = 'queued', owner = NULL
+                WHERE status = 'running' AND ((? AND owner = ?) OR heartbeat IS NULL OR heartbeat < ?)""",
+                              (own, self.owner, time.time() - self.ttl)).rowcount
+
+    def get(self, job_id):
+        """
+        Returns a job as a dict, or None if it doesn't exist.
+        """
+        with self.connect() as db:
+            row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job['args'] = json.loads(job['args'])
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+    def recent(self, status=None, limit=100):
+        """
+        Returns the most recent jobs, optionally only those with status, without
+        their args and results.
+        """
+        with self.connect() as db:
+            rows = db.execute(f"""
+                SELECT id, company, priority, status, attempts, error, submitted, started, finished FROM jobs
+                {"WHERE status = ?" if status else ""} ORDER BY id DESC LIMIT ?""",
+                              (status, limit) if status else (limit,)).fetchall()
+        return [dict(row) for row in rows]
+
+class PDFDownloader():
+    """
+    Downloads PDFs concurrently over a pooled HTTP session.
+
+    Files whose ETag, size and hash match the previous download are skipped.
+    Transfers are written to a .part file which is renamed into place once
+    complete, and interrupted transfers are resumed with Range requests. Each
+    download's ETag, size and SHA-256 are kept in a .meta.json file next to it.
+
+    Parameters:
+        workers (int): Number of concurrent transfers.
+        timeout (float): Connect and read timeout in seconds.
+        retries (int): Attempts per file before giving up.
+    """
+    def __init__(self, workers=4, timeout=60, retries=3, verbose=False, tracer=None):
+        self.workers = workers
+        self.timeout = timeout
+        self.retries = retries
+        self.verbose = verbose
+        self.tracer = tracer if tracer else Tracer()
+        self.session = requests.Session()
+        # Retries are left to download, which resumes the partial file on each attempt
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        return
+
+    def download(self, url, path):
+        """
+        Downloads url to path, unless an identical copy already exists.
+        Returns the number of bytes transferred.
+        """
+        meta_path = f"{path}.meta.json"
+        part_path = f"{path}.part"
+        meta = {}
+        if os.path.exists(meta_path):
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+
+        try:
+            head = self.session.head(url, allow_redirects=True, timeout=self.timeout)
+            head.raise_for_status()
+            remote = {
+                'etag': head.headers.get('ETag'),
+                'last_modified': head.headers.get('Last-Modified'),
+                'bytes': int(head.headers['Content-Length']) if 'Content-Length' in head.headers else None,
+                'ranges': head.headers.get('Accept-Ranges') == 'bytes'
+            }
+        except requests.RequestException:
+            # Some servers reject HEAD requests, so fall back to a plain download
+            remote = {'etag': None, 'last_modified': None, 'bytes': None, 'ranges': False}
+
+        if os.path.exists(path) and self.is_current(path, meta, remote):
+            if self.verbose:
+                print(f"Skipping {path}, already downloaded.")
+            return 0
+
+        # A partial file can only be resumed if it is known to be of the same remote
+        # version, by its ETag, or by its Last-Modified date if there is no ETag
+        validator = remote['etag'] or remote['last_modified']
+        partial_validator = meta.get('partial_etag') or meta.get('partial_last_modified')
+        if os.path.exists(part_path) and not (remote['ranges'] and validator and partial_validator == validator):
+            os.remove(part_path)
+
+        transferred = 0
+        for attempt in range(self.retries):
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) and remote['ranges'] and validator else 0
+            headers = {}
+            if offset:
+                headers['Range'] = f"bytes={offset}-"
+                headers['If-Range'] = validator
+            try:
+                with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        offset = 0
+                    with open(meta_path, "w", encoding="utf-8") as f:
+                        json.dump({'url': url,
+                                   'partial_etag': response.headers.get('ETag', remote['etag']),
+                                   'partial_last_modified': response.headers.get('Last-Modified', remote['last_modified'])}, f)
+                    with open(part_path, "ab" if offset else "wb") as f:
+                        for chunk in response.iter_content(chunk_size=1024**2):
+                            f.write(chunk)
+                            transferred += len(chunk)
+                break
+            except requests.RequestException as e:
+                # Client errors other than rate limiting won't go away on a retry
+                status = e.response.status_code if isinstance(e, requests.HTTPError) else None
+                if attempt == self.retries - 1 or (status is not None and status < 500 and status != 429):
+                    raise
+                if self.verbose:
+                    print(f"Retrying {url} after error: {e}")
+                time.sleep(2**attempt)
+
+        size = os.path.getsize(part_path)
+        if remote['bytes'] is not None and size != remote['bytes']:
+            raise IOError(f"Incomplete download of {url}: {size} of {remote['bytes']} bytes.")
+        os.replace(part_path, path)
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump({'url': url, 'etag': remote['etag'], 'bytes': size, 'sha256': file_sha256(path)}, f)
+        return transferred
+
+    def traced_download(self, url, path):
+        with self.tracer.span("download", url=url) as span:
+            span['bytes'] = self.download(url, path)
+            return span['bytes']
+
+    def is_current(self, path, meta, remote):
+        """
+        Returns True if the file at path matches the remote file.
+        """
+        size = os.path.getsize(path)
+        if remote['bytes'] is not None and size != remote['bytes']:
+            return False
+        if meta.get('sha256'):
+            if meta.get('bytes') != size or meta['sha256'] != file_sha256(path):
+                return False
+            return remote['etag'] is None or meta.get('etag') == remote['etag']
+        # Downloaded before metadata was kept, so only the size can be compared
+        return remote['bytes'] is not None
+
+    def download_all(self, downloads):
+        """
+        Downloads a list of (url, path) tuples concurrently, and reports the throughput.
+        Returns a dict of path to exception for the downloads which failed.
+        """
+        failed = {}
+        transferred = 0
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.traced_download, url, path): path for url, path in downloads}
+            for future in as_completed(futures):
+                try:
+                    transferred += future.result()
+                except Exception as e:
+                    failed[futures[future]] = e
+
+        elapsed = time.perf_counter() - start
+        print(f"Downloaded {transferred/1024**2:.1f} MB for {len(downloads) - len(failed)} of {len(downloads)} files "
+              f"in {elapsed:.1f}s ({transferred/1024**2/max(elapsed, 1e-9):.1f} MB/s).")
+        return failed
+
+class StatementLocator():
+    """
+    Scores every page of a report as a candidate page for each statement, and
+    picks a tight window of pages per statement.
+
+    Each page is described by a few features: statement titles and synonyms in
+    its heading and body, statement line items, numeric density, and the share of
+    table-like lines with several numbers. Contents, notes and auditor's report
+    pages are penalized. The features are extracted page by page, and weighted
+    into scores for all pages at once with numpy.
+
+    Parameters:
+        max_window (int): Maximum number of pages picked per statement.
+        min_score (float): Minimum score of the best page. Below it, the statement
+            falls back to the keyword search of DataParser.find_statement_pages.
+    """
+    HEADING_LINES = 8
+
+    def __init__(self, max_window=3, min_score=3.0):
+        self.max_window = max_window
+        self.min_score = min_score
+        self.statements = list(STATEMENT_SYNONYMS.keys())
+        return
+
+    def features(self, page_texts):
+        """
+        Returns a dict of feature arrays. Statement features have shape
+        (pages, statements), page features have shape (pages,).
+        """
+        n = len(page_texts)
+        title = np.zeros((n, len(self.statements)))
+        synonyms = np.zeros((n, len(self.statements)))
+        terms = np.zeros((n, len(self.statements)))
+        numeric_density = np.zeros(n)
+        table_lines = np.zeros(n)
+        contents = np.zeros(n)
+        notes = np.zeros(n)
+        auditor = np.zeros(n)
+
+        for i, text in enumerate(page_texts):
+            text = text.lower()
+            lines = [l for l in text.splitlines() if l.strip()]
+            heading = " ".join(lines[:self.HEADING_LINES])
+            for j, statement in enumerate(self.statements):
+                title[i, j] = any(k in heading for k in STATEMENT_SYNONYMS[statement])
+                synonyms[i, j] = min(sum(text.count(k) for k in STATEMENT_SYNONYMS[statement]), 3)/3
+                terms[i, j] = sum(k in text for k in STATEMENT_TERMS[statement])/len(STATEMENT_TERMS[statement])
+
+            tokens = text.split()
+            if tokens:
+                numeric_density[i] = sum(bool(NUMBER_PATTERN.fullmatch(t)) for t in tokens)/len(tokens)
+            if lines:
+                numbers_per_line = [len(NUMBER_PATTERN.findall(l)) for l in lines]
+                table_lines[i] = sum(c >= 2 for c in numbers_per_line)/len(lines)
+                # Contents pages are lists of titles each ending in a page number
+                page_refs = sum(bool(re.search(r"\s\d{1,3}$", l.strip())) for l in lines)/len(lines)
+                contents[i] = ("contents" in heading) or (page_refs > 0.5 and table_lines[i] < 0.2)
+            notes[i] = "notes to" in heading
+            auditor[i] = "auditor" in heading
+
+        return {
+            'title': title, 'synonyms': synonyms, 'terms': terms,
+            'numeric_density': numeric_density, 'table_lines': table_lines,
+            'contents': contents, 'notes': notes, 'auditor': auditor
+        }
+
+    def scores(self, page_texts, f=None):
+        """
+        Returns an array of shape (pages, statements) with the score of each page
+        for each statement. Precomputed features can be passed in as f.
+        """
+        if f is None:
+            f = self.features(page_texts)
+        relevance = 3*f['title'] + 1*f['synonyms'] + 4*f['terms']
+        page = 2*f['table_lines'] + 2*f['numeric_density'] - 4*f['contents'] - 3*f['notes'] - 3*f['auditor']
+        # Numbers only count towards a statement on pages which relate to it
+        return relevance + (relevance > 0)*page[:, None]
+
+    def locate(self, page_texts):
+        """
+        Returns a dict of statement to its sorted list of page numbers. A
+        statement with no page scoring at least min_score maps to None.
+        """
+        f = self.features(page_texts)
+        scores = self.scores(page_texts, f)
+        pages = {}
+        for j, statement in enumerate(self.statements):
+            best = int(np.argmax(scores[:, j])) if len(page_texts) else 0
+            if not len(page_texts) or scores[best, j] < self.min_score:
+                pages[statement] = None
+                continue
+
+            # Extend the window over continuation pages, stopping at the title of the next statement
+            window = [best]
+            for i in range(best + 1, min(best + self.max_window, len(page_texts))):
+                if scores[i, j] < 0.5*scores[best, j] or f['title'][i].any():
+                    break
+                window.append(i)
+            pages[statement] = window
+        return pages
+
+    def evaluate(self, fixtures):
+        """
+        Returns the precision and recall of locate() per statement, over a list of
+        labeled reports. Each report is a dict with either 'pages', the list of
+        page texts, or 'pdf', the path of a report PDF, and 'labels', a dict of
+        statement to its list of page numbers, counted from 0.
+        """
+        counts = {statement: {'selected': 0, 'labeled': 0, 'correct': 0} for statement in self.statements}
+        for fixture in fixtures:
+            if 'pages' in fixture:
+                pages = fixture['pages']
+            else:
+                with open_pdf(fixture['pdf']) as pdf:
+                    pages = pdf.page_texts()
+            located = self.locate(pages)
+            for statement in self.statements:
+                selected = set(located[statement] or [])
+                labeled = set(fixture['labels'].get(statement, []))
+                counts[statement]['selected'] += len(selected)
+                counts[statement]['labeled'] += len(labeled)
+                counts[statement]['correct'] += len(selected & labeled)
+
+        results = {}
+        for statement, c in counts.items():
+            results[statement] = {
+                'precision': c['correct']/c['selected'] if c['selected'] else 0.0,
+                'recall': c['correct']/c['labeled'] if c['labeled'] else 0.0
+            }
+        return pd.DataFrame(results).T
+
+class Consolidator():
+    """
+    Merges the line items of one statement across years, without a model.
+
+    Every key of every year starts as its own column. Columns are merged when
+    their keys normalize to the same name, or when their keys share enough tokens
+    and their values continue plausibly from one year into the adjacent one.
+    Columns reported in the same year with different values are never merged.
+    Each merged column is named after the key used in its most recent year.
+
+    Parameters:
+        similarity (float): Minimum token similarity (Jaccard) for two keys to be merged.
+        strict_similarity (float): Minimum similarity when value continuity can't be checked.
+        max_jump (float): Maximum ratio between the values of adjacent years for
+            them to count as continuous.
+    """
+    def __init__(self, similarity=0.6, strict_similarity=0.85, max_jump=2.0, verbose=False):
+        self.similarity = similarity
+        self.strict_similarity = strict_similarity
+        self.max_jump = max_jump
+        self.verbose = verbose
+        return
+
+    def consolidate(self, data, aliases=None):
+        """
+        Consolidates a list of dicts, one per year, each with a 'year' key.
+
+        aliases is an optional dict of key to the key it must be merged with, as long
+        as the two don't conflict.
+
+        Returns the consolidated DataFrame indexed by year, the list of column names
+        which could not be matched to another year, and a dict of each input key to
+        the column it was merged into.
+        """
+        years = []
+        series = {}
+        for d in data:
+            years.append(d['year'])
+            for k, v in d.items():
+                if k != 'year':
+                    series.setdefault(k, {})[d['year']] = to_number(v)
+        keys = list(series.keys())
+
+        # Union-find over keys, tracking the values of each group
+        parent = {k: k for k in keys}
+        values = {k: {y: v for y, v in series[k].items() if v is not None} for k in keys}
+
+        def find(k):
+            while parent[k] != k:
+                parent[k] = parent[parent[k]]
+                k = parent[k]
+            return k
+
+        def union(a, b):
+            a, b = find(a), find(b)
+            if a == b:
+                return False
+            shared = values[a].keys() & values[b].keys()
+            if any(values[a][y] != values[b][y] for y in shared):
+                return False
+            parent[b] = a
+            values[a].update(values.pop(b))
+            return True
+
+        for key, target in (aliases or {}).items():
+            if key in parent and target in parent:
+                union(target, key)
+
+        # Score all candidate pairs once, then merge the best pairs first
+        tokens = {k: key_tokens(k) for k in keys}
+        normalized = {k: normalize_key(k) for k in keys}
+        candidates = []
+        for i, a in enumerate(keys):
+            for b in keys[i + 1:]:
+                if normalized[a] == normalized[b]:
+                    candidates.append((2.0, a, b))
+                    continue
+                union_size = len(tokens[a] | tokens[b])
+                similarity = len(tokens[a] & tokens[b])/union_size if union_size else 0
+                if similarity < self.similarity:
+                    continue
+                continuous = self.continuity(values[find(a)], values[find(b)])
+                if continuous is False or (continuous is None and similarity < self.strict_similarity):
+                    continue
+                candidates.append((similarity + 0.5*bool(continuous), a, b))
+
+        for _, a, b in sorted(candidates, key=lambda c: c[0], reverse=True):
+            union(a, b)
+
+        # Name each group after the key used in its most recent year, normalized so
+        # that column names don't depend on a year's spelling. Groups which
+        # normalize alike but conflict are told apart by a trailing underscore.
+        groups = {}
+        for k in keys:
+            groups.setdefault(find(k), []).append(k)
+        names = {}
+        for root, members in groups.items():
+            key = max(members, key=lambda k: max(series[k].keys(), default=0))
+            name = normalize_key(key) or key
+            while name in names.values():
+                name = f"{name}_"
+            names[root] = name
+
+        rows = []
+        for y in years:
+            row = {'year': y}
+            for root in groups:
+                row[names[root]] = values[root].get(y)
+            rows.append(row)
+        result = pd.DataFrame(rows, columns=['year'] + [names[root] for root in groups]).set_index('year')
+
+        # Keys reported in a single year of a longer history are likely unmatched renames
+        unresolved = []
+        if len(years) > 2:
+            unresolved = [names[root] for root in groups if len(values[root]) == 1]
+        if self.verbose:
+            print(f"Merged {len(keys)} keys into {len(groups)} columns, {len(unresolved)} unresolved.")
+        return result, unresolved, {k: names[find(k)] for k in keys}
+
+    def reconcile(self, merged, frame):
+        """
+        Merges frame, a consolidated window of years, into merged, the windows
+        consolidated so far. Both are DataFrames indexed by year.
+
+        A column of frame is matched to a column of merged with the same name, or
+        else to the column whose values are equal in the years both windows
+        cover. Values already in merged take precedence in those years.
+        """
+        overlap = [y for y in frame.index if y in merged.index]
+
+        def agreement(m, c):
+            a = pd.to_numeric(merged.loc[overlap, m], errors='coerce')
+            b = pd.to_numeric(frame.loc[overlap, c], errors='coerce')
+            shared = a.notna() & b.notna()
+            if not np.allclose(a[shared], b[shared]):
+                return None
+            return int(shared.sum())
+
+        rename = {}
+        used = set()
+        for c in frame.columns:
+            if c in merged.columns and agreement(c, c) is not None:
+                rename[c] = c
+                used.add(c)
+        for c in frame.columns:
+            if c in rename:
+                continue
+            candidates = []
+            for m in merged.columns:
+                if m in used or m in frame.columns:
+                    continue
+                shared = agreement(m, c)
+                if shared:
+                    candidates.append((normalize_key(m) == normalize_key(c), len(key_tokens(m) & key_tokens(c)), shared, m))
+            if candidates:
+                m = max(candidates, key=lambda x: x[:3])[3]
+                rename[c] = m
+                used.add(m)
+            else:
+                # A new column, renamed if its name is taken by a conflicting column
+                name = c
+                while name in merged.columns or name in used:
+                    name = f"{name}_"
+                rename[c] = name
+                used.add(name)
+        frame = frame.rename(columns=rename)
+
+        columns = list(merged.columns) + [c for c in frame.columns if c not in merged.columns]
+        result = merged.reindex(columns=columns)
+        frame = frame.reindex(columns=columns)
+        if overlap:
+            result.loc[overlap] = result.loc[overlap].fillna(frame.loc[overlap])
+        result = pd.concat([result, frame.loc[[y for y in frame.index if y not in merged.index]]])
+        if self.verbose:
+            print(f"Reconciled window {list(frame.index)} over {len(overlap)} overlapping years.")
+        return result
+
+    def continuity(self, a, b):
+        """
+        Returns whether the values of two columns, which are dicts of year to value,
+        continue plausibly between their closest years, or None if that can't be
+        checked.
+        """
+        if not a or not b:
+            return None
+        ya, yb = min(((ya, yb) for ya in a for yb in b), key=lambda p: abs(p[0] - p[1]))
+        va, vb = a[ya], b[yb]
+        if va == 0 and vb == 0:
+            return True
+        if va*vb <= 0:
+            return False
+        return max(abs(va), abs(vb))/min(abs(va), abs(vb)) <= self.max_jump
+
+class AliasStore():
+    """
+    Persistent map of line item keys to their consolidated column names, shared
+    across all companies.
+
+    Keys are indexed by normalize_key, per statement, so spelling variants are
+    found with a single lookup. Mappings are learned from consolidations, and
+    applied to the keys of later consolidations before they are matched, so
+    renames which were resolved once don't need to be resolved again.
+
+    The first mapping learned for a key is kept. A later consolidation mapping
+    the key to another column is reported as a conflict in self.conflicts, and
+    the store is left unchanged, so that one bad merge can't rename the key for
+    every company.
+
+    Parameters:
+        store_path (str): JSON file holding the aliases.
+    """
+    def __init__(self, store_path="data\\aliases.json", verbose=False):
+        self.store_path = store_path
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.aliases = {}
+        self.learned = {}
+        self.conflicts = {}
+        if os.path.exists(self.store_path):
+            with open(self.store_path, "r", encoding="utf-8") as f:
+                self.aliases = json.load(f)
+        return
+
+    def canonical(self, statement, key):
+        """
+        Returns the column name learned for key, or None if key is unknown.
+        """
+        return self.aliases.get(statement, {}).get(normalize_key(key))
+
+    def canonicalize(self, statement, data):
+        """
+        Returns a copy of data, a list of dicts, with every known key renamed to its
+        column name. A key is kept as is if its column is already used in the
+        same dict.
+        """
+        index = self.aliases.get(statement, {})
+        result = []
+        renamed = 0
+        for d in data:
+            canonical = {}
+            for k, v in d.items():
+                name = index.get(normalize_key(k), k) if k != 'year' else k
+                if name in canonical or (name != k and name in d):
+                    name = k
+                renamed += name != k
+                canonical[name] = v
+            result.append(canonical)
+        if self.verbose:
+            print(f"Renamed {renamed} {statement} keys with known aliases.")
+        return result
+
+    def learn(self, statement, mapping):
+        """
+        Records the renames of mapping, a dict of key to column name, for
+        statement. Keys mapped to themselves are not recorded, and keys which
+        already map to another column are reported as conflicts.
+        """
+        with self.lock:
+            index = self.aliases.setdefault(statement, {})
+            for key, column in mapping.items():
+                k = normalize_key(key)
+                if k == normalize_key(column):
+                    continue
+                if self.add(statement, index, k, column):
+                    self.learned.setdefault(statement, {})[k] = column
+        return
+
+    def add(self, statement, index, key, column):
+        """
+        Maps key to column in index, unless key already maps to another column.
+        Entries mapping a key to itself, written by older versions, don't count.
+        Returns True if the mapping was added.
+        """
+        known = index.get(key)
+        if known == column:
+            return False
+        if known is not None and normalize_key(known) != key:
+            if column not in self.conflicts.setdefault(statement, {}).setdefault(key, [known]):
+                self.conflicts[statement][key].append(column)
+                print(f"Alias conflict for {statement} key {key}: keeping {known}, not {column}.")
+            return False
+        index[key] = column
+        return True
+
+    def save(self):
+        """
+        Writes the aliases to disk, if any were learned, merged with the aliases
+        learned by other processes since they were read.
+        """
+        with self.lock:
+            if not self.learned:
+                return
+            Path(self.store_path).parent.mkdir(parents=True, exist_ok=True)
+            with FileLock(f"{self.store_path}.lock"):
+                if os.path.exists(self.store_path):
+                    with open(self.store_path, "r", encoding="utf-8") as f:
+                        self.aliases = json.load(f)
+                # Mappings saved by other processes since were learned first
+                for statement, learned in self.learned.items():
+                    index = self.aliases.setdefault(statement, {})
+                    for key, column in learned.items():
+                        self.add(statement, index, key, column)
+                tmp_path = f"{self.store_path}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(self.aliases, f, indent=1, sort_keys=True)
+                os.replace(tmp_path, self.store_path)
+            self.learned = {}
+        return
+
+class StatementStore():
+    """
+    Parquet dataset of the consolidated statements of all companies, partitioned
+    by company and statement, at <root>/company=<id>/statement=<name>/.
+
+    Rows are in long format (year, item, value), so that companies with
+    different line items share one schema. Writing a company's statement only
+    replaces its own partition. Queries filter on company and statement by
+    partition, and on year and item inside the Parquet files.
+
+    Parameters:
+        root (str): Directory of the dataset.
+    """
+    schema = pa.schema([
+        ('year', pa.int64()),
+        ('item', pa.string()),
+        ('value', pa.float64())
+    ])
+    partitioning = ds.partitioning(pa.schema([
+        ('company', pa.string()),
+        ('statement', pa.string())
+    ]), flavor="hive")
+
+    def __init__(self, root="data\\store", verbose=False):
+        self.root = root
+        self.verbose = verbose
+        return
+
+    def write(self, company, statement, df):
+        """
+        Replaces the partition of company and statement with df, a consolidated
+        DataFrame indexed by year with one column per line item.
+        """
+        long = df.reset_index().melt(id_vars='year', var_name='item', value_name='value')
+        long['value'] = pd.to_numeric(long['value'], errors='coerce')
+        long = long.dropna(subset=['value'])
+        long['year'] = long['year'].astype('int64')
+        long['item'] = long['item'].astype(str)
+        table = pa.Table.from_pandas(long[['year', 'item', 'value']], schema=self.schema, preserve_index=False)
+
+        partition = Path(self.root) / f"company={company}" / f"statement={statement}"
+        partition.mkdir(parents=True, exist_ok=True)
+        # Files starting with "." are ignored by dataset discovery
+        tmp_path = partition / ".part-0.parquet.tmp"
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, partition / "part-0.parquet")
+        if self.verbose:
+            print(f"Stored {table.num_rows} {statement} values for {company}.")
+        return
+
+    def query(self, statements=None, companies=None, items=None, years=None):
+        """
+        Returns the stored values as a long DataFrame with the columns company,
+        statement, year, item and value. Each argument is an optional list to
+        filter on; years may also be a (first, last) tuple.
+        """
+        if not os.path.exists(self.root):
+            return pd.DataFrame(columns=['company', 'statement', 'year', 'item', 'value'])
+        dataset = ds.dataset(self.root, format="parquet", partitioning=self.partitioning)
+
+        filters = []
+        if statements is not None:
+            filters.append(ds.field('statement').isin(list(statements)))
+        if companies is not None:
+            filters.append(ds.field('company').isin(list(companies)))
+        if items is not None:
+            filters.append(ds.field('item').isin(list(items)))
+        if isinstance(years, tuple):
+            filters.append((ds.field('year') >= years[0]) & (ds.field('year') <= years[1]))
+        elif years is not None:
+            filters.append(ds.field('year').isin(list(years)))
+        expression = None
+        for f in filters:
+            expression = f if expression is None else expression & f
+
+        table = dataset.to_table(columns=['company', 'statement', 'year', 'item', 'value'], filter=expression)
+        return table.to_pandas()
+
+    def statement(self, statement, companies=None, years=None):
+        """
+        Returns one statement of all (or the given) companies, indexed by company
+        and year, with one column per line item.
+        """
+        df = self.query(statements=[statement], companies=companies, years=years)
+        return df.pivot_table(index=['company', 'year'], columns='item', values='value', aggfunc='first')
+
+    def line_item(self, item, statement=None, companies=None, years=None):
+        """
+        Returns one line item across years, indexed by year, with one column per
+        company.
+        """
+        df = self.query(statements=[statement] if statement else None, companies=companies, items=[item], years=years)
+        return df.pivot_table(index='year', columns='company', values='value', aggfunc='first')
+
+class CrawlCache():
+    """
+    Remembers the pages of a company's last crawl: each page's depth, ETag,
+    Last-Modified and SHA-256 of its HTML, the PDF links found on it, and the
+    pages it links to. Before the next crawl, each page is revalidated with a
+    conditional GET, so that only pages which changed are rendered again. A page
+    without validators, such as one which failed to render, is always rendered
+    again.
+
+    Also records a fingerprint of the PDF links last classified into pdfs.csv,
+    so that links are only classified again when they changed.
+
+    Parameters:
+        cache_path (str): JSON file holding the cache, e.g. data\\<id>\\crawl_cache.json.
+        workers (int): Number of concurrent revalidation requests.
+        timeout (float): Connect and read timeout in seconds.
+    """
+    def __init__(self, cache_path, workers=8, timeout=30, verbose=False):
+        self.cache_path = cache_path
+        self.workers = workers
+        self.timeout = timeout
+        self.verbose = verbose
+        self.cache = {'crawl': None, 'pages': {}, 'changes': None, 'classified': None}
+        if os.path.exists(self.cache_path):
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                self.cache.update(json.load(f))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        return
+
+    @property
+    def pages(self):
+        return self.cache['pages']
+
+    def matches(self, crawl):
+        """
+        Returns True if the cached pages were crawled with the same settings.
+        """
+        return bool(self.pages) and self.cache['crawl'] == crawl
+
+    def reset(self, crawl):
+        self.cache['crawl'] = crawl
+        self.cache['pages'] = {}
+
+    def validators(self, url):
+        """
+        Requests url, conditionally on the cached page's validators if it has any.
+        Returns the page's status, "unchanged", "changed" or "gone", and its new
+        validators.
+        """
+        entry = self.pages.get(url, {})
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        try:
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            # Rendering the page again will show whether it is really unreachable
+            if self.verbose:
+                print(f"Could not revalidate {url}: {e}")
+            return "changed", {}
+        if response.status_code == 304:
+            return "unchanged", {k: entry.get(k) for k in ('etag', 'last_modified', 'sha256')}
+        if response.status_code in (404, 410):
+            return "gone", {}
+        validators = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'sha256': hashlib.sha256(response.content).hexdigest() if response.ok else None
+        }
+        if validators['sha256'] is not None and validators['sha256'] == entry.get('sha256'):
+            return "unchanged", validators
+        return "changed", validators
+
+    def revalidate(self, urls):
+        """
+        Revalidates urls concurrently. Returns a dict of url to (status, validators).
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return dict(zip(urls, executor.map(self.validators, urls)))
+
+    def record(self, url, depth, pdfs, children, validators=None):
+        """
+        Records a rendered page with the PDF links and pages linked from it.
+        """
+        self.pages[url] = {
+            'depth': depth,
+            'etag': None,
+            'last_modified': None,
+            'sha256': None,
+            'pdfs': [{c: l.get(c, "") for c in LINK_COLUMNS} for l in pdfs],
+            'children': sorted(set(children))
+        }
+        if validators:
+            self.pages[url].update(validators)
+
+    def invalidate(self, url):
+        """
+        Drops the validators of a cached page, so that it is rendered again on
+        the next crawl, while keeping its links.
+        """
+        self.pages[url].update(etag=None, last_modified=None, sha256=None)
+
+    def prune(self, root_url):
+        """
+        Drops pages no longer linked from root_url, and returns their urls.
+        """
+        reachable = set()
+        frontier = [root_url]
+        while frontier:
+            url = frontier.pop()
+            if url in reachable or url not in self.pages:
+                continue
+            reachable.add(url)
+            frontier.extend(self.pages[url]['children'])
+        removed = [url for url in self.pages if url not in reachable]
+        for url in removed:
+            del self.pages[url]
+        return removed
+
+    def pdf_links(self, max_pdfs=None):
+        """
+        Returns the PDF links of all cached pages, shallowest pages first,
+        deduplicated on their normalized URL.
+        """
+        pdfs = []
+        seen = set()
+        for url in sorted(self.pages, key=lambda u: (self.pages[u]['depth'], u)):
+            for l in self.pages[url]['pdfs']:
+                if max_pdfs and len(pdfs) >= max_pdfs:
+                    return pdfs
+                if normalize_url(l['href']) not in seen:
+                    seen.add(normalize_url(l['href']))
+                    pdfs.append(l)
+        return pdfs
+
+    def record_changes(self, changed, added, removed, unchanged):
+        self.cache['changes'] = {
+            'time': time.time(),
+            'changed': sorted(changed),
+            'added': sorted(added),
+            'removed': sorted(removed),
+            'unchanged': unchanged
+        }
+        return self.cache['changes']
+
+    def links_fingerprint(self, links, special_instructions):
+        """
+        Returns the SHA-256 of the candidate PDF links and the instructions they
+        are classified with, ignoring their order and duplicates.
+        """
+        records = sorted({json.dumps([normalize_url(l['href'])] + [str(l.get(k, "")) for k in ('text', 'title')])
+                          for l in links if isinstance(l.get('href'), str)})
+        return hashlib.sha256(json.dumps([special_instructions, records]).encode()).hexdigest()
+
+    def is_classified(self, fingerprint):
+        return self.cache['classified'] == fingerprint
+
+    def record_classification(self, fingerprint):
+        self.cache['classified'] = fingerprint
+
+    def save(self):
+        tmp_path = f"{self.cache_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.cache, f, indent=1)
+        os.replace(tmp_path, self.cache_path)
 
 class PDFScraper():
-    def __init__(self, verbose):
+    def __init__(self, verbose, cache=None, scheduler=None, tracer=None, client=None):
         self.verbose = verbose
-        self.client = OpenAI(api_key=openai_key)
+        # Retries are left to the scheduler
+        self.client = client if client else OpenAI(api_key=openai_key, max_retries=0)
+        self.cache = cache if cache else ResponseCache(enabled=False)
+        self.scheduler = scheduler if scheduler else RequestScheduler(verbose=verbose)
+        self.tracer = tracer if tracer else Tracer()
         return
     
-    async def get_pdf_links_from_url(self, root_url, deep=False, url_depth=1):
-        """
-        Crawls a root_url for all pdf links.
-        With deep=True, crawling occurs on found links, with a depth of url_depth.
-        """
-        browser_config = BrowserConfig(
+    def browser_config(self):
+        return BrowserConfig(
             browser_type='chromium',
             headless=True,
             verbose=self.verbose
             )
 
+    async def get_pdf_links_from_urls(self, crawls, concurrency=4, on_result=None):
+        """
+        Crawls several root URLs concurrently with one shared browser.
+
+        Parameters:
+            crawls (dict): Maps a key, such as a company id, to the keyword arguments
+                of get_pdf_links_from_url (root_url, deep, url_depth).
+            concurrency (int): Maximum number of crawls running at once.
+            on_result (callable): Optional, called with the key and result of each
+                crawl as soon as it completes. It must not block.
+
+        Returns a dict of key to the DataFrame of PDF links, or to the exception
+        raised while crawling.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        # Pages rendered again by revalidated crawls share the same limit
+        renders = asyncio.Semaphore(concurrency)
+        async with AsyncWebCrawler(config=self.browser_config()) as crawler:
+            async def crawl(key, kwargs):
+                async with semaphore:
+                    try:
+                        result = await self.get_pdf_links_from_url(crawler=crawler, renders=renders, **kwargs)
+                    except Exception as e:
+                        result = e
+                if on_result is not None:
+                    on_result(key, result)
+                return key, result
+
+            results = await asyncio.gather(*(crawl(key, kwargs) for key, kwargs in crawls.items()))
+        return dict(results)
+
+    async def get_pdf_links_from_url(self, root_url, deep=False, url_depth=1, crawler=None,
+                                     max_pages=None, max_pdfs=None, output_path=None, cache_path=None,
+                                     recrawl=False, concurrency=4, renders=None):
+        """
+        Crawls a root_url for all pdf links.
+        With deep=True, crawling occurs on found links, with a depth of url_depth.
+        An open crawler can be passed in to reuse its browser.
+
+        Deep crawl results are processed as they stream in, so crawled pages are
+        not held in memory. PDF links are deduplicated on their normalized URL, and
+        the crawl stops early once max_pages pages or max_pdfs PDF links are found.
+        With an output_path, links are written to that CSV as they are found, and
+        the CSV replaces any previous one when the crawl completes.
+
+        With a cache_path, the crawled pages are kept in a CrawlCache, and the next
+        crawl with the same settings only renders the pages which changed since,
+        and the new pages they link to. With recrawl=True, every page is rendered.
+        At most concurrency of those pages are rendered at once, or as many as the
+        renders semaphore allows when it is shared by several crawls.
+        """
+        if crawler is None:
+            async with AsyncWebCrawler(config=self.browser_config()) as crawler:
+                return await self.get_pdf_links_from_url(root_url, deep, url_depth, crawler,
+                                                         max_pages, max_pdfs, output_path, cache_path, recrawl,
+                                                         concurrency, renders)
+
+        cache = CrawlCache(cache_path, verbose=self.verbose) if cache_path else None
+        settings = {'root_url': root_url, 'deep': deep, 'url_depth': url_depth, 'max_pages': max_pages, 'max_pdfs': max_pdfs}
+        if cache and not recrawl and cache.matches(settings):
+            return await self.revalidate_pdf_links(crawler, cache, root_url, deep, url_depth, max_pages, max_pdfs, output_path,
+                                                   renders if renders else asyncio.Semaphore(concurrency))
+
         deep_crawl_strategy = None
         if deep:
             scorer = KeywordRelevanceScorer(
@@ -35,38 +2561,270 @@ class PDFScraper():
             deep_crawl_strategy = BestFirstCrawlingStrategy(
                 max_depth=url_depth,
                 url_scorer=scorer,
-                include_external=False
+                include_external=False,
+                max_pages=max_pages if max_pages else float('inf')
                 )
 
-        crawl_config = CrawlerRunConfig(deep_crawl_strategy=deep_crawl_strategy)
-        async with AsyncWebCrawler(config=browser_config) as crawler:
-            result = await crawler.arun(
-                url=root_url,
-                config=crawl_config,
-            )
+        crawl_config = CrawlerRunConfig(deep_crawl_strategy=deep_crawl_strategy, stream=deep)
+        pdfs = []
+        seen = set()
+        previous = set(cache.pages) if cache else set()
+        if cache:
+            cache.reset(settings)
+        part_path = f"{output_path}.part"
+        with self.tracer.span("crawl", url=root_url, deep=deep) as span, \
+                open(part_path, "w", newline="", encoding="utf-8") if output_path else contextlib.nullcontext() as f:
+            writer = csv.writer(f) if output_path else None
+            if writer:
+                writer.writerow([""] + LINK_COLUMNS)
 
-        if type(result) is list:
-            pdfs = []
-            for r in result:
-                for l in r.links.get("internal", []):
-                    if '.pdf' in l['href']:
-                        pdfs.append(l)
-                for l in r.links.get("external", []):
-                    if '.pdf' in l['href']:
-                        pdfs.append(l)
-        else:
-            pdfs = []
-            for l in result.links.get("internal", []):
-                if '.pdf' in l['href']:
-                    pdfs.append(l)
-            for l in result.links.get("external", []):
-                if '.pdf' in l['href']:
+            unvalidated = []
+            def collect(result):
+                page_pdfs, children = page_links(result)
+                if cache:
+                    url = normalize_url(getattr(result, 'url', None) or root_url)
+                    depth = (getattr(result, 'metadata', None) or {}).get('depth', 0)
+                    # A page which failed to render is kept without validators, to be rendered again
+                    success = getattr(result, 'success', True)
+                    validators = response_validators(result) if success else None
+                    cache.record(url, depth, page_pdfs, children if deep and depth < url_depth else [], validators)
+                    if validators is None and success:
+                        unvalidated.append(url)
+                for l in page_pdfs:
+                    if max_pdfs and len(pdfs) >= max_pdfs:
+                        break
+                    url = normalize_url(l['href'])
+                    if url in seen:
+                        continue
+                    seen.add(url)
+                    if writer:
+                        writer.writerow([len(pdfs)] + [l.get(c, "") for c in LINK_COLUMNS])
                     pdfs.append(l)
+                if writer:
+                    f.flush()
+
+            pages = 1
+            if deep:
+                pages = 0
+                async for result in await crawler.arun(url=root_url, config=crawl_config):
+                    collect(result)
+                    pages += 1
+                    if (max_pages and pages >= max_pages) or (max_pdfs and len(pdfs) >= max_pdfs):
+                        if self.verbose:
+                            print(f"Crawl budget reached after {pages} pages and {len(pdfs)} PDF links.")
+                        break
+            else:
+                collect(await crawler.arun(url=root_url, config=crawl_config))
+            span['pages'] = pages
+            span['pdfs'] = len(pdfs)
+
+            if cache:
+                # Pages served without an ETag or Last-Modified are requested once
+                # more, for the hash of their HTML
+                for url, (status, validators) in (await asyncio.to_thread(cache.revalidate, unvalidated)).items():
+                    cache.pages[url].update(validators)
+                changes = cache.record_changes(changed=previous & set(cache.pages),
+                                               added=set(cache.pages) - previous,
+                                               removed=previous - set(cache.pages),
+                                               unchanged=0)
+                span['pages_added'] = len(changes['added'])
+                span['pages_removed'] = len(changes['removed'])
+
+        # Only replace the previous links once the crawl succeeded
+        if output_path:
+            os.replace(part_path, output_path)
+        if cache:
+            cache.save()
+        if self.verbose:
+            print(pdfs)
+        return pd.DataFrame(pdfs)
+
+    async def revalidate_pdf_links(self, crawler, cache, root_url, deep, url_depth, max_pages, max_pdfs, output_path,
+                                   renders):
+        """
+        Updates the PDF links of a cached crawl. Every cached page is revalidated
+        with a conditional request, and only the pages which changed are rendered
+        again, along with the new pages they link to, as many at once as the
+        renders semaphore allows. Pages which are gone, or no longer linked to,
+        are dropped. A changed page which fails to render keeps its previous
+        links until the next crawl renders it again.
+        """
+        async def render(url):
+            async with renders:
+                return await crawler.arun(url=url, config=CrawlerRunConfig())
+
+        root = normalize_url(root_url)
+        with self.tracer.span("crawl", url=root_url, deep=deep, cached=True) as span:
+            statuses = await asyncio.to_thread(cache.revalidate, list(cache.pages))
+            unchanged = [url for url, (status, _) in statuses.items() if status == "unchanged"]
+            gone = [url for url, (status, _) in statuses.items() if status == "gone" and url != root]
+            for url in unchanged:
+                cache.pages[url].update(statuses[url][1])
+            for url in gone:
+                del cache.pages[url]
+
+            frontier = [(url, cache.pages[url]['depth']) for url in cache.pages if url not in unchanged]
+            changed = [url for url, _ in frontier]
+            added = []
+            failed = []
+            unvalidated = []
+            rendered = 0
+            while frontier:
+                results = await asyncio.gather(*(render(url) for url, _ in frontier))
+                rendered += len(frontier)
+                next_frontier = {}
+                for (url, depth), result in zip(frontier, results):
+                    if not getattr(result, 'success', True):
+                        failed.append(url)
+                        if url in cache.pages:
+                            cache.invalidate(url)
+                        else:
+                            cache.record(url, depth, [], [])
+                        continue
+                    page_pdfs, children = page_links(result)
+                    follow = deep and depth < url_depth
+                    if url in statuses:
+                        validators = statuses[url][1]
+                    else:
+                        validators = response_validators(result)
+                        if validators is None:
+                            unvalidated.append(url)
+                    cache.record(url, depth, page_pdfs, children if follow else [], validators)
+                    for child in children if follow else []:
+                        if child not in cache.pages and child not in next_frontier:
+                            next_frontier[child] = depth + 1
+                if max_pages:
+                    next_frontier = dict(list(next_frontier.items())[:max(max_pages - len(cache.pages), 0)])
+                frontier = list(next_frontier.items())
+                added.extend(next_frontier)
+
+            # New pages served without an ETag or Last-Modified are requested once
+            # more, for the hash of their HTML
+            if unvalidated:
+                for url, (status, validators) in (await asyncio.to_thread(cache.revalidate, unvalidated)).items():
+                    cache.pages[url].update(validators)
+
+            removed = gone + cache.prune(root)
+            changes = cache.record_changes(changed=[url for url in changed if url in cache.pages],
+                                           added=[url for url in added if url in cache.pages],
+                                           removed=removed,
+                                           unchanged=len(unchanged))
+            pdfs = cache.pdf_links(max_pdfs)
+            span['pages'] = rendered
+            span['pages_failed'] = len(failed)
+            span['pages_unchanged'] = len(unchanged)
+            span['pages_added'] = len(changes['added'])
+            span['pages_removed'] = len(removed)
+            span['pdfs'] = len(pdfs)
+
+        if self.verbose:
+            print(f"Revalidated {len(statuses)} cached pages of {root_url}: {len(unchanged)} unchanged, "
+                  f"{len(changes['changed'])} changed, {len(changes['added'])} added and {len(removed)} removed.")
+            if failed:
+                print(f"Kept the previous links of {len(failed)} pages which failed to render: {failed}")
+        if output_path:
+            write_csv(pd.DataFrame(pdfs, columns=LINK_COLUMNS), output_path)
+        cache.save()
         if self.verbose:
             print(pdfs)
         return pd.DataFrame(pdfs)
 
-    def find_annual_reports_from_pdf_links(self, links, special_instructions):
+    def shortlist_pdf_links(self, links, max_links=400):
+        """
+        Deduplicates links on their normalized URL, trims each to the fields the
+        model needs, and ranks them with local heuristics on year tokens and
+        filename keywords. Returns at most max_links links, with their scores and
+        the years found in them, grouped by year so that candidates for the same
+        year stay together.
+        """
+        candidates = {}
+        for l in links:
+            if not isinstance(l.get('href'), str):
+                continue
+            url = normalize_url(l['href'])
+            record = {k: l[k] for k in ('href', 'text', 'title') if isinstance(l.get(k), str) and l[k].strip()}
+            text = " ".join(record.values()).lower()
+            years = sorted({int(y) for y in YEAR_PATTERN.findall(text) if MIN_REPORT_YEAR <= int(y) <= datetime.date.today().year})
+            score = 3*bool(years)
+            score += sum(2 for k in ANNUAL_REPORT_KEYWORDS if k in text)
+            score -= sum(2 for k in OTHER_REPORT_KEYWORDS if k in text)
+            if url not in candidates or score > candidates[url][0]:
+                candidates[url] = (score, years, record)
+
+        ranked = sorted(candidates.values(), key=lambda c: c[0], reverse=True)[:max_links]
+        ranked.sort(key=lambda c: (-(c[1][-1] if c[1] else 0), -c[0]))
+        if self.verbose:
+            print(f"Shortlisted {len(ranked)} of {len(links)} PDF links.")
+        return ranked
+
+    def find_annual_reports_from_pdf_links(self, links, special_instructions, max_links=400, chunk_tokens=8000):
+        """
+        Uses OpenAI to pick the annual report for each year from a list of PDF links.
+
+        Links are first shortlisted locally, then sent to the model in chunks of
+        roughly chunk_tokens tokens. Chunks are only cut between years, so that all
+        candidates for a year are in the same chunk. If a year is still picked in
+        more than one chunk, the link with the best local score is kept.
+        """
+        shortlist = self.shortlist_pdf_links(links, max_links)
+        scores = {normalize_url(record['href']): score for score, _, record in shortlist}
+        if not shortlist:
+            if self.verbose:
+                print("No candidate PDF links to classify.")
+            return pd.DataFrame(columns=['year', 'filename', 'url']).set_index('year')
+
+        # Group the shortlist by the latest year in each link, as it is sorted
+        groups = [[record for _, _, record in group]
+                  for _, group in itertools.groupby(shortlist, key=lambda c: c[1][-1] if c[1] else 0)]
+
+        # Split the groups into chunks of about chunk_tokens, at ~4 characters per token
+        chunks = [[]]
+        chunk_size = 0
+        for group in groups:
+            group_tokens = sum(len(json.dumps(record))/4 for record in group)
+            if chunks[-1] and chunk_size + group_tokens > chunk_tokens:
+                chunks.append([])
+                chunk_size = 0
+            chunks[-1].extend(group)
+            chunk_size += group_tokens
+
+        results = []
+        with self.tracer.span("link_classification", links=len(links), shortlisted=len(shortlist), chunks=len(chunks)):
+            for n, chunk in enumerate(chunks):
+                if self.verbose:
+                    print(f"Querying ChatGPT to find annual reports from PDF links ({n + 1}/{len(chunks)})...")
+                results.extend(self.find_annual_reports_in_chunk(chunk, special_instructions, fill_gaps=len(chunks) == 1))
+
+        # Keep the best scoring link for each year
+        annual_reports = pd.DataFrame(results, columns=['year', 'filename', 'url'])
+        annual_reports['score'] = [scores.get(normalize_url(url), 0) for url in annual_reports['url']]
+        annual_reports = (annual_reports.sort_values('score', ascending=False, kind='stable')
+                          .drop_duplicates('year')
+                          .drop(columns='score')
+                          .sort_values('year', ascending=False)
+                          .set_index('year'))
+        if self.verbose:
+            print(annual_reports)
+            suspicious_years = []
+            for year in range(MIN_REPORT_YEAR, datetime.date.today().year + 1):
+                if (str(year) in json.dumps(links)) and (not year in annual_reports.index.values):
+                    suspicious_years.append(year)
+            if len(suspicious_years) > 0:
+                print(f"Warning: years found in links without annual reports: {suspicious_years}")
+
+        return annual_reports
+
+    def find_annual_reports_in_chunk(self, links, special_instructions, fill_gaps=True):
+        """
+        Queries OpenAI for the annual reports among one chunk of links.
+        With fill_gaps, the model is asked to fill in years missing between the
+        newest and oldest year, which only makes sense if the chunk holds all the
+        candidates. Returns a list of dicts with year, filename and url.
+        """
+        gap_instruction = """
+        If there are missing years between the newest and oldest year, there's a high
+        likelihood that data isn't missing. Try to ensure those gaps are filled.
+""" if fill_gaps else ""
         system_prompt = f"""
         You are a utility which picks out the relevant annual reports from a list of URLs.
         """
@@ -80,12 +2838,9 @@ class PDFScraper():
         uploaded after the year its for.
 
         Sort the output by year descending.
-    
-        If there are missing years between the newest and oldest year, there's a high
-        likelihood that data isn't missing. Try to ensure those gaps are filled.
-
+    {gap_instruction}
         Special instructions: {special_instructions}
-        Dataset: {links}
+        Dataset: {json.dumps(links)}
         """
 
         schema = {
@@ -118,210 +2873,255 @@ class PDFScraper():
             "additionalProperties": False
         }
 
-        if self.verbose:
-            print("Querying ChatGPT to find annual reports from PDF links...")
-        response = self.client.responses.create(
-            model="o3-mini",
-            input=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": prompt}
-            ],
-            text={
-                "format": {
-                    "type": "json_schema",
-                    "name": "annual_report",
-                    "schema": schema,
-                    "strict": True
-                }
+        text_format = {
+            "format": {
+                "type": "json_schema",
+                "name": "annual_report",
+                "schema": schema,
+                "strict": True
             }
+        }
+        output_text = self.cache.get_or_create(
+            self.cache.key("o3-mini", [system_prompt, prompt], text=text_format),
+            lambda: create_response(
+                self.client, self.scheduler, self.tracer,
+                model="o3-mini",
+                input=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": prompt}
+                ],
+                text=text_format
+            )
         )
-        annual_reports = pd.DataFrame(json.loads(response.output_text)['annual_reports']).set_index('year')
-        if self.verbose:
-            print(annual_reports)
-            suspicious_years = []
-            for year in range(1980, 2025):
-                if (str(year) in json.dumps(links)) and (not year in annual_reports.index.values):
-                    suspicious_years.append(year)
-            if len(suspicious_years) > 0:
-                print(f"Warning: years found in links without annual reports: {suspicious_years}")
-
-        return annual_reports
+        return json.loads(output_text)['annual_reports']
     
 class DataParser():
-    def __init__(self, verbose):
+    def __init__(self, verbose, cache=None, uploads=None, aliases=None, scheduler=None, priority=PRIORITY_BACKFILL,
+                 tracer=None, profiler=None, client=None):
         self.verbose = verbose
-        self.client = OpenAI(api_key=openai_key)
+        # Retries are left to the scheduler
+        self.client = client if client else OpenAI(api_key=openai_key, max_retries=0)
+        self.cache = cache if cache else ResponseCache(enabled=False)
+        self.scheduler = scheduler if scheduler else RequestScheduler(verbose=verbose)
+        self.priority = priority
+        self.tracer = tracer if tracer else Tracer()
+        self.profiler = profiler if profiler else Profiler()
+        self.uploads = uploads if uploads else UploadRegistry(self.client, verbose=verbose, scheduler=self.scheduler, tracer=self.tracer)
+        self.aliases = aliases
+        self.locator = StatementLocator()
         return
     
-    def parse_report_for_year(self, report_path, report_name, year, special_instructions=""):
+    def parse_report_for_year(self, report_path, report_name, year, special_instructions="", page_locator="scored",
+                              pdf_backend="pypdf2"):
+        """
+        Parses the balance sheet, income statement and cash flow statement of an
+        annual report into <report_path>\\output.json.
+
+        Reports too large for a single request are split into one reduced PDF per
+        statement. page_locator chooses how the statement pages are picked:
+        "scored" uses StatementLocator, "keyword" a plain search for the statement
+        name. pdf_backend chooses the PDF_BACKENDS entry reading the PDF.
+
+        Returns the list of statements which could not be extracted. Their
+        output is left empty, and the year should be parsed again.
+        """
+        with self.profiler.profile():
+            requests = self.plan_report(report_path, report_name, year, special_instructions, page_locator, pdf_backend)
+
+        # Parse a split PDF
+        if 'report' not in requests:
+            # The statements are independent, so upload and extract them concurrently
+            with ThreadPoolExecutor(max_workers=len(requests)) as executor:
+                futures = {
+                    key: executor.submit(self.timed_parse_reduced_file, r['file'], r['find_str'], year, special_instructions, r['expected_columns'], r['text'])
+                    for key, r in requests.items()
+                }
+
+            final_dict = {'year': year}
+            for key, future in futures.items():
+                final_dict[key] = future.result()
+            final_dict['input_modes'] = {key: "file" if r['text'] is None else "text" for key, r in requests.items()}
+
+        # Parse a small PDF
+        else:
+            r = requests['report']
+            output_text = self.request_extraction(r['instruction'], file=r['file'], text=r['text'], text_format=r['format'],
+                                                  validate=lambda t: json_object(t) is not None)
+            output = json_object(output_text)
+            if output is None:
+                # Every statement is extracted again on its own
+                print(f"Invalid response for {year}: not a JSON object. Extracting each statement again.")
+                output = {}
+            if self.verbose:
+                print(f"Result:")
+                print(output)
+
+            final_dict = {'year':year}
+            for key in STATEMENTS:
+                problems = validate_statement(output.get(key))
+                if not problems:
+                    final_dict[key] = flatten_statement(output[key])
+                    continue
+                # Only the failing statement is extracted again
+                find_str = key.replace("_", " ")
+                print(f"Invalid {find_str} for {year}: {'; '.join(problems)}. Extracting it again.")
+                final_dict[key] = self.parse_reduced_file(r['file'], find_str, year, special_instructions, STATEMENT_EXPECTED[key], r['text'])
+            mode = "file" if r['text'] is None else "text"
+            final_dict['input_modes'] = {key: mode for key in STATEMENTS}
+
+        if self.verbose:
+            print(f"Saving result...")
+        # Written to a temporary file first, so output.json is never left half written
+        tmp_path = f"{report_path}\\output.json.tmp"
+        with open(tmp_path, 'w') as f:
+                json.dump(final_dict, f)
+        os.replace(tmp_path, f"{report_path}\\output.json")
+        return [key for key in STATEMENTS if not final_dict[key]]
+
+    def plan_report(self, report_path, report_name, year, special_instructions="", page_locator="scored",
+                    pdf_backend="pypdf2"):
+        """
+        Prepares the extraction requests of an annual report, without sending them.
+
+        Returns a dict of statement to its request, or a single request under
+        'report' if the report is small enough to be parsed at once. Each request
+        is a dict with the instruction, its text format, and the file and text
+        (None if unusable) to send with it. Requests for statements also hold the find_str and
+        expected_columns they were built from.
+        """
         pdf_path = f"{report_path}\\{report_name}"
-        filesize = os.path.getsize(pdf_path)/1024**2
-        final_dict = None
         if self.verbose:
             print(f"Processing {pdf_path} for {year}")
 
-        expected_balance_sheet = [
-            "total_assets", "current_assets", "non_current_assets",
-            "total_liabilities", "current_liabilities", "non_current_liabilities",
-            "total_shareholders_equity", "share_capital", "retained_earnings"
-            ]
-        expected_income_statement = [
-            "total_revenue", "total_expenses", "net_gains", "net_losses",
-            "earnings_per_share"
-            ]
-        
-        expected_cash_flow_statement = [
-            "cash_and_cash_equivalents_at_beginning_of_period",
-            "cash_and_cash_equivalents_at_end_of_period",
-            "cash_from_operations", "cash_from_investing", "cash_from_financing",
-            "net_change_in_cash", "free_cash_flow"
-            ]
-
-        with open(pdf_path, "rb") as infile:
-            reader = PyPDF2.PdfReader(infile)
-            num_pages = len(reader.pages)
+        with open_pdf(pdf_path, pdf_backend) as pdf:
+            num_pages = pdf.num_pages()
+            # Only an extraction is recorded, not a reused index, e.g. one built in a process pool
+            page_texts = read_page_index(pdf_path, f"{report_path}\\pages.idx", pdf.name)
+            if page_texts is None:
+                with self.tracer.span("text_extraction", year=year, pages=num_pages, bytes=os.path.getsize(pdf_path), backend=pdf_backend):
+                    page_texts = build_page_index(pdf_path, f"{report_path}\\pages.idx", pdf)
 
             # Split too large PDFs
-            if filesize > 32 or num_pages > 100:
+            if requires_split(pdf_path, num_pages):
                 print(f"File {pdf_path} too large for a single request. Splitting the PDF.")
 
-                balance_sheet_pages = []
-                income_statement_pages = []
-                cash_flow_statement_pages = []
-                    
-                for i in range(num_pages):
-                    page = reader.pages[i]
-                    text = page.extract_text()
-                    if text and 'balance sheet' in text.lower():
-                        for j in range(i, min(i + 3, num_pages)):
-                            if j not in balance_sheet_pages:
-                                balance_sheet_pages.append(j)
-                    if text and 'income statement' in text.lower():
-                        for j in range(i, min(i + 3, num_pages)):
-                            if j not in income_statement_pages:
-                                income_statement_pages.append(j)
-                    if text and 'cash flow statement' in text.lower():
-                        for j in range(i, min(i + 3, num_pages)):
-                            if j not in income_statement_pages:
-                                cash_flow_statement_pages.append(j)
-                    
-                balance_sheet_pdf = f"{report_path}\\_balance_sheet_{report_name}"
-                income_statement_pdf = f"{report_path}\\_income_statement_{report_name}"
-                cash_flow_statement_pdf = f"{report_path}\\_cash_flow_statement_{report_name}"
-                self.save_reduced_pdf(pdf_path, balance_sheet_pdf, balance_sheet_pages)
-                self.save_reduced_pdf(pdf_path, income_statement_pdf, income_statement_pages)
-                self.save_reduced_pdf(pdf_path, cash_flow_statement_pdf, cash_flow_statement_pages)
-
-                balance_sheet_dict = self.parse_reduced_file(balance_sheet_pdf, 'balance sheet', year, special_instructions, expected_balance_sheet)
-                income_statement_dict = self.parse_reduced_file(income_statement_pdf, 'income statement', year, special_instructions, expected_income_statement)
-                cash_flow_statement_dict = self.parse_reduced_file(cash_flow_statement_pdf, 'cash flow statement', year, special_instructions, expected_cash_flow_statement)
-
-                final_dict = {
-                    'year': year,
-                    'balance_sheet': balance_sheet_dict,
-                    'income_statement': income_statement_dict,
-                    'cash_flow_statement': cash_flow_statement_dict
-                }
-                
-            # Parse a small PDF
-            else:
-                if self.verbose:
-                    print(f"Parsing {report_name} for all data.")
-                    print(f"Uploading to openai...")
-                openai_file = self.client.files.create(
-                    file=open(pdf_path, "rb"),
-                    purpose="user_data"
-                )
+                with self.tracer.span("page_selection", year=year, locator=page_locator) as span:
+                    located = self.locator.locate(page_texts) if page_locator == "scored" else {}
+                    if self.verbose and located:
+                        print(f"Located statement pages: {located}")
+                    statement_pages = {key: located.get(key) or self.find_statement_pages(page_texts, key.replace("_", " "))
+                                       for key in STATEMENT_EXPECTED}
+                    span['pages'] = sum(len(pages) for pages in statement_pages.values())
 
-                if self.verbose:
-                    print(f"Data parsing with openai...")
+                with self.tracer.span("reduced_pdfs", year=year) as span:
+                    for key, pages in statement_pages.items():
+                        self.save_reduced_pdf(pdf_path, f"{report_path}\\_{key}_{report_name}", pages, pdf)
+                    span['bytes'] = sum(os.path.getsize(f"{report_path}\\_{key}_{report_name}") for key in statement_pages)
 
-                instruction = f"""
-                    From the given annual report, extract the balance sheet, income statement, and 
-                    cash flow statement data for the current year. The current year is {year}.
+                # Send the extracted text of the statement pages where it is usable,
+                # and the reduced PDF otherwise
+                requests = {}
+                for key, expected_columns in STATEMENT_EXPECTED.items():
+                    find_str = key.replace("_", " ")
+                    pages = statement_pages[key]
+                    file = f"{report_path}\\_{key}_{report_name}"
+                    requests[key] = {
+                        'find_str': find_str,
+                        'expected_columns': expected_columns,
+                        'instruction': self.statement_instruction(find_str, year, special_instructions, expected_columns),
+                        'format': json_schema_format(key, statement_schema(expected_columns)),
+                        'file': file,
+                        'text': self.report_text(page_texts, pages)
+                    }
+                return requests
 
-                    Your response should simply be a JSON dictionary, ready to load into json.loads (no headers).
-                    The top level dict keys must be balance_sheet, income_statement, and
-                    cash_flow_statement. The values for these keys is another dict, where the items
-                    are the relevant data you find. Do not nest another dictionary beyond this
-                    level. Make sure there are no duplicate keys. I would like dict keys in
-                    lowercase_with_underscores.
+        if self.verbose:
+            print(f"Parsing {report_name} for all data.")
+        return {
+            'report': {
+                'instruction': self.report_instruction(year, special_instructions),
+                'format': report_format(),
+                'file': pdf_path,
+                'text': self.report_text(page_texts)
+            }
+        }
 
-                    I am expecting the following keys for the balance sheet: {expected_balance_sheet}
-                    I am expecting the following keys for the income statement: {expected_income_statement}
-                    I am expecting the following keys for the cash flow statement: {expected_cash_flow_statement}
-                    These are the minimum required sets, additional keys are expected. Include all data you can,
-                    while maintaining accuracy in data categorization.
+    def parse_reduced_file(self, file, find_str, year, special_instructions, expected_columns, text=None):
+        """
+        Extracts one statement from the reduced PDF at file. If text is given, the
+        text is sent instead of the PDF.
 
-                    Special instructions: {special_instructions}
-                    """
-                response = self.client.responses.create(
-                    model="o1",
-                    input=[
-                        {
-                            "role": "user",
-                            "content": [
-                                {
-                                    "type": "input_file",
-                                    "file_id": openai_file.id,
-                                },
-                                {
-                                    "type": "input_text",
-                                    "text": instruction,
-                                },
-                            ]
-                        }
-                    ]
-                )
-                output = json.loads(response.output_text)
+        A response which fails validation is requested again, up to
+        STATEMENT_RETRIES times, with the problems added to the instruction.
+        """
+        if self.verbose:
+            print(f"Parsing {file} for {find_str} from {'file' if text is None else 'text'}.")
+        instruction = self.statement_instruction(find_str, year, special_instructions, expected_columns)
+        text_format = json_schema_format(find_str.replace(" ", "_"), statement_schema(expected_columns))
+        for attempt in range(STATEMENT_RETRIES + 1):
+            output_text = self.request_extraction(instruction, file=file, text=text, text_format=text_format,
+                                                  validate=is_valid_statement)
+            output = json_object(output_text)
+            problems = validate_statement(output)
+            if not problems:
+                statement = flatten_statement(output)
                 if self.verbose:
                     print(f"Result:")
-                    print(output)
-    
-                final_dict = {'year':year}
-                final_dict.update(output)
+                    print(statement)
+                return statement
 
-        if final_dict:
-            if self.verbose:
-                print(f"Saving result...")
-            with open(f"{report_path}\\output.json", 'w') as f:
-                    json.dump(final_dict, f)
+            print(f"Invalid {find_str} extracted from {file}: {'; '.join(problems)}")
+            instruction = self.statement_instruction(find_str, year, special_instructions, expected_columns) + f"""
+        A previous answer was rejected because {'; '.join(problems)}. Correct these problems.
+        """
 
-    def parse_reduced_file(self, file, find_str, year, special_instructions, expected_columns):
-        if self.verbose:
-            print(f"Parsing {file} for {find_str}.")
-            print(f"Uploading {find_str} to openai...")
-        openai_file = self.client.files.create(
-            file=open(file, "rb"),
-            purpose="user_data"
-        )
+        print(f"Failed to extract {find_str} from {file} after {STATEMENT_RETRIES + 1} attempts.")
+        return {}
 
-        if self.verbose:
-            print(f"Data parsing with openai...")
-        instruction = f"""
-        From the given annual report, extract the {find_str} data for the current
-        year. The current year is {year}.
+    def request_extraction(self, instruction, file=None, text=None, text_format=None, validate=None):
+        """
+        Sends instruction to the extraction model along with the report, and returns
+        the response text. The report is given as text if text is not None, and as
+        the uploaded PDF at file otherwise. text_format is the optional structured
+        output format of the response. Only responses passing validate are cached.
+        """
+        def create():
+            body = self.extraction_body(instruction, file=file, text=text, text_format=text_format)
+            if self.verbose:
+                print(f"Data parsing with openai...")
+            # PDFs are estimated at about a page of text per 20 KB
+            tokens = estimate_tokens(instruction, text or "")
+            if text is None:
+                tokens += os.path.getsize(file)//20000*500
+            return create_response(self.client, self.scheduler, self.tracer, priority=self.priority, tokens=tokens, **body)
 
-        Your response should simply be a JSON dictionary, ready to load into json.loads (no headers).
-        Dict items are the relevant data you find. Make sure there are no duplicate
-        keys. Do not give a nested dictionary. I would like dict keys in
-        lowercase_with_underscores.
+        return self.cache.get_or_create(self.extraction_key(instruction, file=file, text=text, text_format=text_format), create,
+                                        validate=validate)
 
-        I am expecting the following keys at minimum: {expected_columns}
-        Additional keys are expected. Include all data you can, while maintaining accuracy in data categorization.
+    def extraction_key(self, instruction, file=None, text=None, text_format=None):
+        """
+        Returns the response cache key of an extraction request.
+        """
+        if text is not None:
+            return self.cache.key(EXTRACTION_MODEL, [text, instruction], text=text_format)
+        return self.cache.key(EXTRACTION_MODEL, instruction, files=[file], text=text_format)
 
-        Special instructions: {special_instructions}
+    def extraction_body(self, instruction, file=None, text=None, text_format=None):
         """
-        response = self.client.responses.create(
-            model="o1",
-            input=[
+        Returns the body of a responses request for an extraction, uploading file
+        if the report isn't given as text.
+        """
+        if text is not None:
+            document = {"type": "input_text", "text": text}
+        else:
+            document = {"type": "input_file", "file_id": self.uploads.upload(file)}
+        body = {
+            "model": EXTRACTION_MODEL,
+            "input": [
                 {
                     "role": "user",
                     "content": [
-                        {
-                            "type": "input_file",
-                            "file_id": openai_file.id,
-                        },
+                        document,
                         {
                             "type": "input_text",
                             "text": instruction,
@@ -329,21 +3129,121 @@ class DataParser():
                     ]
                 }
             ]
-        )
-        try:
-            output = json.loads(response.output_text)
-            if self.verbose:
-                print(f"Result:")
-                print(output)
-            return output
-        
-        except Exception as e:
-            print(f"Failed to extract {find_str} from {file}. AI response:")
-            print(f"{response.output_text}")
-            print(e)
-            return {}
+        }
+        if text_format:
+            body['text'] = text_format
+        return body
+
+    def report_text(self, page_texts, pages=None):
+        """
+        Returns a compact text of the given pages (all pages by default) to send
+        to the model instead of the PDF, or None if the extracted text is too
+        sparse to be reliable, e.g. for scanned pages.
+
+        Lines ending in figures are reconstructed as tab separated rows of the
+        line item followed by its values.
+        """
+        if pages is None:
+            pages = range(len(page_texts))
+        blocks = []
+        numbers = 0
+        for i in pages:
+            rows = []
+            for line in page_texts[i].splitlines():
+                tokens = line.split()
+                values = []
+                while tokens and (NUMBER_PATTERN.fullmatch(tokens[-1]) or tokens[-1] in ("-", "–", "—")):
+                    values.insert(0, tokens.pop())
+                if tokens or values:
+                    rows.append("\t".join([" ".join(tokens)] + values))
+                numbers += len(values)
+            blocks.append(f"--- Page {i + 1} ---\n" + "\n".join(rows))
+        text = "\n".join(blocks)
+
+        if len(text) < MIN_TEXT_CHARS_PER_PAGE*len(pages) or numbers < MIN_TEXT_NUMBERS:
+            return None
+        return "Annual report pages:\n" + text
+
+    def report_instruction(self, year, special_instructions):
+        """
+        Returns the instruction for extracting all statements from a full report.
+        """
+        return f"""
+                    From the given annual report, extract the balance sheet, income statement, and 
+                    cash flow statement data for the current year. The current year is {year}.
+
+                    Give the value of each expected key, or null if it isn't reported. Give every
+                    other line item you find in other_items, with keys in lowercase_with_underscores.
+                    Make sure no line item is given twice. Values must be plain numbers.
+
+                    I am expecting the following keys for the balance sheet: {EXPECTED_BALANCE_SHEET}
+                    I am expecting the following keys for the income statement: {EXPECTED_INCOME_STATEMENT}
+                    I am expecting the following keys for the cash flow statement: {EXPECTED_CASH_FLOW_STATEMENT}
+                    These are the minimum required sets, additional keys are expected. Include all data you can,
+                    while maintaining accuracy in data categorization.
+
+                    Special instructions: {special_instructions}
+                    """
+
+    def statement_instruction(self, find_str, year, special_instructions, expected_columns):
+        """
+        Returns the instruction for extracting one statement from a reduced report.
+        """
+        return f"""
+        From the given annual report, extract the {find_str} data for the current
+        year. The current year is {year}.
+
+        Give the value of each expected key, or null if it isn't reported. Give every
+        other line item you find in other_items, with keys in lowercase_with_underscores.
+        Make sure no line item is given twice. Values must be plain numbers.
+
+        I am expecting the following keys at minimum: {expected_columns}
+        Additional keys are expected. Include all data you can, while maintaining accuracy in data categorization.
+
+        Special instructions: {special_instructions}
+        """
+
+    def extraction_fingerprint(self, special_instructions, page_locator="scored", pdf_backend="pypdf2"):
+        """
+        Returns a hash of the model, every instruction used to parse a report, and
+        the page locator and PDF backend choosing the pages and text sent with
+        them, so that outputs can be checked against the current settings.
+        """
+        instructions = [
+            EXTRACTION_MODEL,
+            page_locator,
+            pdf_backend,
+            report_format(),
+            self.report_instruction("<year>", special_instructions),
+            self.statement_instruction('balance sheet', "<year>", special_instructions, EXPECTED_BALANCE_SHEET),
+            self.statement_instruction('income statement', "<year>", special_instructions, EXPECTED_INCOME_STATEMENT),
+            self.statement_instruction('cash flow statement', "<year>", special_instructions, EXPECTED_CASH_FLOW_STATEMENT)
+        ]
+        return hashlib.sha256(json.dumps(instructions).encode()).hexdigest()
+
+    def timed_parse_reduced_file(self, file, find_str, year, special_instructions, expected_columns, text=None):
+        """
+        Runs parse_reduced_file, and reports how long it took in verbose mode.
+        """
+        start = time.perf_counter()
+        output = self.parse_reduced_file(file, find_str, year, special_instructions, expected_columns, text)
+        if self.verbose:
+            print(f"Parsed {find_str} for {year} in {time.perf_counter() - start:.1f}s.")
+        return output
+
+    def find_statement_pages(self, page_texts, find_str):
+        """
+        Returns the sorted page numbers of every page containing find_str, plus
+        the 2 pages following each match.
+        """
+        num_pages = len(page_texts)
+        pages = set()
+        for i, text in enumerate(page_texts):
+            if find_str in text.lower():
+                pages.update(range(i, min(i + 3, num_pages)))
+        return sorted(pages)
 
-    def save_reduced_pdf(self, input_pdf_path, output_pdf_path, page_numbers):
+    def save_reduced_pdf(self, input_pdf_path, output_pdf_path, page_numbers, pdf=None, backend="pypdf2"):
         """
         Create a reduced PDF from the input_pdf_path containing only the pages listed in page_numbers.
         
@@ -351,25 +3251,60 @@ class DataParser():
             input_pdf_path (str): Path to the original PDF.
             output_pdf_path (str): Path where the reduced PDF will be saved.
             page_numbers (list): A list of page numbers (0-indexed) to include in the new PDF.
+            pdf (PDFBackend): Optional PDF already open on input_pdf_path,
+                to avoid reparsing the original PDF for every reduced PDF.
+            backend (str): Name of the backend to open input_pdf_path with, if pdf isn't given.
         """
-        with open(input_pdf_path, "rb") as infile:
-            reader = PyPDF2.PdfReader(infile)
-            writer = PyPDF2.PdfWriter()
-            
-            # Iterate through the list of page numbers
-            for page_num in page_numbers:
-                # Check if the page number is within the range of available pages
-                if page_num < len(reader.pages):
-                    writer.add_page(reader.pages[page_num])
-                else:
-                    print(f"Page {page_num + 1} is out of range. Skipping.")
-            
-            # Save the reduced PDF
-            with open(output_pdf_path, "wb") as outfile:
-                writer.write(outfile)
-            print(f"Reduced PDF saved as: {output_pdf_path}")
+        if pdf is None:
+            with open_pdf(input_pdf_path, backend) as pdf:
+                return self.save_reduced_pdf(input_pdf_path, output_pdf_path, page_numbers, pdf)
+
+        # Iterate through the list of page numbers
+        pages = []
+        for page_num in page_numbers:
+            # Check if the page number is within the range of available pages
+            if page_num < pdf.num_pages():
+                pages.append(page_num)
+            else:
+                print(f"Page {page_num + 1} is out of range. Skipping.")
+        
+        # Save the reduced PDF
+        pdf.write_pages(pages, output_pdf_path)
+        print(f"Reduced PDF saved as: {output_pdf_path}")
     
-    def consolidate_reports(self, data, data_str, special_instructions, model):
+    def consolidate_reports(self, data, data_str, special_instructions, model, engine="local"):
+        """
+        Consolidates a list of one statement's dicts, one per year, into a
+        DataFrame indexed by year.
+
+        With engine="local", keys are first renamed with the alias store, then
+        merged by Consolidator, and only the keys it can't match are sent to the
+        model. The resulting key to column mapping is learned by the alias store. With engine="llm", the model
+        consolidates all of the data.
+        """
+        if engine == "local":
+            statement = data_str.replace(" ", "_")
+            if self.aliases:
+                data = self.aliases.canonicalize(statement, data)
+            consolidator = Consolidator(verbose=self.verbose)
+            with self.tracer.span("key_resolution", statement=statement) as span:
+                result, unresolved, mapping = consolidator.consolidate(data)
+                span['keys'] = len(mapping)
+                span['unresolved_locally'] = len(unresolved)
+                if unresolved and model:
+                    columns = [c for c in result.columns if c not in unresolved]
+                    resolved = self.resolve_keys(unresolved, columns, data_str, special_instructions, model)
+                    result, unresolved, mapping = consolidator.consolidate(data, resolved)
+                span['unresolved'] = len(unresolved)
+            if unresolved:
+                print(f"{len(unresolved)} {data_str} keys reported in a single year were left unmatched: {unresolved}")
+            if self.aliases:
+                self.aliases.learn(statement, mapping)
+            if self.verbose:
+                print(f"{data_str}.")
+                print(result)
+            return result
+
         instruction = f"""
             Consolidate the given data.
 
@@ -396,13 +3331,167 @@ class DataParser():
             """
         if self.verbose:
             print(f"{data_str}.")
-        response = self.client.responses.create(
-            model=model,
-            input=instruction
+        output_text = self.cache.get_or_create(
+            self.cache.key(model, instruction),
+            lambda: create_response(
+                self.client, self.scheduler, self.tracer,
+                priority=self.priority,
+                model=model,
+                input=instruction
+            )
         )
 
-        result = pd.DataFrame(json.loads(response.output_text)).set_index('year')
+        result = pd.DataFrame(json.loads(output_text)).set_index('year')
         if self.verbose:
             print(result)
 
-        return result
\ No newline at end of file
+        return result
+
+    def consolidate_windows(self, data, data_str, special_instructions, model, engine="local",
+                            window=10, overlap=2, workers=1, window_dir=None):
+        """
+        Consolidates a long history in overlapping windows of years, and merges
+        the windows with Consolidator.reconcile, so that the size of every
+        consolidation stays the same however many years there are.
+
+        Windows run on up to workers threads. A window which fails is reported and
+        left out, instead of failing the whole statement. If window_dir is given,
+        each window's result is saved there under a hash of its inputs and reused
+        while they are unchanged.
+
+        Parameters:
+            window (int): Number of years per window.
+            overlap (int): Number of years shared by adjacent windows, used to
+                match their columns.
+        """
+        step = max(window - overlap, 1)
+        windows = []
+        for start in range(0, len(data), step):
+            windows.append(data[start:start + window])
+            if start + window >= len(data):
+                break
+
+        statement = data_str.replace(" ", "_")
+        keys = []
+        for w in windows:
+            inputs = [w, data_str, special_instructions, model, engine]
+            keys.append(hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()[:16])
+        if window_dir:
+            Path(window_dir).mkdir(parents=True, exist_ok=True)
+
+        def consolidate(i):
+            w = windows[i]
+            if not window_dir:
+                return self.consolidate_reports(w, data_str, special_instructions, model, engine)
+            path = f"{window_dir}\\{statement}_{keys[i]}.csv"
+            if os.path.exists(path):
+                if self.verbose:
+                    print(f"Reusing consolidated window {path}.")
+                return pd.read_csv(path, index_col='year')
+            result = self.consolidate_reports(w, data_str, special_instructions, model, engine)
+            tmp_path = f"{path}.tmp"
+            result.to_csv(tmp_path)
+            os.replace(tmp_path, path)
+            return result
+
+        results = [None]*len(windows)
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            futures = {executor.submit(consolidate, i): i for i in range(len(windows))}
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    results[i] = future.result()
+                except Exception as e:
+                    print(f"Error consolidating {data_str} for years {[d['year'] for d in windows[i]]}:")
+                    print(e)
+        results = [r for r in results if r is not None]
+        if not results:
+            raise RuntimeError(f"No window of the {data_str} could be consolidated.")
+
+        if window_dir:
+            # Drop saved windows whose inputs no longer exist. Temporary files may
+            # be another process's windows being written, and are only dropped
+            # once a day old, as left behind by a crashed run.
+            for entry in os.scandir(window_dir):
+                if not entry.name.startswith(f"{statement}_"):
+                    continue
+                name = entry.name[len(statement) + 1:]
+                try:
+                    if name.endswith(".csv") and name[:-4] not in keys:
+                        os.remove(entry.path)
+                    elif name.endswith(".csv.tmp") and time.time() - entry.stat().st_mtime > 86400:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+        consolidator = Consolidator(verbose=self.verbose)
+        merged = results[0]
+        for result in results[1:]:
+            merged = consolidator.reconcile(merged, result)
+        merged.index.name = 'year'
+        return merged
+
+    def resolve_keys(self, keys, columns, data_str, special_instructions, model):
+        """
+        Asks the model which of columns each of keys is another name for.
+        Returns a dict of key to column, for the keys which have a match.
+        """
+        instruction = f"""
+            The following keys of a {data_str} could not be matched to a column:
+            {keys}
+
+            These are the consolidated columns of the {data_str} over other years:
+            {columns}
+
+            For each key, give the column it is another name for, for example
+            "assets" and "total_assets". Only match keys which describe the same
+            figure. If a key has no matching column, give an empty string.
+
+            Special instructions:
+            {special_instructions}
+            """
+        schema = {
+            "type": "object",
+            "properties": {
+                "mappings": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "key": {"type": "string"},
+                            "column": {"type": "string"}
+                        },
+                        "required": ["key", "column"],
+                        "additionalProperties": False
+                    }
+                }
+            },
+            "required": ["mappings"],
+            "additionalProperties": False
+        }
+        text_format = {
+            "format": {
+                "type": "json_schema",
+                "name": "key_mappings",
+                "schema": schema,
+                "strict": True
+            }
+        }
+        if self.verbose:
+            print(f"Resolving {len(keys)} {data_str} keys with openai...")
+        output_text = self.cache.get_or_create(
+            self.cache.key(model, instruction, text=text_format),
+            lambda: create_response(
+                self.client, self.scheduler, self.tracer,
+                priority=self.priority,
+                model=model,
+                input=instruction,
+                text=text_format
+            )
+        )
+
+        aliases = {}
+        for m in json.loads(output_text)['mappings']:
+            if m['key'] in keys and m['column'] in columns:
+                aliases[m['key']] = m['column']
+        return aliases
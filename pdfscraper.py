@@ -1,12 +1,75 @@
 import asyncio
 import argparse
+import datetime
 import json
+import os
 from pathlib import Path
 import pandas as pd
 import ssl
-import urllib
 
-from classes import PDFScraper
+from classes import CrawlCache, LeaseManager, PDFDownloader, PDFScraper, RequestScheduler, ResponseCache, Tracer, write_csv
+
+def crawl_config(id, id_config, recrawl=False):
+    """
+    Returns the keyword arguments of PDFScraper.get_pdf_links_from_url for a company.
+    """
+    return {
+        'root_url': id_config['crawler']['root_url'],
+        'deep': id_config['crawler']['deep'],
+        'url_depth': id_config['crawler']['url_depth'],
+        'max_pages': id_config['crawler'].get('max_pages'),
+        'max_pdfs': id_config['crawler'].get('max_pdfs'),
+        'output_path': f"data\\{id}\\links.csv",
+        'cache_path': f"data\\{id}\\crawl_cache.json",
+        'recrawl': recrawl
+    }
+
+def find_reports(pdfscraper, id, id_config, force=False):
+    """
+    Uses the LLM to get a table of annual reports from all candidate PDFs of a
+    company, unless they are the candidates pdfs.csv was made from and force is
+    False. Returns False if its links weren't scraped.
+    """
+    id_path = f"data\\{id}"
+    try:
+        links = pd.read_csv(f"{id_path}\\links.csv", index_col=0).to_dict('records')
+    except FileNotFoundError:
+        print(f"Links not scraped for for {id}")
+        return False
+    special_instructions = id_config['link_parser']['special_instructions']
+    crawl_cache = CrawlCache(f"{id_path}\\crawl_cache.json")
+    fingerprint = crawl_cache.links_fingerprint(links, special_instructions)
+    if not force and crawl_cache.is_classified(fingerprint) and os.path.exists(f"{id_path}\\pdfs.csv"):
+        if pdfscraper.verbose:
+            print(f"PDF links unchanged for {id}, keeping pdfs.csv")
+        return True
+    pdfs = pdfscraper.find_annual_reports_from_pdf_links(links=links, special_instructions=special_instructions)
+    write_csv(pdfs, f"{id_path}\\pdfs.csv")
+    crawl_cache.record_classification(fingerprint)
+    crawl_cache.save()
+    return True
+
+def download_reports(downloader, id):
+    """
+    Downloads the annual reports of a company. Returns False if its PDF links
+    weren't parsed, or some downloads failed.
+    """
+    id_path = f"data\\{id}"
+    try:
+        pdfs = pd.read_csv(f"{id_path}\\pdfs.csv", index_col=0)
+    except FileNotFoundError:
+        print(f"PDF links not parsed for {id}")
+        return False
+    downloads = []
+    for y, row in pdfs.iterrows():
+        report_path = f"{id_path}\\{y}"
+        Path(report_path).mkdir(parents=True, exist_ok=True)
+        downloads.append((row['url'], report_path+f"\\{row['filename']}"))
+    failed = downloader.download_all(downloads)
+    for path, e in failed.items():
+        print(f"Error getting data for {path}:")
+        print(e)
+    return not failed
 
 def run():
     # Hack for windows
@@ -44,6 +107,67 @@ def run():
         required=False, 
         help="Only download annual reports from the PDF links."
     )
+    parser.add_argument(
+        "--recrawl",
+        action="store_true",
+        required=False,
+        help="Render every page again instead of revalidating the crawl cache, and find annual reports again even if the PDF links are unchanged."
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        required=False,
+        help="Number of companies to crawl concurrently for PDF links, and of changed pages rendered at once when revalidating the crawl cache. Defaults to 4."
+    )
+    parser.add_argument(
+        "-w", "--workers",
+        type=int,
+        default=4,
+        required=False,
+        help="Number of concurrent PDF downloads. Defaults to 4."
+    )
+    parser.add_argument(
+        "--shard",
+        type=str,
+        required=False,
+        metavar="WORK_DIR",
+        help="Share the work with other pdfscraper processes, on this or other hosts, started with the same WORK_DIR on a shared drive. Each company is leased to one process at a time."
+    )
+    parser.add_argument(
+        "--lease-ttl",
+        type=float,
+        default=300,
+        required=False,
+        help="Seconds after which the lease of a --shard process which stopped is taken over by another. Defaults to 300."
+    )
+    parser.add_argument(
+        "--report",
+        type=str,
+        nargs="?",
+        const="",
+        required=False,
+        metavar="PATH",
+        help="Write a report of the run's stages to PATH as JSON lines. Defaults to runs\\pdfscraper_<time>.jsonl."
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        required=False,
+        help="Neither read nor write the OpenAI response cache."
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        required=False,
+        help="Ignore cached OpenAI responses, and cache the new responses."
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        required=False,
+        help="Only use cached OpenAI responses. Fails on a cache miss."
+    )
     parser.add_argument(
         "-v", "--verbose",
         action="store_true",
@@ -76,42 +200,86 @@ def run():
     get_links = args.get('get_links')
     parse_links = args.get('parse_links')
     download_pdfs = args.get('download_pdfs')
+    recrawl = args.get('recrawl')
     run_all = not (get_links or parse_links or download_pdfs)
 
     # Run and save data
-    pdfscraper = PDFScraper(verbose=verbose)
+    cache = ResponseCache(enabled=not args.get('no_cache'),
+                          refresh=args.get('refresh'),
+                          offline=args.get('offline'),
+                          verbose=verbose)
+    scheduler = RequestScheduler(verbose=verbose)
+    run_id = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    if args.get('shard'):
+        # Workers of a shard are usually started together
+        run_id = f"{run_id}_{os.getpid()}"
+    report_path = None
+    if args.get('report') is not None:
+        report_path = args.get('report') or f"runs\\pdfscraper_{run_id}.jsonl"
+    tracer = Tracer(report_path, run_id)
+    pdfscraper = PDFScraper(verbose=verbose, cache=cache, scheduler=scheduler, tracer=tracer)
+    downloader = PDFDownloader(workers=args.get('workers'), verbose=verbose, tracer=tracer)
     for id in to_run:
-        id_config = config[id]
-        id_path = f"data\\{id}"
-        Path(id_path).mkdir(parents=True, exist_ok=True)
-        
-        # Scrape all PDF links and save
-        if run_all or get_links:
-            links = asyncio.run(pdfscraper.get_pdf_links_from_url(id_config['crawler']['root_url'], id_config['crawler']['deep'], id_config['crawler']['url_depth']))
-            links.to_csv(f"{id_path}\\links.csv")
+        Path(f"data\\{id}").mkdir(parents=True, exist_ok=True)
+
+    # Run as one of several workers, leasing each company
+    if args.get('shard'):
+        leases = LeaseManager(args.get('shard'), ttl=args.get('lease_ttl'), verbose=verbose)
+        ran = 0
+        try:
+            for id in to_run:
+                unit = f"scrape_{id}"
+                # An error on the shared drive skips the company, which another
+                # worker or the next run can take
+                try:
+                    if not leases.acquire(unit):
+                        continue
+                except Exception as e:
+                    print(f"Error leasing {unit}:")
+                    print(e)
+                    continue
+                ok = True
+                try:
+                    if run_all or get_links:
+                        asyncio.run(pdfscraper.get_pdf_links_from_url(**crawl_config(id, config[id], recrawl),
+                                                                   concurrency=args.get('concurrency')))
+                    if run_all or parse_links:
+                        ok = find_reports(pdfscraper, id, config[id], force=recrawl)
+                    if ok and (run_all or download_pdfs):
+                        ok = download_reports(downloader, id)
+                    leases.complete(unit, failed=not ok)
+                except Exception as e:
+                    print(f"Error scraping {id}:")
+                    print(e)
+                    leases.complete(unit, failed=True, error=str(e))
+                ran += 1
+        finally:
+            leases.close()
+        print(f"Ran {ran} work units of {args.get('shard')}.")
+        to_run = []
+
+    # Scrape all PDF links and save, crawling all companies in one browser
+    if to_run and (run_all or get_links):
+        crawls = {id: crawl_config(id, config[id], recrawl) for id in to_run}
+        results = asyncio.run(pdfscraper.get_pdf_links_from_urls(crawls, concurrency=args.get('concurrency')))
+        for id, links in results.items():
+            if isinstance(links, Exception):
+                print(f"Error crawling links for {id}:")
+                print(links)
 
+    for id in to_run:
         # Use LLM to get a table of annual reports from all candidate PDFs
         if run_all or parse_links:
-            try:
-                links = pd.read_csv(f"{id_path}\\links.csv", index_col=0).to_dict('records')
-                pdfs = pdfscraper.find_annual_reports_from_pdf_links(links=links, special_instructions=id_config['link_parser']['special_instructions'])
-                pdfs.to_csv(f"{id_path}\\pdfs.csv")
-            except FileNotFoundError:
-                print(f"Links not scraped for for {id}")
-        
+            find_reports(pdfscraper, id, config[id], force=recrawl)
+
         # Download PDFs from PDF links
         if run_all or download_pdfs:
-            try:
-                pdfs = pd.read_csv(f"{id_path}\\pdfs.csv", index_col=0)
-                for y, row in pdfs.iterrows():
-                    report_path = f"{id_path}\\{y}"
-                    Path(report_path).mkdir(parents=True, exist_ok=True)
-                    try:
-                        urllib.request.urlretrieve(row['url'], report_path+f"\\{row['filename']}")
-                    except Exception as e:
-                        print(f"Error getting data for year {y}:")
-                        print(e)
-            except FileNotFoundError:
-                print(f"PDF links not parsed for {id}")
+            download_reports(downloader, id)
 
+    if verbose:
+        print(cache.stats())
+        print(scheduler.stats())
+        print(tracer.summary())
+        if tracer.report_path:
+            print(f"Run report saved to {tracer.report_path}")
     return
@@ -0,0 +1,372 @@
+import asyncio
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import datetime
+import json
+import multiprocessing
+from pathlib import Path
+import queue
+import ssl
+import threading
+import time
+import pandas as pd
+
+from classes import AliasStore, DataParser, ParseManifest, PDFDownloader, PDFScraper, RequestScheduler, ResponseCache, StatementStore, Tracer, EXTRACTION_MODEL, index_report
+from pdfscraper import crawl_config, find_reports
+from reportparser import consolidate_company, extraction_fingerprint
+
+# Put on a stage's queue once per worker to stop it
+DONE = None
+
+class Pipeline():
+    """
+    Runs get_links, parse_links, download, parse and consolidate for several
+    companies at once, each stage taking work from the previous one as soon as
+    it is produced.
+
+    A company's links are classified as soon as its crawl completes, each year's
+    report is parsed as soon as its download completes, and a company is
+    consolidated as soon as its last year is parsed. The download and parse
+    queues are bounded, so downloads wait for the parsers instead of piling up.
+
+    Parameters:
+        config (dict): The contents of config.json.
+        download_workers (int): Number of concurrent PDF downloads.
+        parse_workers (int): Number of reports parsed concurrently. Text extraction
+            runs in a pool of as many processes.
+        queue_size (int): Maximum number of reports waiting to be downloaded, and
+            downloaded reports waiting to be parsed.
+        concurrency (int): Number of companies crawled concurrently.
+    """
+    def __init__(self, config, pdfscraper, downloader, dataparser, store, download_workers=4, parse_workers=2,
+                 queue_size=4, concurrency=4, verbose=False):
+        self.config = config
+        self.pdfscraper = pdfscraper
+        self.downloader = downloader
+        self.dataparser = dataparser
+        self.store = store
+        self.download_workers = download_workers
+        self.parse_workers = parse_workers
+        self.concurrency = concurrency
+        self.verbose = verbose
+        self.tracer = dataparser.tracer
+
+        # Crawls and finished companies are few, so only the per-report queues are bounded
+        self.link_queue = queue.Queue()
+        self.download_queue = queue.Queue(maxsize=queue_size)
+        self.parse_queue = queue.Queue(maxsize=queue_size)
+        self.consolidate_queue = queue.Queue()
+
+        self.lock = threading.Lock()
+        self.pdfs = {}
+        self.manifests = {}
+        self.pending = {}
+        self.failed = {}
+        self.start = None
+        self.first_result = None
+        return
+
+    def run(self, ids):
+        """
+        Runs the pipeline on a list of company ids.
+        Returns a dict of company to the years which failed.
+        """
+        self.start = time.perf_counter()
+        stages = [
+            (self.parse_links, self.link_queue, 1),
+            (self.download, self.download_queue, self.download_workers),
+            (self.parse, self.parse_queue, self.parse_workers),
+            (self.consolidate, self.consolidate_queue, 1),
+        ]
+        # Workers are spawned rather than forked, as forking while a stage holds a
+        # lock, such as PdfiumBackend's, would leave it held in the child
+        with ProcessPoolExecutor(max_workers=self.parse_workers, mp_context=multiprocessing.get_context("spawn")) as self.processes:
+            threads = []
+            for work, inbox, workers in stages:
+                stage = [threading.Thread(target=self.worker, args=(work, inbox), daemon=True) for _ in range(workers)]
+                for t in stage:
+                    t.start()
+                threads.append(stage)
+
+            self.crawl(ids)
+
+            # A stage is stopped once every stage feeding it has stopped
+            for (work, inbox, workers), stage in zip(stages, threads):
+                for _ in range(workers):
+                    inbox.put(DONE)
+                for t in stage:
+                    t.join()
+        with self.lock:
+            return {id: list(years) for id, years in self.failed.items()}
+
+    def worker(self, work, inbox):
+        while True:
+            item = inbox.get()
+            if item is DONE:
+                return
+            # A stage thread which stopped would leave the queues feeding it full,
+            # and a year which never finished would hold back its company
+            try:
+                work(*item)
+            except Exception as e:
+                print(f"Error in {work.__name__} for {' '.join(str(i) for i in item[:2])}:")
+                print(e)
+                if work in (self.download, self.parse):
+                    self.finish(item[0], item[1], failed=True)
+
+    def crawl(self, ids):
+        """
+        Crawls all companies in one browser, queueing each for link classification
+        as soon as its crawl completes.
+        """
+        crawls = {}
+        for id in ids:
+            Path(f"data\\{id}").mkdir(parents=True, exist_ok=True)
+            crawls[id] = crawl_config(id, self.config[id])
+
+        def on_result(id, links):
+            if isinstance(links, Exception):
+                print(f"Error crawling links for {id}:")
+                print(links)
+                return
+            self.link_queue.put((id,))
+
+        asyncio.run(self.pdfscraper.get_pdf_links_from_urls(crawls, concurrency=self.concurrency, on_result=on_result))
+
+    def parse_links(self, id):
+        id_path = f"data\\{id}"
+        try:
+            if not find_reports(self.pdfscraper, id, self.config[id]):
+                return
+            pdfs = pd.read_csv(f"{id_path}\\pdfs.csv", index_col=0)
+        except Exception as e:
+            print(f"Error finding annual reports for {id}:")
+            print(e)
+            return
+
+        if pdfs.empty:
+            print(f"No annual reports found for {id}")
+            return
+        with self.lock:
+            self.pdfs[id] = pdfs
+            self.manifests[id] = ParseManifest(f"{id_path}\\manifest.json")
+            self.pending[id] = len(pdfs)
+        for y, row in pdfs.iterrows():
+            Path(f"{id_path}\\{y}").mkdir(parents=True, exist_ok=True)
+            self.download_queue.put((id, y, row['url'], row['filename']))
+
+    def download(self, id, y, url, filename):
+        path = f"data\\{id}\\{y}\\{filename}"
+        try:
+            self.downloader.traced_download(url, path)
+        except Exception as e:
+            print(f"Error getting data for {path}:")
+            print(e)
+            self.finish(id, y, failed=True)
+            return
+        self.parse_queue.put((id, y, filename))
+
+    def parse(self, id, y, filename):
+        report_path = f"data\\{id}\\{y}"
+        pdf_path = f"{report_path}\\{filename}"
+        special_instructions = self.config[id]['report_parser']['special_instructions']
+        pdf_backend = self.config[id]['report_parser'].get('pdf_backend', 'pypdf2')
+
+        # Text extraction holds the GIL, so it runs in the process pool
+        try:
+            pages, duration = self.processes.submit(index_report, pdf_path, f"{report_path}\\pages.idx", pdf_backend).result()
+            if duration is not None:
+                self.tracer.record("text_extraction", duration, year=y, pages=pages, process=True)
+        except Exception as e:
+            # The parser retries the extraction itself and reports the failure
+            print(f"Error extracting text for {id} {y}:")
+            print(e)
+
+        try:
+            with self.tracer.span("parse_report", company=id, year=y):
+                missing = self.dataparser.parse_report_for_year(report_path=report_path,
+                                                                report_name=filename,
+                                                                year=y,
+                                                                special_instructions=special_instructions,
+                                                                page_locator=self.config[id]['report_parser'].get('page_locator', 'scored'),
+                                                                pdf_backend=pdf_backend)
+            if not missing:
+                with self.lock:
+                    self.manifests[id].record(y, pdf_path, f"{report_path}\\output.json",
+                                              extraction_fingerprint(self.dataparser, self.config[id]['report_parser']), EXTRACTION_MODEL)
+        except Exception as e:
+            print(f"Error parsing report for {id} {y}:")
+            print(e)
+            self.finish(id, y, failed=True)
+            return
+        if missing:
+            print(f"Could not extract {', '.join(missing)} for {id} {y}.")
+            self.finish(id, y, failed=True)
+            return
+        self.finish(id, y)
+
+    def finish(self, id, y, failed=False):
+        """
+        Marks a year of a company as done, and queues the company for consolidation
+        once all its years are done.
+        """
+        with self.lock:
+            if failed:
+                self.failed.setdefault(id, []).append(y)
+            elif self.first_result is None:
+                self.first_result = time.perf_counter() - self.start
+                self.tracer.record("first_result", self.first_result, company=id, year=y)
+                if self.verbose:
+                    print(f"First report parsed after {self.first_result:.1f}s ({id} {y}).")
+            self.pending[id] -= 1
+            done = self.pending[id] == 0
+        if done:
+            self.consolidate_queue.put((id,))
+
+    def consolidate(self, id):
+        with self.lock:
+            failed = len(self.failed.get(id, []))
+        if failed == len(self.pdfs[id]):
+            print(f"No reports parsed for {id}, skipping consolidation.")
+            return
+        try:
+            self.manifests[id].save()
+            consolidate_company(self.dataparser, self.store, self.manifests[id], id, f"data\\{id}", self.config[id],
+                                self.pdfs[id].index, workers=self.parse_workers)
+            if self.verbose:
+                print(f"Consolidated {id} after {time.perf_counter() - self.start:.1f}s.")
+        except Exception as e:
+            print(f"Error consolidating data for {id}:")
+            print(e)
+
+def run():
+    # Hack for windows
+    ssl._create_default_https_context = ssl._create_unverified_context
+
+    # Parse args for program
+    parser = argparse.ArgumentParser(prog="pipeline", description="Scrapes, downloads, parses and consolidates annual reports in one pipelined run.")
+    parser.add_argument(
+        "-i", "--id",
+        type=str,
+        required=False,
+        help="The ID of the company to run."
+    )
+    parser.add_argument(
+        "-a", "--all",
+        action="store_true",
+        required=False,
+        help="Run all companies found in config.json. Ignored when --id is present."
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        required=False,
+        help="Number of companies to crawl concurrently for PDF links, and of changed pages rendered at once when revalidating the crawl cache. Defaults to 4."
+    )
+    parser.add_argument(
+        "-w", "--workers",
+        type=int,
+        default=4,
+        required=False,
+        help="Number of concurrent PDF downloads. Defaults to 4."
+    )
+    parser.add_argument(
+        "--parse-workers",
+        type=int,
+        default=2,
+        required=False,
+        help="Number of reports to parse concurrently. Defaults to 2."
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=4,
+        required=False,
+        help="Maximum number of reports waiting to be downloaded, and downloaded reports waiting to be parsed. Defaults to 4."
+    )
+    parser.add_argument(
+        "--report",
+        type=str,
+        nargs="?",
+        const="",
+        required=False,
+        metavar="PATH",
+        help="Write a report of the run's stages to PATH as JSON lines. Defaults to runs\\pipeline_<time>.jsonl."
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        required=False,
+        help="Neither read nor write the OpenAI response cache."
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        required=False,
+        help="Ignore cached OpenAI responses, and cache the new responses."
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        required=False,
+        help="Only use cached OpenAI responses. Fails on a cache miss."
+    )
+    parser.add_argument(
+        "-v", "--verbose",
+        action="store_true",
+        required=False,
+        help="Enable verbose mode"
+    )
+    args = vars(parser.parse_args())
+    verbose = args.get('verbose')
+
+    # Figure out which companies to run
+    if (args.get('id') is None and args.get('all')==False):
+        print("Must specify a company to run using --id or --all")
+        return
+
+    with open('config.json', 'r') as f:
+        config = json.load(f)
+    to_run = []
+    if args.get('id'):
+        if args.get('id') in config.keys():
+            to_run.append(args.get('id'))
+        else:
+            print(f"No config found for {args.get('id')}")
+    elif args.get('all'):
+        to_run = list(config.keys())
+
+    if verbose:
+        print(f"Running pipeline on ids: {to_run}")
+
+    cache = ResponseCache(enabled=not args.get('no_cache'),
+                          refresh=args.get('refresh'),
+                          offline=args.get('offline'),
+                          verbose=verbose)
+    scheduler = RequestScheduler(verbose=verbose)
+    run_id = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    report_path = None
+    if args.get('report') is not None:
+        report_path = args.get('report') or f"runs\\pipeline_{run_id}.jsonl"
+    tracer = Tracer(report_path, run_id)
+    pdfscraper = PDFScraper(verbose=verbose, cache=cache, scheduler=scheduler, tracer=tracer)
+    downloader = PDFDownloader(workers=args.get('workers'), verbose=verbose, tracer=tracer)
+    dataparser = DataParser(verbose=verbose, cache=cache, aliases=AliasStore(verbose=verbose), scheduler=scheduler, tracer=tracer)
+    pipeline = Pipeline(config, pdfscraper, downloader, dataparser, StatementStore(verbose=verbose),
+                        download_workers=args.get('workers'),
+                        parse_workers=args.get('parse_workers'),
+                        queue_size=args.get('queue_size'),
+                        concurrency=args.get('concurrency'),
+                        verbose=verbose)
+    failed = pipeline.run(to_run)
+    for id, years in failed.items():
+        print(f"Failed to get years for {id}: {sorted(years)}")
+
+    if verbose:
+        print(cache.stats())
+        print(scheduler.stats())
+        print(tracer.summary())
+        if tracer.report_path:
+            print(f"Run report saved to {tracer.report_path}")
+    return
@@ -0,0 +1,122 @@
+import argparse
+import json
+import time
+import urllib.error
+import urllib.request
+
+# Only the standard library is imported, so that submitting a job starts fast
+
+DEFAULT_SERVER = "http://127.0.0.1:8765"
+
+def request(server, path, job=None):
+    """
+    Sends a request to a reportparser serve worker, and returns the decoded JSON
+    response. Errors returned by the worker are raised as RuntimeError.
+    """
+    data = json.dumps(job).encode() if job is not None else None
+    req = urllib.request.Request(f"{server}{path}", data=data, headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(req) as response:
+            return json.load(response)
+    except urllib.error.HTTPError as e:
+        raise RuntimeError(json.load(e).get('error', str(e)))
+
+def wait(server, job_id, interval=1.0):
+    """
+    Polls a job until it is done or failed, and returns it.
+    """
+    while True:
+        job = request(server, f"/jobs/{job_id}")
+        if job['status'] in ("done", "failed"):
+            return job
+        time.sleep(interval)
+
+def run():
+    # Parse args for program
+    parser = argparse.ArgumentParser(prog="reportclient", description="Submits jobs to a reportparser serve worker.")
+    parser.add_argument(
+        "-i", "--id",
+        type=str,
+        required=False,
+        help="The ID of the company to work on."
+    )
+    parser.add_argument(
+        "-y", "--year",
+        type=int,
+        required=False,
+        help="Work on a single year."
+    )
+    parser.add_argument(
+        "-p", "--parse",
+        action="store_true",
+        required=False,
+        help="Only parse report(s). By default, parsing and consolidating are run."
+    )
+    parser.add_argument(
+        "-c", "--consolidate",
+        action="store_true",
+        required=False,
+        help="Only consolidate data for all reports. By default, parsing and consolidating are run."
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        required=False,
+        help="Skip years whose output.json is up to date, and skip consolidation if no output changed."
+    )
+    parser.add_argument(
+        "-w", "--workers",
+        type=int,
+        default=1,
+        required=False,
+        help="Number of years to parse concurrently. Defaults to 1."
+    )
+    parser.add_argument(
+        "--status",
+        type=int,
+        nargs="?",
+        const=0,
+        required=False,
+        metavar="JOB",
+        help="Show a job, or the most recent jobs, and exit."
+    )
+    parser.add_argument(
+        "--no-wait",
+        action="store_true",
+        required=False,
+        help="Print the job id once queued, instead of waiting for the result."
+    )
+    parser.add_argument(
+        "--server",
+        type=str,
+        default=DEFAULT_SERVER,
+        required=False,
+        help=f"URL of the worker. Defaults to {DEFAULT_SERVER}."
+    )
+    args = vars(parser.parse_args())
+    server = args.get('server').rstrip("/")
+
+    if args.get('status') is not None:
+        path = f"/jobs/{args.get('status')}" if args.get('status') else "/jobs"
+        print(json.dumps(request(server, path), indent=1))
+        return
+
+    if args.get('id') is None:
+        print("Must specify a company using --id")
+        return
+
+    job = {key: args.get(key) for key in ('id', 'year', 'parse', 'consolidate', 'incremental', 'workers')}
+    job_id = request(server, "/jobs", job)['job']
+    if args.get('no_wait'):
+        print(job_id)
+        return
+
+    job = wait(server, job_id)
+    if job['status'] == "failed":
+        print(f"Job {job_id} failed after {job['attempts']} attempts: {job['error']}")
+    if job['result'] is not None:
+        print(json.dumps(job['result'], indent=1))
+    return
+
+if __name__ == "__main__":
+    run()
@@ -1,15 +1,597 @@
 import asyncio
 import argparse
+import contextlib
+import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import partial
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import json
+import multiprocessing
 import os
 from pathlib import Path
+import signal
+import socket
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+from openai import OpenAI
 import pandas as pd
 
-from classes import DataParser
+from classes import AliasStore, BatchManifest, DataParser, JobQueue, LeaseManager, OpenAIBatchTransport, ParseManifest, Profiler, RequestScheduler, ResponseCache, StatementLocator, StatementStore, Tracer, EXTRACTION_MODEL, PRIORITY_BACKFILL, PRIORITY_INTERACTIVE, STATEMENTS, index_report, openai_key, write_csv
+
+def parse_years(dataparser, id_path, pdfs, years, special_instructions, workers=1, page_locator="scored", pdf_backend="pypdf2",
+                processes=None):
+    """
+    Parses the annual report of each year in years.
+
+    With workers > 1, page text extraction runs in a process pool, and each year
+    is handed to a thread pool for the OpenAI requests as soon as its text is
+    extracted. A failure in one year is reported and does not stop the others.
+    An open process pool can be passed in as processes to reuse its workers, in
+    which case it is used whatever the number of workers.
+
+    Returns the list of years which failed, including years with a statement
+    which could not be extracted.
+    """
+    failed = []
+    reports = {}
+    for y in years:
+        report_path = f"{id_path}\\{y}"
+        report_name = pdfs.loc[y]['filename']
+        if os.path.exists(f"{report_path}\\{report_name}"):
+            reports[y] = (report_path, report_name)
+        else:
+            print(f"Report does not exist: {report_name}")
+            failed.append(y)
+
+    def parse(y):
+        report_path, report_name = reports[y]
+        try:
+            with dataparser.tracer.span("parse_report", company=os.path.basename(id_path), year=y):
+                missing = dataparser.parse_report_for_year(report_path=report_path,
+                                                           report_name=report_name,
+                                                           year=y,
+                                                           special_instructions=special_instructions,
+                                                           page_locator=page_locator,
+                                                           pdf_backend=pdf_backend)
+        except Exception as e:
+            print(f"Error parsing report for year {y}:")
+            print(e)
+            return False
+        if missing:
+            print(f"Could not extract {', '.join(missing)} for year {y}.")
+            return False
+        return True
+
+    if workers <= 1 and processes is None:
+        for y in reports:
+            if not parse(y):
+                failed.append(y)
+        return failed
+
+    with (contextlib.nullcontext(processes) if processes else ProcessPoolExecutor(max_workers=workers)) as processes, \
+            ThreadPoolExecutor(max_workers=workers) as threads:
+        indexing = {}
+        for y, (report_path, report_name) in reports.items():
+            future = processes.submit(index_report, f"{report_path}\\{report_name}", f"{report_path}\\pages.idx", pdf_backend)
+            indexing[future] = y
+
+        parsing = {}
+        for future in as_completed(indexing):
+            y = indexing[future]
+            try:
+                pages, duration = future.result()
+                if duration is not None:
+                    dataparser.tracer.record("text_extraction", duration, year=y, pages=pages, process=True)
+            except Exception as e:
+                # The parser retries the extraction itself and reports the failure
+                print(f"Error extracting text for year {y}:")
+                print(e)
+            parsing[threads.submit(parse, y)] = y
+
+        for future in as_completed(parsing):
+            if not future.result():
+                failed.append(parsing[future])
+    return failed
+
+def extraction_fingerprint(dataparser, report_config):
+    """
+    Returns the fingerprint recorded in the manifest for the years parsed with
+    the report_parser config of a company.
+    """
+    return dataparser.extraction_fingerprint(report_config['special_instructions'],
+                                             page_locator=report_config.get('page_locator', 'scored'),
+                                             pdf_backend=report_config.get('pdf_backend', 'pypdf2'))
+
+def stale_years(dataparser, manifest, id_path, pdfs, years, report_config):
+    """
+    Splits years into those whose output.json is out of date with the PDF,
+    prompts, model, page locator or PDF backend, and those which are up to date.
+
+    Returns the list of stale years, and the list of current years.
+    """
+    prompt_sha256 = extraction_fingerprint(dataparser, report_config)
+    current = []
+    for y in years:
+        pdf_path = f"{id_path}\\{y}\\{pdfs.loc[y]['filename']}"
+        output_path = f"{id_path}\\{y}\\output.json"
+        if os.path.exists(pdf_path) and manifest.is_current(y, pdf_path, output_path, prompt_sha256, EXTRACTION_MODEL):
+            current.append(y)
+    return [y for y in years if y not in current], current
+
+def parse_company(dataparser, manifest, id_path, id_config, pdfs, years, workers=1, processes=None):
+    """
+    Parses years of a company with parse_years, and records each year whose
+    statements were all extracted in the company's manifest.
+
+    Returns the list of years which failed.
+    """
+    special_instructions = id_config['report_parser']['special_instructions']
+    failed = parse_years(dataparser, id_path, pdfs, years,
+                         special_instructions=special_instructions,
+                         workers=workers,
+                         page_locator=id_config['report_parser'].get('page_locator', 'scored'),
+                         pdf_backend=id_config['report_parser'].get('pdf_backend', 'pypdf2'),
+                         processes=processes)
+
+    prompt_sha256 = extraction_fingerprint(dataparser, id_config['report_parser'])
+    for y in years:
+        output_path = f"{id_path}\\{y}\\output.json"
+        if y not in failed:
+            manifest.record(y, f"{id_path}\\{y}\\{pdfs.loc[y]['filename']}", output_path, prompt_sha256, EXTRACTION_MODEL)
+    manifest.save()
+    return failed
+
+def plan_batch(dataparser, id, id_path, pdfs, years, special_instructions, page_locator="scored", pdf_backend="pypdf2"):
+    """
+    Prepares the extraction requests of each year in years for a batch job,
+    leaving out requests whose responses are already cached.
+
+    Returns the list of (custom_id, body) to submit, a dict of each custom_id
+    to its response cache key, and the list of years which were planned.
+    """
+    requests = []
+    cache_keys = {}
+    planned = []
+    for y in years:
+        report_path = f"{id_path}\\{y}"
+        report_name = pdfs.loc[y]['filename']
+        if not os.path.exists(f"{report_path}\\{report_name}"):
+            print(f"Report does not exist: {report_name}")
+            continue
+        try:
+            plan = dataparser.plan_report(report_path, report_name, y, special_instructions, page_locator, pdf_backend)
+            for key, r in plan.items():
+                cache_key = dataparser.extraction_key(r['instruction'], file=r['file'], text=r['text'], text_format=r['format'])
+                if dataparser.cache.contains(cache_key):
+                    continue
+                custom_id = f"{id}/{y}/{key}"
+                requests.append((custom_id, dataparser.extraction_body(r['instruction'], file=r['file'], text=r['text'], text_format=r['format'])))
+                cache_keys[custom_id] = cache_key
+            planned.append(y)
+        except Exception as e:
+            print(f"Error preparing report for year {y}:")
+            print(e)
+    return requests, cache_keys, planned
+
+def collect_batches(cache, transport, batches):
+    """
+    Caches the responses of every finished batch job, so that parsing their
+    years only reads from the response cache.
+
+    Returns a dict of company to the years whose requests all succeeded.
+    """
+    collected = {}
+    for batch_id, job in batches.pending().items():
+        job.update(transport.status(batch_id))
+        if job['status'] not in ("completed", "expired", "cancelled", "failed"):
+            print(f"Batch {batch_id} is still {job['status']} ({job['completed']}/{job['total']} done).")
+            continue
+
+        results = transport.results(batch_id)
+        failed = set()
+        for custom_id, cache_key in job['requests'].items():
+            output_text = results.get(custom_id)
+            if output_text is None:
+                failed.add(tuple(custom_id.split("/")[:2]))
+            else:
+                cache.put(cache_key, output_text)
+        for id, years in job['reports'].items():
+            for y in years:
+                if (id, str(y)) in failed:
+                    print(f"Batch requests failed for {id} {y}. Submit it again with --batch submit.")
+                else:
+                    collected.setdefault(id, []).append(y)
+        job['status'] = "collected"
+    batches.save()
+    return collected
+
+def consolidate_company(dataparser, store, manifest, id, id_path, id_config, years, workers=1, incremental=False):
+    """
+    Consolidates the output.json of each of years into one CSV per statement,
+    and writes them to the Parquet store.
+
+    With incremental=True, consolidation is skipped if no year's output nor the
+    consolidator config changed since the last run.
+
+    Returns False if consolidation was skipped, True otherwise.
+    """
+    balance_sheet = []
+    income_statement = []
+    cash_flow_statement = []
+    for y in years:
+        output_file = f"{id_path}\\{y}\\output.json"
+        if os.path.exists(output_file):
+            with open(output_file) as f:
+                statement = json.load(f)
+                statement['balance_sheet'].update({'year':y})
+                balance_sheet.append(statement['balance_sheet'])
+
+                statement['income_statement'].update({'year':y})
+                income_statement.append(statement['income_statement'])
+
+                statement['cash_flow_statement'].update({'year':y})
+                cash_flow_statement.append(statement['cash_flow_statement'])
+
+    # Only re-run consolidation when a year's output or the consolidator config changed
+    consolidation_inputs = [balance_sheet, income_statement, cash_flow_statement, id_config['data_consolidator']]
+    fingerprint = hashlib.sha256(json.dumps(consolidation_inputs, sort_keys=True, default=str).encode()).hexdigest()
+    consolidated = all(os.path.exists(f"{id_path}\\{s}.csv") for s in STATEMENTS)
+    if incremental and consolidated and manifest.consolidation_is_current(fingerprint):
+        return False
+
+    engine = id_config['data_consolidator'].get('engine', 'local')
+    window = id_config['data_consolidator'].get('window_years')
+    if window and len(balance_sheet) > window:
+        # Long histories are consolidated in overlapping windows of years
+        consolidate = partial(dataparser.consolidate_windows,
+                              window=window,
+                              overlap=id_config['data_consolidator'].get('window_overlap', 2),
+                              workers=workers,
+                              window_dir=f"{id_path}\\windows")
+    else:
+        consolidate = dataparser.consolidate_reports
+    with dataparser.tracer.span("consolidation", company=id, years=len(balance_sheet), engine=engine):
+        df_balance_sheet = consolidate(balance_sheet, 'balance sheet', id_config['data_consolidator']['balance_sheet_special_instructions'], id_config['data_consolidator']['model'], engine) 
+        df_income_statement = consolidate(income_statement, 'income statement', id_config['data_consolidator']['income_statement_special_instructions'], id_config['data_consolidator']['model'], engine) 
+        df_cash_flow_statement = consolidate(cash_flow_statement, 'cash flow statement', id_config['data_consolidator']['cash_flow_statement_special_instructions'], id_config['data_consolidator']['model'], engine)
+
+    write_csv(df_balance_sheet, f"{id_path}\\balance_sheet.csv")
+    write_csv(df_income_statement, f"{id_path}\\income_statement.csv")
+    write_csv(df_cash_flow_statement, f"{id_path}\\cash_flow_statement.csv")
+
+    store.write(id, 'balance_sheet', df_balance_sheet)
+    store.write(id, 'income_statement', df_income_statement)
+    store.write(id, 'cash_flow_statement', df_cash_flow_statement)
+
+    manifest.record_consolidation(fingerprint)
+    manifest.save()
+    if dataparser.aliases is not None:
+        dataparser.aliases.save()
+    return True
+
+def run_shard(leases, dataparser, store, config, to_run, run_parse=True, run_consolidate=True, year=None, incremental=False):
+    """
+    Parses and consolidates companies as one of several workers sharing the
+    work directory of leases, on one or several hosts.
+
+    Each year of each company is a work unit, and so is the consolidation of
+    each company. A company is consolidated by the worker which finishes its
+    last year, or by any worker once all its years are done. A unit which fails
+    is marked done with failed=True in its .done file, and isn't retried within
+    the same work directory.
+
+    Returns the number of units this worker ran.
+    """
+    def acquire(unit):
+        # An error on the shared drive skips the unit, which another worker or
+        # the next run can take
+        try:
+            return leases.acquire(unit)
+        except Exception as e:
+            print(f"Error leasing {unit}:")
+            print(e)
+            return False
+
+    def consolidate(id, years):
+        if run_parse and not all(leases.is_done(f"parse_{id}_{y}") for y in years):
+            return 0
+        unit = f"consolidate_{id}"
+        if not acquire(unit):
+            return 0
+        try:
+            consolidate_company(dataparser, store, ParseManifest(f"data\\{id}\\manifest.json"), id, f"data\\{id}",
+                                config[id], years, incremental=incremental)
+            leases.complete(unit)
+        except Exception as e:
+            print(f"Error consolidating data for {id}:")
+            print(e)
+            leases.complete(unit, failed=True, error=str(e))
+        return 1
+
+    ran = 0
+    for id in to_run:
+        id_config = config[id]
+        id_path = f"data\\{id}"
+        try:
+            pdfs = pd.read_csv(f"{id_path}\\pdfs.csv", index_col=0)
+        except FileNotFoundError:
+            print(f"PDF links not parsed for {id}")
+            continue
+        years = [year] if year else pdfs.index.to_list()
+
+        if run_parse:
+            for y in years:
+                unit = f"parse_{id}_{y}"
+                if not acquire(unit):
+                    continue
+                try:
+                    # Read the manifest per year, as other workers record their years in it
+                    manifest = ParseManifest(f"{id_path}\\manifest.json")
+                    todo = [y]
+                    if incremental:
+                        todo, _ = stale_years(dataparser, manifest, id_path, pdfs, todo, id_config['report_parser'])
+                    failed = parse_company(dataparser, manifest, id_path, id_config, pdfs, todo) if todo else []
+                    leases.complete(unit, failed=bool(failed))
+                except Exception as e:
+                    print(f"Error parsing report for year {y}:")
+                    print(e)
+                    leases.complete(unit, failed=True, error=str(e))
+                ran += 1
+                if run_consolidate:
+                    ran += consolidate(id, years)
+
+        # Companies whose last year was finished by another worker, or before this run
+        if run_consolidate:
+            ran += consolidate(id, years)
+    return ran
+
+def run_job(job, config, dataparser, store, processes=None):
+    """
+    Runs a job of reportparser serve: parses and consolidates one company, as
+    reportparser --id would with the same arguments.
+
+    Returns a dict of the years parsed, the years which failed, the output.json
+    of each parsed year, and whether the company was consolidated.
+    """
+    id = job['id']
+    id_config = config[id]
+    id_path = f"data\\{id}"
+    manifest = ParseManifest(f"{id_path}\\manifest.json")
+    pdfs = pd.read_csv(f"{id_path}\\pdfs.csv", index_col=0)
+    run_all = not (job.get('parse') or job.get('consolidate'))
+    result = {'id': id, 'parsed': [], 'failed': [], 'outputs': {}, 'consolidated': False}
+
+    if run_all or job.get('parse'):
+        years = [job['year']] if job.get('year') else pdfs.index.to_list()
+        if job.get('year') and job['year'] not in pdfs.index:
+            raise ValueError(f"No annual report found for {id} in {job['year']}")
+        if job.get('incremental'):
+            years, _ = stale_years(dataparser, manifest, id_path, pdfs, years, id_config['report_parser'])
+        result['failed'] = sorted(parse_company(dataparser, manifest, id_path, id_config, pdfs, years,
+                                                workers=job.get('workers', 1), processes=processes))
+        result['parsed'] = [y for y in years if y not in result['failed']]
+        for y in result['parsed']:
+            with open(f"{id_path}\\{y}\\output.json") as f:
+                result['outputs'][y] = json.load(f)
+
+    if run_all or job.get('consolidate'):
+        result['consolidated'] = consolidate_company(dataparser, store, manifest, id, id_path, id_config, pdfs.index,
+                                                     workers=job.get('workers', 1), incremental=job.get('incremental'))
+    return result
+
+class ParserService():
+    """
+    Long-running reportparser worker, taking jobs over a local HTTP API.
+
+    The OpenAI client and its connection pool, the response cache, the upload
+    registry, the aliases, and a pool of text extraction processes are set up
+    once and shared by every job, and config.json is only read again when it
+    changes. Jobs are kept in a JobQueue, so queued jobs survive a restart.
+
+        POST /jobs          queue a job, a JSON object of reportparser arguments:
+                            id, and optionally year, parse, consolidate,
+                            incremental and workers
+        GET  /jobs          the most recent jobs, optionally ?status=<status>
+        GET  /jobs/<id>     a job's status, attempts, error and result
+
+    Claims are renewed in the background, where the jobs of servers which
+    stopped are queued again and the response cache is evicted.
+
+    Parameters:
+        jobs (int): Number of jobs run concurrently.
+        processes (int): Number of text extraction processes.
+        evict_interval (float): Seconds between evictions of the response cache.
+        report_path (str): Optional JSON lines file to write the spans to, "" for
+            runs\\reportparser_serve_<time>.jsonl.
+    """
+    def __init__(self, queue, cache=None, jobs=2, processes=2, report_path=None, evict_interval=3600, verbose=False):
+        self.queue = queue
+        self.jobs = jobs
+        self.evict_interval = evict_interval
+        self.verbose = verbose
+        self.store = StatementStore(verbose=verbose)
+        run_id = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        if report_path == "":
+            report_path = f"runs\\reportparser_serve_{run_id}.jsonl"
+        # Only the running totals are kept, as the service runs for long
+        self.tracer = Tracer(report_path, run_id, keep_spans=False)
+        self.scheduler = RequestScheduler(verbose=verbose)
+        self.cache = cache if cache else ResponseCache(verbose=verbose)
+        self.dataparser = DataParser(verbose=verbose, cache=self.cache, aliases=AliasStore(verbose=verbose),
+                                     scheduler=self.scheduler, tracer=self.tracer)
+        # Spawned rather than forked, as other jobs' threads may hold locks
+        self.processes = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+        self.config = {}
+        self.config_mtime = None
+        self.config_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        return
+
+    def load_config(self):
+        """
+        Returns the contents of config.json, reading it again only if it changed.
+        """
+        with self.config_lock:
+            mtime = os.path.getmtime('config.json')
+            if mtime != self.config_mtime:
+                with open('config.json', 'r') as f:
+                    self.config = json.load(f)
+                self.config_mtime = mtime
+            return self.config
+
+    def job_parser(self, job):
+        """
+        Returns a DataParser for job, sharing the warm client and caches, at the
+        priority reportparser would give it.
+        """
+        return DataParser(verbose=self.verbose, cache=self.cache, uploads=self.dataparser.uploads,
+                          aliases=self.dataparser.aliases, scheduler=self.scheduler,
+                          priority=PRIORITY_INTERACTIVE if job.get('year') else PRIORITY_BACKFILL,
+                          tracer=self.tracer, client=self.dataparser.client)
+
+    def submit(self, job):
+        """
+        Validates and queues a job. Returns its id, or raises ValueError.
+        """
+        if not isinstance(job, dict) or job.get('id') not in self.load_config():
+            raise ValueError(f"No config found for {job.get('id') if isinstance(job, dict) else job}")
+        if job.get('year') is not None and not isinstance(job['year'], int):
+            raise ValueError(f"Invalid year {job['year']}")
+        job_id = self.queue.submit(job['id'], job, PRIORITY_INTERACTIVE if job.get('year') else PRIORITY_BACKFILL)
+        self.wakeup.set()
+        return job_id
+
+    def work(self):
+        while not self.stopping.is_set():
+            claimed = self.queue.claim()
+            if claimed is None:
+                self.wakeup.wait(1)
+                self.wakeup.clear()
+                continue
+
+            job_id, job = claimed
+            if self.verbose:
+                print(f"Running job {job_id}: {job}")
+            try:
+                with self.tracer.span("job", job=job_id, company=job['id'], year=job.get('year')):
+                    result = run_job(job, self.load_config(), self.job_parser(job), self.store, self.processes)
+                if result['failed']:
+                    retried = self.queue.fail(job_id, f"Failed to parse years {result['failed']}", result)
+                else:
+                    self.queue.complete(job_id, result)
+                    retried = None
+            except Exception as e:
+                print(f"Error running job {job_id}:")
+                print(e)
+                retried = self.queue.fail(job_id, e)
+            if self.verbose or retried is not None:
+                print(f"Job {job_id} {'done' if retried is None else 'queued again' if retried else 'failed'}.")
+
+    def maintain(self):
+        """
+        Renews this server's claims, queues again the jobs of servers which
+        stopped, and evicts the response cache, until the server stops.
+        """
+        evicted = time.monotonic()
+        while not self.stopping.wait(self.queue.ttl/4):
+            try:
+                self.queue.renew()
+                recovered = self.queue.recover(own=False)
+                if recovered:
+                    print(f"Queued {recovered} jobs of stopped servers again.")
+                    self.wakeup.set()
+                if time.monotonic() - evicted >= self.evict_interval:
+                    self.cache.evict()
+                    evicted = time.monotonic()
+            except Exception as e:
+                print("Error maintaining the job queue:")
+                print(e)
+
+    def handler(self):
+        service = self
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                if service.verbose:
+                    BaseHTTPRequestHandler.log_message(self, *args)
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                parts = url.path.strip("/").split("/")
+                if parts == ["jobs"]:
+                    self.respond(200, service.queue.recent(parse_qs(url.query).get('status', [None])[0]))
+                elif len(parts) == 2 and parts[0] == "jobs" and parts[1].isdigit():
+                    job = service.queue.get(int(parts[1]))
+                    if job is None:
+                        self.respond(404, {'error': f"No job {parts[1]}"})
+                    else:
+                        self.respond(200, job)
+                else:
+                    self.respond(404, {'error': f"Unknown path {url.path}"})
+
+            def do_POST(self):
+                if urlsplit(self.path).path.strip("/") != "jobs":
+                    self.respond(404, {'error': f"Unknown path {self.path}"})
+                    return
+                try:
+                    job = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                    self.respond(202, {'job': service.submit(job)})
+                except ValueError as e:
+                    self.respond(400, {'error': str(e)})
+
+            def respond(self, status, payload):
+                data = json.dumps(payload, default=str).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+        return Handler
+
+    def serve(self, port=8765):
+        """
+        Serves the HTTP API on localhost:port and runs jobs until interrupted.
+        Running jobs are finished before returning.
+        """
+        recovered = self.queue.recover()
+        if recovered:
+            print(f"Queued {recovered} interrupted jobs again.")
+        workers = [threading.Thread(target=self.work) for _ in range(self.jobs)]
+        workers.append(threading.Thread(target=self.maintain))
+        for t in workers:
+            t.start()
+        server = ThreadingHTTPServer(("127.0.0.1", port), self.handler())
+        # Stop on SIGTERM as on Ctrl-C, so that a service manager can stop the worker cleanly
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        print(f"Serving reportparser jobs on http://127.0.0.1:{port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print("Stopping after the running jobs...")
+        finally:
+            server.server_close()
+            self.stopping.set()
+            self.wakeup.set()
+            for t in workers:
+                t.join()
+            self.processes.shutdown()
+        if self.verbose:
+            print(self.cache.stats())
+            print(self.scheduler.stats())
+            print(self.tracer.summary())
 
 def run():
     # Parse args for program
     parser = argparse.ArgumentParser(prog="reportparser", description="Scrapes a website for annual report PDFs.")
+    parser.add_argument(
+        "command",
+        type=str,
+        nargs="?",
+        choices=["serve"],
+        help="serve: run as a worker taking jobs over a local HTTP API, submitted with reportclient."
+    )
     parser.add_argument(
         "-i", "--id",
         type=str, 
@@ -40,6 +622,121 @@ def run():
         required=False,
         help="Only consolidate data for all reports. By default, parsing and consolidating are run."
     )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        required=False,
+        help="Skip years whose output.json is up to date with the PDF, prompts and model, and skip consolidation if no output changed."
+    )
+    parser.add_argument(
+        "-w", "--workers",
+        type=int,
+        default=1,
+        required=False,
+        help="Number of years to parse, or windows of years to consolidate, concurrently. Defaults to 1."
+    )
+    parser.add_argument(
+        "--gc-uploads",
+        type=int,
+        nargs="?",
+        const=30,
+        required=False,
+        metavar="DAYS",
+        help="Delete files uploaded to OpenAI more than DAYS days ago (default 30), and forget uploads which no longer exist."
+    )
+    parser.add_argument(
+        "--evaluate-locator",
+        type=str,
+        nargs="?",
+        const="fixtures\\statement_pages.json",
+        required=False,
+        metavar="FIXTURES",
+        help="Report the precision and recall of the statement page locator on a set of labeled reports, and exit. Defaults to the synthetic pages in fixtures\\statement_pages.json, which only check for regressions."
+    )
+    parser.add_argument(
+        "--build-store",
+        action="store_true",
+        required=False,
+        help="Load the consolidated CSVs of the selected companies into the Parquet store in ./data/store, and exit."
+    )
+    parser.add_argument(
+        "--batch",
+        type=str,
+        choices=["submit", "poll", "collect"],
+        required=False,
+        help="Parse with the OpenAI Batch API: submit the extraction requests of the selected reports as one job, poll the status of submitted jobs, or collect the results of finished jobs and write their output.json files."
+    )
+    parser.add_argument(
+        "--openai-url",
+        type=str,
+        required=False,
+        metavar="URL",
+        help="Send the OpenAI requests, including --batch jobs, to another OpenAI compatible API, such as the local fake of benchmark --serve."
+    )
+    parser.add_argument(
+        "--shard",
+        type=str,
+        required=False,
+        metavar="WORK_DIR",
+        help="Share the work with other reportparser processes, on this or other hosts, started with the same WORK_DIR on a shared drive. Each year and each consolidation is leased to one process at a time."
+    )
+    parser.add_argument(
+        "--lease-ttl",
+        type=float,
+        default=300,
+        required=False,
+        help="Seconds after which the lease of a --shard process, or the jobs of a serve worker, which stopped are taken over by another. Defaults to 300."
+    )
+    parser.add_argument(
+        "--report",
+        type=str,
+        nargs="?",
+        const="",
+        required=False,
+        metavar="PATH",
+        help="Write a report of the run's stages to PATH as JSON lines. Defaults to runs\\reportparser_<time>.jsonl."
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        nargs="?",
+        const="",
+        required=False,
+        metavar="PATH",
+        help="Profile the PDF handling of each report with cProfile, and save the statistics to PATH. Defaults to runs\\reportparser_<time>.prof. With --workers, text extraction runs in other processes and isn't profiled."
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8765,
+        required=False,
+        help="Port of the serve HTTP API on localhost. Defaults to 8765."
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=2,
+        required=False,
+        help="Number of jobs serve runs concurrently. Defaults to 2. Text extraction runs in a pool of --workers processes."
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        required=False,
+        help="Neither read nor write the OpenAI response cache."
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        required=False,
+        help="Ignore cached OpenAI responses, and cache the new responses."
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        required=False,
+        help="Only use cached OpenAI responses. Fails on a cache miss."
+    )
     parser.add_argument(
         "-v", "--verbose",
         action="store_true",
@@ -49,8 +746,58 @@ def run():
     args = vars(parser.parse_args())
     verbose = args.get('verbose')
 
+    # Evaluate the statement page locator
+    if args.get('evaluate_locator'):
+        with open(args.get('evaluate_locator'), 'r') as f:
+            fixtures = json.load(f)
+        print(StatementLocator().evaluate(fixtures))
+        if os.path.normpath(args.get('evaluate_locator')) == os.path.normpath("fixtures\\statement_pages.json"):
+            print("These are synthetic pages, which only check for regressions. Label real reports to measure the locator.")
+        return
+
+    # A local API doesn't need a real key
+    client = OpenAI(api_key=openai_key or "local", base_url=args.get('openai_url'), max_retries=0) if args.get('openai_url') else None
+
+    # Garbage collect old uploads
+    if args.get('gc_uploads') is not None:
+        dataparser = DataParser(verbose=verbose, client=client)
+        removed = dataparser.uploads.gc(max_age_days=args.get('gc_uploads'))
+        print(f"Removed {removed} uploads.")
+        return
+
+    # Run as a worker
+    if args.get('command') == "serve":
+        cache = ResponseCache(enabled=not args.get('no_cache'),
+                              refresh=args.get('refresh'),
+                              offline=args.get('offline'),
+                              verbose=verbose)
+        # Named after the port, so that a restarted server takes its running jobs back at once
+        queue = JobQueue(ttl=args.get('lease_ttl'), owner=f"{socket.gethostname()}-{args.get('port')}")
+        service = ParserService(queue, cache=cache, jobs=args.get('jobs'), processes=max(args.get('workers'), 1),
+                                report_path=args.get('report'), verbose=verbose)
+        service.serve(args.get('port'))
+        return
+
+    batches = BatchManifest()
+    if args.get('batch') and args.get('no_cache'):
+        print("--batch stores its results in the response cache, and can't be used with --no-cache")
+        return
+    if args.get('batch') and args.get('shard'):
+        print("--batch can't be used with --shard")
+        return
+
+    # Report the status of submitted batch jobs
+    if args.get('batch') == "poll":
+        dataparser = DataParser(verbose=verbose, client=client)
+        transport = OpenAIBatchTransport(dataparser.client, scheduler=dataparser.scheduler)
+        for batch_id, job in batches.pending().items():
+            job.update(transport.status(batch_id))
+            print(f"Batch {batch_id}: {job['status']} ({job['completed']}/{job['total']} done, {job['failed']} failed)")
+        batches.save()
+        return
+
      # Figure out which companies to run
-    if (args.get('id') is None and args.get('all')==False):
+    if (args.get('id') is None and args.get('all')==False and args.get('batch') != "collect"):
         print("Must specify a company to scrape using --id or --all")
         return
     
@@ -69,66 +816,131 @@ def run():
     if verbose:
         print(f"Running parser on ids: {to_run}")
 
+    store = StatementStore(verbose=verbose)
+
+    # Backfill the Parquet store from existing CSVs
+    if args.get('build_store'):
+        for id in to_run:
+            for s in STATEMENTS:
+                csv_path = f"data\\{id}\\{s}.csv"
+                if os.path.exists(csv_path):
+                    store.write(id, s, pd.read_csv(csv_path, index_col='year'))
+        return
+
     # Figure out what operation we're running
     run_parse = args.get('parse')
     run_consolidate = args.get('consolidate')
     run_all = not (run_parse or run_consolidate)
 
     # Process reports
-    dataparser = DataParser(verbose=verbose)
+    cache = ResponseCache(enabled=not args.get('no_cache'),
+                          refresh=args.get('refresh'),
+                          offline=args.get('offline'),
+                          verbose=verbose)
+    aliases = AliasStore(verbose=verbose)
+    # Single year runs are served before backfills sharing the same limits
+    scheduler = RequestScheduler(verbose=verbose)
+    run_id = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    if args.get('shard'):
+        # Workers of a shard are usually started together
+        run_id = f"{run_id}_{os.getpid()}"
+    report_path = None
+    if args.get('report') is not None:
+        report_path = args.get('report') or f"runs\\reportparser_{run_id}.jsonl"
+    tracer = Tracer(report_path, run_id)
+    profiler = Profiler(enabled=args.get('profile') is not None)
+    dataparser = DataParser(verbose=verbose, cache=cache, aliases=aliases, scheduler=scheduler,
+                            priority=PRIORITY_INTERACTIVE if args.get('year') else PRIORITY_BACKFILL,
+                            tracer=tracer, profiler=profiler, client=client)
+
+    # Run as one of several workers, leasing each year and consolidation
+    if args.get('shard'):
+        leases = LeaseManager(args.get('shard'), ttl=args.get('lease_ttl'), verbose=verbose)
+        try:
+            ran = run_shard(leases, dataparser, store, config, to_run,
+                            run_parse=run_all or run_parse,
+                            run_consolidate=run_all or run_consolidate,
+                            year=args.get('year'),
+                            incremental=args.get('incremental'))
+        finally:
+            leases.close()
+        print(f"Ran {ran} work units of {args.get('shard')}.")
+        # Every company was handled by the shard
+        to_run = []
+
+    # Batch jobs are submitted once all companies are planned, and their results
+    # are parsed like any other run, from the response cache
+    transport = OpenAIBatchTransport(dataparser.client, scheduler=scheduler)
+    batch_requests = []
+    batch_cache_keys = {}
+    batch_reports = {}
+    if args.get('batch') == "collect":
+        collected = collect_batches(cache, transport, batches)
+        to_run = [id for id in config.keys() if id in collected]
+        if verbose:
+            print(f"Collected batch results for: {collected}")
+
     for id in to_run:
         id_config = config[id]
         id_path = f"data\\{id}"
+        manifest = ParseManifest(f"{id_path}\\manifest.json")
 
         # Parser
         if run_all or run_parse:
             pdfs = pd.read_csv(f"{id_path}\\pdfs.csv", index_col=0)
-            if run_parse:
+            if args.get('batch') == "collect":
+                years = collected[id]
+            elif run_parse:
                 years = [args.get('year')]
             else:
                 years = pdfs.index.to_list()
 
-            for y in years:
-                report_path = f"{id_path}\\{y}"
-                report_name = pdfs.loc[y]['filename']
-                if os.path.exists(f"{report_path}\\{report_name}"):
-                    dataparser.parse_report_for_year(report_path=report_path,
-                                                     report_name=report_name,
-                                                     year=y,
-                                                     special_instructions=id_config['report_parser']['special_instructions'])
-                else:
-                    print(f"Report does not exist: {report_name}")
-                    break
-            if run_parse:
-                return
+            special_instructions = id_config['report_parser']['special_instructions']
+            if args.get('incremental'):
+                years, current = stale_years(dataparser, manifest, id_path, pdfs, years, id_config['report_parser'])
+                if verbose:
+                    print(f"Skipping up to date years for {id}: {current}")
+
+            if args.get('batch') == "submit":
+                requests, cache_keys, planned = plan_batch(dataparser, id, id_path, pdfs, years,
+                                                           special_instructions=special_instructions,
+                                                           page_locator=id_config['report_parser'].get('page_locator', 'scored'),
+                                                           pdf_backend=id_config['report_parser'].get('pdf_backend', 'pypdf2'))
+                batch_requests.extend(requests)
+                batch_cache_keys.update(cache_keys)
+                batch_reports[id] = planned
+                continue
+
+            failed = parse_company(dataparser, manifest, id_path, id_config, pdfs, years, workers=args.get('workers'))
+            if failed:
+                print(f"Failed to parse years for {id}: {sorted(failed)}")
 
         # Consolidation
         if run_all or run_consolidate:
             pdfs = pd.read_csv(f"{id_path}\\pdfs.csv", index_col=0)
+            if not consolidate_company(dataparser, store, manifest, id, id_path, id_config, pdfs.index,
+                                       workers=args.get('workers'), incremental=args.get('incremental')):
+                if verbose:
+                    print(f"Consolidated data is up to date for {id}")
 
-            balance_sheet = []
-            income_statement = []
-            cash_flow_statement = []
-            for y in pdfs.index:
-                output_file = f"{id_path}\\{y}\\output.json"
-                if os.path.exists(output_file):
-                    with open(output_file) as f:
-                        statement = json.load(f)
-                        statement['balance_sheet'].update({'year':y})
-                        balance_sheet.append(statement['balance_sheet'])
+    if args.get('batch') == "submit":
+        if not batch_requests:
+            print("All extraction requests are already cached. Parse without --batch to write the outputs.")
+            return
+        batch_id = transport.submit(batch_requests)
+        batches.add(batch_id, batch_cache_keys, batch_reports)
+        batches.save()
+        print(f"Submitted batch {batch_id} with {len(batch_requests)} requests.")
 
-                        statement['income_statement'].update({'year':y})
-                        income_statement.append(statement['income_statement'])
+    if args.get('profile') is not None:
+        profile_path = args.get('profile') or f"runs\\reportparser_{run_id}.prof"
+        profiler.dump(profile_path)
+        print(f"Saved profile to {profile_path}")
 
-                        statement['cash_flow_statement'].update({'year':y})
-                        cash_flow_statement.append(statement['cash_flow_statement'])
-
-            df_balance_sheet = dataparser.consolidate_reports(balance_sheet, 'balance sheet', id_config['data_consolidator']['balance_sheet_special_instructions'], id_config['data_consolidator']['model']) 
-            df_income_statement = dataparser.consolidate_reports(income_statement, 'income statement', id_config['data_consolidator']['income_statement_special_instructions'], id_config['data_consolidator']['model']) 
-            df_cash_flow_statement = dataparser.consolidate_reports(cash_flow_statement, 'cash flow statement', id_config['data_consolidator']['cash_flow_statement_special_instructions'], id_config['data_consolidator']['model'])
-
-            df_balance_sheet.to_csv(f"{id_path}\\balance_sheet.csv")
-            df_income_statement.to_csv(f"{id_path}\\income_statement.csv")
-            df_cash_flow_statement.to_csv(f"{id_path}\\cash_flow_statement.csv")
-
-            return
\ No newline at end of file
+    if verbose:
+        print(cache.stats())
+        print(scheduler.stats())
+        print(tracer.summary())
+        if tracer.report_path:
+            print(f"Run report saved to {tracer.report_path}")
+    return
@@ -0,0 +1,157 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from classes import FileLock, LeaseManager
+
+def work(work_dir, units, ttl, crash=False):
+    """
+    Runs units as one worker of a shard, as pdfscraper and reportparser do. Each
+    run of a unit is logged to its .runs file, and counted in a counter file
+    under a FileLock. With crash, the worker exits after taking its first lease,
+    without releasing it, as a killed process would.
+    """
+    leases = LeaseManager(work_dir, ttl=ttl)
+    for unit in units:
+        if not leases.acquire(unit):
+            continue
+        with open(f"{work_dir}\\{unit}.runs", "a", encoding="utf-8") as f:
+            f.write(f"{leases.owner}\n")
+        if crash:
+            os._exit(1)
+        time.sleep(random.uniform(0.01, 0.1))
+        with FileLock(f"{work_dir}\\counter.lock"):
+            with open(f"{work_dir}\\counter", "r", encoding="utf-8") as f:
+                count = int(f.read())
+            with open(f"{work_dir}\\counter", "w", encoding="utf-8") as f:
+                f.write(str(count + 1))
+        leases.complete(unit)
+    leases.close()
+
+def check(workers=4, units=40, ttl=2, verbose=False):
+    """
+    Runs units in workers local processes sharing a work directory, after a
+    worker which crashes holding a lease, then runs the workers again once the
+    lease expired, as a restarted run would. Returns a list of problems, empty
+    if every unit was completed, the crashed worker's unit was taken over by
+    the second run, and no other unit ran twice.
+    """
+    work_dir = tempfile.mkdtemp(prefix="shardcheck")
+    names = [f"unit_{i:03d}" for i in range(units)]
+    problems = []
+    try:
+        with open(f"{work_dir}\\counter", "w", encoding="utf-8") as f:
+            f.write("0")
+
+        command = [sys.executable, os.path.abspath(__file__), "--worker", work_dir, "--units", str(units), "--ttl", str(ttl)]
+        # The crashed worker takes the first unit before the others start
+        subprocess.run(command + ["--crash"], check=False)
+        crashed = time.perf_counter()
+        start = time.perf_counter()
+        for attempt in range(2):
+            if attempt:
+                time.sleep(max(ttl - (time.perf_counter() - crashed), 0) + 0.1)
+            processes = [subprocess.Popen(command) for _ in range(workers)]
+            for p in processes:
+                if p.wait() != 0:
+                    problems.append(f"A worker exited with {p.returncode}.")
+        elapsed = time.perf_counter() - start
+        runs = {}
+        for name in names:
+            if not os.path.exists(f"{work_dir}\\{name}.done"):
+                problems.append(f"{name} was not completed.")
+            try:
+                with open(f"{work_dir}\\{name}.runs", "r", encoding="utf-8") as f:
+                    runs[name] = f.read().split()
+            except FileNotFoundError:
+                runs[name] = []
+        for name, owners in runs.items():
+            # The crashed worker's unit is run again once its lease expires
+            expected = 2 if name == names[0] else 1
+            if len(owners) != expected:
+                problems.append(f"{name} ran {len(owners)} times, expected {expected}: {owners}.")
+        with open(f"{work_dir}\\counter", "r", encoding="utf-8") as f:
+            count = int(f.read())
+        completed = sum(len(owners) for owners in runs.values()) - 1
+        if count != completed:
+            problems.append(f"The counter under FileLock is {count}, expected {completed}.")
+
+        if verbose:
+            owners = {}
+            for name, unit_owners in runs.items():
+                for owner in unit_owners[-1:]:
+                    owners[owner] = owners.get(owner, 0) + 1
+            print(f"Ran {units} units in two runs of {workers} workers in {elapsed:.1f}s, units per worker: {json.dumps(owners)}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        # Lease, done and counter files of the work directory may sit beside it
+        parent, base = os.path.split(work_dir)
+        for name in os.listdir(parent):
+            if name.startswith(f"{base}\\"):
+                os.remove(os.path.join(parent, name))
+    return problems
+
+def run():
+    # Parse args for program
+    parser = argparse.ArgumentParser(prog="shardcheck", description="Checks that --shard workers share a run's units correctly, with several local processes.")
+    parser.add_argument(
+        "-w", "--workers",
+        type=int,
+        default=4,
+        required=False,
+        help="Number of worker processes. Defaults to 4."
+    )
+    parser.add_argument(
+        "--units",
+        type=int,
+        default=40,
+        required=False,
+        help="Number of work units. Defaults to 40."
+    )
+    parser.add_argument(
+        "--ttl",
+        type=float,
+        default=2,
+        required=False,
+        help="Seconds after which the crashed worker's lease expires. Defaults to 2."
+    )
+    parser.add_argument(
+        "--worker",
+        type=str,
+        required=False,
+        metavar="WORK_DIR",
+        help=argparse.SUPPRESS
+    )
+    parser.add_argument(
+        "--crash",
+        action="store_true",
+        required=False,
+        help=argparse.SUPPRESS
+    )
+    parser.add_argument(
+        "-v", "--verbose",
+        action="store_true",
+        required=False,
+        help="Enable verbose mode"
+    )
+    args = vars(parser.parse_args())
+
+    units = [f"unit_{i:03d}" for i in range(args.get('units'))]
+    if args.get('worker'):
+        work(args.get('worker'), units, args.get('ttl'), crash=args.get('crash'))
+        return
+
+    problems = check(workers=args.get('workers'), units=args.get('units'), ttl=args.get('ttl'), verbose=args.get('verbose'))
+    for problem in problems:
+        print(problem)
+    print("Shard check failed." if problems else "Shard check passed.")
+    sys.exit(1 if problems else 0)
+
+if __name__ == "__main__":
+    run()